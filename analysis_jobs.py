@@ -0,0 +1,232 @@
+"""
+Background jobs for large /analyze and /close_year requests.
+
+A submission is answered at once with a job id while a small, bounded set of
+job threads hands the work to the analysis process pool (portfolio_batch), so
+a long analysis neither holds a web worker nor blocks other requests. Clients
+poll (or long-poll) the job's status and fetch its serialized result once it
+is done. Jobs are keyed by their input, so submitting the same upload again
+while it is queued, running or still kept returns the existing job. Finished
+jobs are dropped result_ttl seconds after they end, or earlier, oldest first,
+once there are more than max_finished of them or their results take more
+than max_finished_bytes. A job can also leave an attachment, such as the
+upload an /analyze session is started from, for the first client that fetches
+its result; one nobody takes is dropped attachment_ttl seconds after the job
+ends.
+
+Each web worker process keeps its own jobs; a client that asks another worker
+about a job gets 404 and can fall back to a normal request.
+
+Configuration (environment variables):
+    ANALYSIS_JOB_WORKERS     jobs run at the same time (default: 2)
+    ANALYSIS_JOB_QUEUE_SIZE  queued plus running jobs before new ones are
+                             refused (default: 8)
+    ANALYSIS_JOB_TTL         seconds a finished job's result is kept (default: 600)
+    ANALYSIS_JOB_MAX_FINISHED  finished jobs kept (default: 32)
+    ANALYSIS_JOB_MAX_BYTES   total size of the kept results and attachments
+                             (default: 128 MB)
+    ANALYSIS_JOB_ATTACHMENT_TTL  seconds an attachment waits to be taken
+                             (default: 60)
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional
+
+ANALYSIS_JOB_WORKERS = int(os.environ.get('ANALYSIS_JOB_WORKERS', 2))
+ANALYSIS_JOB_QUEUE_SIZE = int(os.environ.get('ANALYSIS_JOB_QUEUE_SIZE', 8))
+ANALYSIS_JOB_TTL = float(os.environ.get('ANALYSIS_JOB_TTL', 600))
+ANALYSIS_JOB_MAX_FINISHED = int(os.environ.get('ANALYSIS_JOB_MAX_FINISHED', 32))
+ANALYSIS_JOB_MAX_BYTES = int(os.environ.get('ANALYSIS_JOB_MAX_BYTES', 128 * 1024 * 1024))
+ANALYSIS_JOB_ATTACHMENT_TTL = float(os.environ.get('ANALYSIS_JOB_ATTACHMENT_TTL', 60))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class QueueFullError(Exception):
+    """Too many jobs are queued or running; the client should retry later."""
+
+
+class Job:
+    """One submitted job and, once it has ended, its result or error."""
+    __slots__ = ('id', 'kind', 'key', 'status', 'created', 'finished', 'body', 'error', 'error_status', 'etag',
+                 'attachment', '_ended')
+
+    def __init__(self, kind: str, key: Hashable, etag: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.status = QUEUED
+        self.created = time.time()
+        self.finished: Optional[float] = None
+        self.body: Optional[bytes] = None
+        self.error: Optional[str] = None
+        self.error_status: Optional[int] = None  # HTTP status for a failed job
+        self.etag = etag
+        self.attachment = None  # Handed to the first taker, see JobQueue.take_attachment()
+        self._ended = threading.Event()
+
+    @property
+    def ended(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def wait(self, timeout: float) -> bool:
+        """Blocks until the job has ended or `timeout` seconds have passed; True if it has ended."""
+        return self._ended.wait(timeout)
+
+    def describe(self) -> dict:
+        status = {"job_id": self.id, "kind": self.kind, "status": self.status, "created": self.created}
+        if self.finished is not None:
+            status["finished"] = self.finished
+        if self.status == FAILED:
+            status["error"] = self.error
+            status["error_status"] = self.error_status
+        return status
+
+
+class JobQueue:
+    """
+    Runs jobs on `workers` background threads, with at most `max_pending`
+    jobs queued or running. `classify_error` turns an exception raised by a
+    job into the HTTP status reported for it, and `attachment_size` gives the
+    bytes an attachment counts towards max_finished_bytes.
+    """
+
+    def __init__(self, workers: int = ANALYSIS_JOB_WORKERS, max_pending: int = ANALYSIS_JOB_QUEUE_SIZE,
+                 result_ttl: float = ANALYSIS_JOB_TTL, classify_error: Callable[[Exception], int] = lambda e: 500,
+                 max_finished: int = ANALYSIS_JOB_MAX_FINISHED, max_finished_bytes: int = ANALYSIS_JOB_MAX_BYTES,
+                 attachment_ttl: float = ANALYSIS_JOB_ATTACHMENT_TTL,
+                 attachment_size: Callable[[object], int] = lambda attachment: 0):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.classify_error = classify_error
+        self.max_finished = max_finished
+        self.max_finished_bytes = max_finished_bytes
+        self.attachment_ttl = attachment_ttl
+        self.attachment_size = attachment_size
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()  # In submission order
+        self._by_key: Dict[Hashable, Job] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _expire(self, now: float):
+        """
+        Drops attachments and finished jobs past their TTL, then the oldest
+        finished jobs beyond max_finished or max_finished_bytes. Call with
+        the lock held.
+        """
+        finished = []
+        for job in list(self._jobs.values()):
+            if job.finished is None:
+                continue
+            if now - job.finished > self.result_ttl:
+                self._drop(job)
+                continue
+            if job.attachment is not None and now - job.finished > self.attachment_ttl:
+                job.attachment = None
+            finished.append(job)
+        count, size = len(finished), sum(self._size(job) for job in finished)
+        for job in finished:  # In submission order, so the oldest go first
+            if count <= self.max_finished and size <= self.max_finished_bytes:
+                break
+            count, size = count - 1, size - self._size(job)
+            self._drop(job)
+
+    def _size(self, job: Job) -> int:
+        return len(job.body or b'') + (self.attachment_size(job.attachment) if job.attachment is not None else 0)
+
+    def _drop(self, job: Job):
+        del self._jobs[job.id]
+        if self._by_key.get(job.key) is job:
+            del self._by_key[job.key]
+
+    def _add(self, job: Job):
+        self._jobs[job.id] = job
+        self._by_key[job.key] = job
+
+    def submit(self, kind: str, key: Hashable, fn: Callable, *args,
+               etag: Optional[str] = None, on_done: Optional[Callable[[bytes], None]] = None) -> Job:
+        """
+        Queues fn(*args), which must return the serialized result as bytes,
+        or a (bytes, attachment) pair (see take_attachment()), unless a job
+        with the same key is already queued, running or done (a failed job is
+        submitted again). `on_done` receives the result body when the job
+        succeeds. Raises QueueFullError when the queue is full.
+        """
+        with self._lock:
+            self._expire(time.time())
+            job = self._by_key.get(key)
+            if job is not None and job.status != FAILED:
+                return job
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f"{self._pending} analysis jobs are already waiting, please retry shortly")
+            job = Job(kind, key, etag)
+            self._add(job)
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='analysis-job')
+            self._executor.submit(self._run, job, fn, args, on_done)
+            return job
+
+    def completed(self, kind: str, key: Hashable, body: bytes, etag: Optional[str] = None) -> Job:
+        """Records an already known result (e.g. from the response cache) as a finished job."""
+        with self._lock:
+            self._expire(time.time())
+            job = self._by_key.get(key)
+            if job is not None and job.status == DONE:
+                return job
+            job = Job(kind, key, etag)
+            self._finish(job, DONE, body=body)
+            self._add(job)
+            return job
+
+    def _run(self, job: Job, fn: Callable, args: tuple, on_done: Optional[Callable[[bytes], None]]):
+        job.status = RUNNING
+        try:
+            body = fn(*args)
+            if isinstance(body, tuple):
+                body, job.attachment = body
+        except Exception as e:
+            with self._lock:
+                self._pending -= 1
+                self._finish(job, FAILED, error=str(e), error_status=self.classify_error(e))
+            return
+        with self._lock:
+            self._pending -= 1
+            self._finish(job, DONE, body=body)
+            self._expire(time.time())
+        if on_done is not None:
+            on_done(body)
+
+    @staticmethod
+    def _finish(job: Job, status: str, body: Optional[bytes] = None, error: Optional[str] = None,
+                error_status: Optional[int] = None):
+        job.body, job.error, job.error_status = body, error, error_status
+        job.finished = time.time()
+        job.status = status
+        job._ended.set()
+
+    def take_attachment(self, job: Job):
+        """The job's attachment, or None; only the first caller gets it."""
+        with self._lock:
+            attachment, job.attachment = job.attachment, None
+            return attachment
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._expire(time.time())
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._expire(time.time())
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return {**counts, "workers": self.workers, "max_pending": self.max_pending, "result_ttl": self.result_ttl,
+                    "finished_bytes": sum(self._size(job) for job in self._jobs.values() if job.finished is not None)}
@@ -0,0 +1,151 @@
+"""
+Serialization of analysis results for the web app.
+
+Rows are built straight from the OpenLot/ClosedTrade attributes instead of
+dataclasses.asdict(), which deep-copies every field of every row. Results can
+be filtered (symbol, lot number, date range) and paginated, or streamed as
+NDJSON: one summary line first, then one line per row, so a client can start
+rendering before the whole result has arrived.
+"""
+import json
+from dataclasses import dataclass, fields
+from operator import attrgetter
+from typing import Iterator, List, Optional, Tuple
+
+from portfolio_lib import OpenLot, ClosedTrade, normalize_date
+
+Analysis = Tuple[List[OpenLot], List[ClosedTrade], float, float, float]
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Rows per chunk written to an NDJSON stream
+NDJSON_CHUNK_ROWS = 500
+
+OPEN_LOT_FIELDS = tuple(f.name for f in fields(OpenLot))
+CLOSED_TRADE_FIELDS = tuple(f.name for f in fields(ClosedTrade))
+_open_lot_values = attrgetter(*OPEN_LOT_FIELDS)
+_closed_trade_values = attrgetter(*CLOSED_TRADE_FIELDS)
+
+
+def open_lot_rows(open_lots: List[OpenLot]) -> List[dict]:
+    """Same dicts as asdict() for each lot (all fields are plain values)."""
+    return [dict(zip(OPEN_LOT_FIELDS, _open_lot_values(lot))) for lot in open_lots]
+
+
+def closed_trade_rows(closed_trades: List[ClosedTrade]) -> List[dict]:
+    """Same dicts as asdict() for each trade."""
+    return [dict(zip(CLOSED_TRADE_FIELDS, _closed_trade_values(trade))) for trade in closed_trades]
+
+
+def analysis_summary(analysis: Analysis, transaction_count: int) -> dict:
+    """Totals of an analysis, without the row lists."""
+    open_lots, _, total_investment, total_realized_pl, total_dividends = analysis
+    return {
+        "total_investment": total_investment,
+        "total_realized_pl": total_realized_pl,
+        "total_dividends": total_dividends,
+        "transaction_count": transaction_count,
+        # รายชื่อหุ้นที่ยังคงมีอยู่ในพอร์ตเท่านั้น
+        "all_symbols": sorted(set(lot.symbol for lot in open_lots)),
+    }
+
+
+@dataclass
+class RowQuery:
+    """
+    Which rows of an analysis to return. Open lots are matched on their buy
+    date and closed trades on their sell date. `offset` and `limit` apply to
+    each list separately.
+    """
+    symbol: Optional[str] = None
+    lot: Optional[str] = None
+    start: Optional[str] = None
+    end: Optional[str] = None
+    offset: int = 0
+    limit: Optional[int] = None
+
+    @classmethod
+    def from_args(cls, args) -> 'RowQuery':
+        """Reads symbol, lot, start, end, offset and limit from request args. Raises ValueError."""
+        def number(name: str) -> Optional[int]:
+            value = args.get(name)
+            if value in (None, ''):
+                return None
+            try:
+                value = int(value)
+            except ValueError:
+                raise ValueError(f"'{name}' must be a whole number") from None
+            if value < 0:
+                raise ValueError(f"'{name}' must not be negative")
+            return value
+
+        start, end = args.get('start'), args.get('end')
+        return cls(
+            symbol=(args.get('symbol') or '').strip().upper() or None,
+            lot=(args.get('lot') or '').strip() or None,
+            start=normalize_date(start) if start else None,
+            end=normalize_date(end) if end else None,
+            offset=number('offset') or 0,
+            limit=number('limit'),
+        )
+
+    @property
+    def is_filtered(self) -> bool:
+        return any((self.symbol, self.lot, self.start, self.end, self.offset, self.limit is not None))
+
+    def cache_suffix(self) -> str:
+        """A stable string for this query, to keep its responses apart in caches and ETags."""
+        if not self.is_filtered:
+            return ''
+        return json.dumps([self.symbol, self.lot, self.start, self.end, self.offset, self.limit])
+
+    def _matches(self, symbol: str, lot_number: str, when: str) -> bool:
+        return ((self.symbol is None or symbol == self.symbol)
+                and (self.lot is None or lot_number == self.lot)
+                and (self.start is None or when >= self.start)
+                and (self.end is None or when <= self.end))
+
+    def select(self, analysis: Analysis) -> Tuple[List[OpenLot], List[ClosedTrade], int, int]:
+        """The open lots and closed trades on the requested page, and how many of each matched in total."""
+        open_lots, closed_trades = analysis[0], analysis[1]
+        if self.symbol or self.lot or self.start or self.end:
+            open_lots = [lot for lot in open_lots if self._matches(lot.symbol, lot.lot_number, lot.buy_date)]
+            closed_trades = [t for t in closed_trades if self._matches(t.symbol, t.lot_number, t.sell_date)]
+        stop = None if self.limit is None else self.offset + self.limit
+        return open_lots[self.offset:stop], closed_trades[self.offset:stop], len(open_lots), len(closed_trades)
+
+
+def build_rows_response(analysis: Analysis, transaction_count: int, query: RowQuery) -> dict:
+    """The /analyze response for one filtered page: whole-portfolio totals and the selected rows."""
+    open_lots, closed_trades, open_lot_count, closed_trade_count = query.select(analysis)
+    response = analysis_summary(analysis, transaction_count)
+    response.update({
+        "open_lots": open_lot_rows(open_lots),
+        "closed_trades": closed_trade_rows(closed_trades),
+        "open_lot_count": open_lot_count,
+        "closed_trade_count": closed_trade_count,
+        "offset": query.offset,
+        "limit": query.limit,
+    })
+    return response
+
+
+def iter_ndjson(analysis: Analysis, transaction_count: int, query: Optional[RowQuery] = None) -> Iterator[bytes]:
+    """
+    The analysis as NDJSON chunks: a {"type": "summary", ...} line with the
+    totals and row counts, then {"type": "open_lot", ...} and
+    {"type": "closed_trade", ...} lines, and a final {"type": "end"} line.
+    """
+    open_lots, closed_trades, open_lot_count, closed_trade_count = (query or RowQuery()).select(analysis)
+    dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+    summary = analysis_summary(analysis, transaction_count)
+    summary.update({"type": "summary", "open_lot_count": open_lot_count, "closed_trade_count": closed_trade_count})
+    yield (dumps(summary) + '\n').encode('utf-8')
+
+    for row_type, names, values, rows in (('open_lot', OPEN_LOT_FIELDS, _open_lot_values, open_lots),
+                                           ('closed_trade', CLOSED_TRADE_FIELDS, _closed_trade_values, closed_trades)):
+        names = ('type',) + names
+        for start in range(0, len(rows), NDJSON_CHUNK_ROWS):
+            lines = [dumps(dict(zip(names, (row_type,) + values(row)))) for row in rows[start:start + NDJSON_CHUNK_ROWS]]
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+    yield b'{"type":"end"}\n'
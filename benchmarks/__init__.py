@@ -0,0 +1 @@
+"""Benchmarks and synthetic portfolio data. Run `python -m benchmarks.run` from the project folder."""
@@ -0,0 +1,180 @@
+"""
+Synthetic portfolios for benchmarks.
+
+Each symbol gets a random-walk price history. Lots are bought on random days,
+some are sold later (in one go or in several partial sales), and every lot
+still held on a dividend date receives a DIVIDEND (or sometimes a
+CASH_RETURN). The output has the same fields as portfolio.json, or the same
+columns as new_transactions.csv.
+
+Usage:
+    python -m benchmarks.generator portfolio.json --symbols 20 --lots-per-symbol 100
+    python -m benchmarks.generator new_transactions.csv --messy-dates 0.3
+"""
+import argparse
+import csv
+import json
+import random
+from dataclasses import dataclass, asdict
+from datetime import date
+from typing import Dict, List
+
+from portfolio_lib import DATE_FORMATS, ISO_DATE_FORMAT
+
+# Columns of new_transactions.csv (see converter.py)
+CSV_COLUMNS = ['Date', 'Symbol', 'Type', 'Lot Number', 'Volume', 'Price per Share', 'Commission', 'Tax Rate (%)', 'Remark']
+# Fields of a transaction in portfolio.json
+JSON_FIELDS = ['symbol', 'date', 'type', 'volume', 'price_per_unit', 'commission', 'mylotnumber',
+               'closes_lot_number', 'total_amount', 'remark', 'tax_rate', 'realized_pl', 'cumulative_pl_for_symbol']
+DIVIDEND_TAX_RATE = 10.0
+
+
+@dataclass
+class PortfolioSpec:
+    """Shape of a synthetic portfolio."""
+    symbols: int = 20
+    lots_per_symbol: int = 50
+    sell_ratio: float = 0.6  # Share of lots that are sold (partly or fully)
+    partial_sell_ratio: float = 0.3  # Share of the sold lots that are sold in several smaller sales
+    dividends_per_year: int = 2  # Dividend dates per symbol and year
+    cash_return_ratio: float = 0.05  # Share of payouts that are CASH_RETURN instead of DIVIDEND
+    messy_dates: float = 0.0  # Share of dates written in a non-ISO format from DATE_FORMATS
+    years: int = 8
+    start: str = '2016-01-01'
+    lot_prefix: str = ''  # Prepended to lot numbers, e.g. to import a CSV into an existing portfolio
+    seed: int = 1
+
+
+def _commission(amount: float) -> float:
+    # Typical Thai broker fee (0.157%) plus 7% VAT
+    return round(amount * 0.00157 * 1.07, 2)
+
+
+def generate_portfolio(spec: PortfolioSpec) -> List[Dict]:
+    """Transactions as portfolio.json dicts, in date order."""
+    rnd = random.Random(spec.seed)
+    first_day = date.fromisoformat(spec.start).toordinal()
+    days = spec.years * 365
+    other_formats = [fmt for fmt in DATE_FORMATS if fmt != ISO_DATE_FORMAT]
+
+    def day_string(ordinal: int) -> str:
+        value = date.fromordinal(ordinal)
+        if spec.messy_dates and rnd.random() < spec.messy_dates:
+            return value.strftime(rnd.choice(other_formats))
+        return value.isoformat()
+
+    rows = []  # (day, sequence, transaction)
+
+    def add(day: int, **fields):
+        tx = dict.fromkeys(JSON_FIELDS)
+        tx.update(fields, date=day_string(day))
+        rows.append((day, len(rows), tx))
+
+    for s in range(spec.symbols):
+        symbol = f"SYM{s:03d}.BK"
+        # Daily closes as a random walk
+        price = rnd.uniform(2, 200)
+        prices = []
+        for _ in range(days + 1):
+            price = max(0.5, price * (1 + rnd.gauss(0.0002, 0.015)))
+            prices.append(round(price, 2))
+
+        lots = []  # [lot number, buy day, volume, sales as (day, volume)]
+        for k in range(spec.lots_per_symbol):
+            buy_day = rnd.randrange(days - 1)
+            volume = rnd.randint(1, 50) * 100
+            lot_number = f"{spec.lot_prefix}{symbol}-{k + 1}"
+            price = prices[buy_day]
+            add(first_day + buy_day, symbol=symbol, type='BUY', volume=volume, price_per_unit=price,
+                commission=_commission(volume * price), mylotnumber=lot_number)
+
+            sales = []
+            if rnd.random() < spec.sell_ratio:
+                parts = rnd.randint(2, 4) if rnd.random() < spec.partial_sell_ratio else 1
+                remaining = volume
+                sell_day = buy_day
+                for part in range(parts):
+                    if sell_day >= days - 1:
+                        break
+                    sell_day = rnd.randint(sell_day + 1, min(days, sell_day + 400))
+                    # A partial sale keeps a multiple of 100 shares unless it is the last one
+                    sold = remaining if part == parts - 1 else max(100, remaining // parts // 100 * 100)
+                    sold = min(sold, remaining)
+                    price = prices[sell_day]
+                    add(first_day + sell_day, symbol=symbol, type='SELL', volume=sold, price_per_unit=price,
+                        commission=_commission(sold * price), closes_lot_number=lot_number)
+                    sales.append((sell_day, sold))
+                    remaining -= sold
+                    if not remaining:
+                        break
+            lots.append([lot_number, buy_day, volume, sales])
+
+        # Payouts go to every lot still held on the day
+        for year in range(spec.years):
+            for n in range(spec.dividends_per_year):
+                pay_day = min(days, year * 365 + (n + 1) * 365 // (spec.dividends_per_year + 1) + rnd.randint(-20, 20))
+                cash_return = rnd.random() < spec.cash_return_ratio
+                per_share = round(prices[pay_day] * rnd.uniform(0.01, 0.04), 4)
+                for lot_number, buy_day, volume, sales in lots:
+                    if buy_day >= pay_day:
+                        continue
+                    held = volume - sum(sold for sell_day, sold in sales if sell_day <= pay_day)
+                    if held <= 0:
+                        continue
+                    if cash_return:
+                        add(first_day + pay_day, symbol=symbol, type='CASH_RETURN', volume=held, price_per_unit=per_share,
+                            commission=0.0, closes_lot_number=lot_number, total_amount=round(per_share * held, 2),
+                            remark="Capital return")
+                    else:
+                        add(first_day + pay_day, symbol=symbol, type='DIVIDEND', volume=held, price_per_unit=per_share,
+                            commission=0.0, closes_lot_number=lot_number, tax_rate=DIVIDEND_TAX_RATE,
+                            total_amount=round(per_share * held * (1 - DIVIDEND_TAX_RATE / 100), 2),
+                            remark=f"Dividend {year + 1}/{n + 1}")
+
+    rows.sort(key=lambda row: (row[0], row[1]))
+    return [tx for _, _, tx in rows]
+
+
+def portfolio_of_size(transactions: int, **spec_fields) -> List[Dict]:
+    """A portfolio of roughly `transactions` rows; lots_per_symbol is chosen to fit."""
+    spec = PortfolioSpec(**spec_fields)
+    sample = PortfolioSpec(**{**asdict(spec), 'lots_per_symbol': 20})
+    per_lot = len(generate_portfolio(sample)) / (20 * spec.symbols)
+    spec.lots_per_symbol = max(1, round(transactions / (per_lot * spec.symbols)))
+    return generate_portfolio(spec)
+
+
+def write_portfolio_json(path: str, transactions: List[Dict]):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(transactions, f, indent=2, ensure_ascii=False)
+
+
+def write_transactions_csv(path: str, transactions: List[Dict]):
+    """Writes the transactions in the new_transactions.csv layout read by converter.py."""
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(CSV_COLUMNS)
+        for tx in transactions:
+            writer.writerow([
+                tx['date'], tx['symbol'], tx['type'],
+                tx['mylotnumber'] if tx['type'] == 'BUY' else tx['closes_lot_number'],
+                tx['volume'], tx['price_per_unit'], tx['commission'],
+                tx['tax_rate'] if tx['tax_rate'] is not None else '',
+                tx['remark'] or '',
+            ])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic portfolio (.json) or transaction import file (.csv).")
+    parser.add_argument('output', help="portfolio.json-style .json file or new_transactions.csv-style .csv file")
+    defaults = PortfolioSpec()
+    for name, value in asdict(defaults).items():
+        parser.add_argument('--' + name.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+    spec = PortfolioSpec(**{name: getattr(args, name) for name in asdict(defaults)})
+    transactions = generate_portfolio(spec)
+    if args.output.lower().endswith('.csv'):
+        write_transactions_csv(args.output, transactions)
+    else:
+        write_portfolio_json(args.output, transactions)
+    print(f"Wrote {len(transactions):,} transactions to '{args.output}'.")
@@ -0,0 +1,255 @@
+"""
+Benchmarks for loading, saving, importing, fixing and analyzing portfolios.
+
+Every benchmark runs on synthetic portfolios of the requested sizes and
+reports the best and median time over a few repeats. Results are saved as
+JSON; pass an earlier results file with --compare to see what got slower.
+
+Usage (from the project folder):
+    python -m benchmarks.run
+    python -m benchmarks.run --sizes 1000 10000 100000 --output results.json
+    python -m benchmarks.run --compare results.json --only analyze
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import converter
+import fix_dates
+import main
+import portfolio_columnar
+import portfolio_parallel
+import webapp
+from portfolio_lib import StockTransaction, analyze_portfolio_by_lot
+
+from benchmarks.generator import portfolio_of_size, write_portfolio_json, write_transactions_csv
+
+DEFAULT_SIZES = [1_000, 10_000, 50_000]
+DEFAULT_REPEATS = 5
+# A benchmark is reported as a regression when it is this much slower than the compared run
+REGRESSION_FACTOR = 1.2
+# Rows in the CSV imported by the append_csv_to_json benchmark, as a share of the portfolio size
+CSV_IMPORT_SHARE = 0.1
+
+
+def measure(run: Callable[[], None], repeats: int, setup: Optional[Callable[[], None]] = None) -> List[float]:
+    """Runs `setup` (untimed) and `run` (timed) `repeats` times; returns the run times in seconds."""
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - started)
+    return times
+
+
+class BenchmarkRun:
+    """Benchmarks for one portfolio size, with its data files in a temporary folder."""
+
+    def __init__(self, size: int, repeats: int, workdir: str, spec_fields: dict):
+        self.repeats = repeats
+        self.workdir = workdir
+        self.transactions = portfolio_of_size(size, **spec_fields)
+        self.size = len(self.transactions)
+        self.portfolio = [StockTransaction(**tx) for tx in self.transactions]
+        self.body = json.dumps(self.transactions, ensure_ascii=False).encode('utf-8')
+
+        self.json_path = self._path('portfolio.json')
+        write_portfolio_json(self.json_path, self.transactions)
+        self.pristine_path = self._path('portfolio.pristine.json')
+        shutil.copyfile(self.json_path, self.pristine_path)
+        messy = portfolio_of_size(size, **{**spec_fields, 'messy_dates': 0.5})
+        self.messy_path = self._path('portfolio.messy.json')
+        write_portfolio_json(self.messy_path, messy)
+        imported = portfolio_of_size(max(1, int(size * CSV_IMPORT_SHARE)),
+                                     **{**spec_fields, 'lot_prefix': 'NEW-', 'seed': spec_fields.get('seed', 1) + 1})
+        self.csv_path = self._path('new_transactions.csv')
+        write_transactions_csv(self.csv_path, imported)
+        self.client = webapp.app.test_client()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.workdir, name)
+
+    def _restore_portfolio(self):
+        shutil.copyfile(self.pristine_path, self.json_path)
+        for sidecar in (self.json_path + '.lots.json',):
+            if os.path.exists(sidecar):
+                os.remove(sidecar)
+
+    def _post(self, path: str, **kwargs):
+        response = self.client.post(path, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}")
+        response.get_data()
+
+    @staticmethod
+    def _clear_response_cache():
+        webapp.response_cache = webapp.ResponseCache(webapp.response_cache.max_bytes)
+
+    # --- Benchmarks: each returns the list of run times ---
+    def bench_load_portfolio(self):
+        return measure(lambda: main.load_portfolio(self.json_path), self.repeats)
+
+    def bench_save_portfolio(self):
+        path = self._path('saved.json')
+        return measure(lambda: main.save_portfolio(path, self.portfolio), self.repeats)
+
+    def bench_append_csv_to_json(self):
+        converter.CSV_INPUT_FILE = self.csv_path
+        converter.PORTFOLIO_JSON_FILE = self.json_path
+        converter.REJECTION_REPORT_FILE = self._path('import_rejections.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            return measure(converter.append_csv_to_json, self.repeats, setup=self._restore_portfolio)
+
+    def bench_fix_date_formats(self):
+        fix_dates.PORTFOLIO_JSON_FILE = self._path('portfolio.fix.json')
+        fix_dates.BACKUP_FILE_PATH = self._path('portfolio.fix.backup.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            return measure(fix_dates.fix_date_formats, self.repeats,
+                           setup=lambda: shutil.copyfile(self.messy_path, fix_dates.PORTFOLIO_JSON_FILE))
+
+    def bench_analyze_python(self):
+        return measure(lambda: analyze_portfolio_by_lot(self.portfolio, backend='python'), self.repeats)
+
+    def bench_analyze_numpy(self):
+        if not portfolio_columnar.is_available():
+            return None
+        return measure(lambda: analyze_portfolio_by_lot(self.portfolio, backend='numpy'), self.repeats)
+
+    def bench_analyze_parallel(self):
+        if portfolio_parallel.PARALLEL_ANALYSIS_WORKERS <= 1:
+            return None
+        return measure(lambda: portfolio_parallel.analyze_parallel(self.portfolio, min_transactions=0), self.repeats)
+
+    def bench_route_analyze(self):
+        post = lambda: self._post('/analyze', data={'portfolio_file': (io.BytesIO(self.body), 'portfolio.json')})
+        return measure(post, self.repeats, setup=self._clear_response_cache)
+
+    def bench_route_analyze_cached(self):
+        post = lambda: self._post('/analyze', data={'portfolio_file': (io.BytesIO(self.body), 'portfolio.json')})
+        post()
+        return measure(post, self.repeats)
+
+    def bench_route_analyze_ndjson(self):
+        post = lambda: self._post('/analyze?format=ndjson',
+                                  data={'portfolio_file': (io.BytesIO(self.body), 'portfolio.json')})
+        return measure(post, self.repeats, setup=self._clear_response_cache)
+
+    def bench_route_close_year(self):
+        post = lambda: self._post('/close_year', data=self.body, content_type='application/json')
+        return measure(post, self.repeats, setup=self._clear_response_cache)
+
+    def transaction_memory(self) -> int:
+        """Bytes allocated to hold the portfolio as StockTransaction objects."""
+        tracemalloc.start()
+        portfolio = [StockTransaction(**tx) for tx in self.transactions]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del portfolio
+        return size
+
+
+BENCHMARKS = [name[len('bench_'):] for name in vars(BenchmarkRun) if name.startswith('bench_')]
+
+
+def run_benchmarks(sizes: List[int], repeats: int, only: Optional[List[str]] = None, spec_fields: Optional[dict] = None) -> dict:
+    """Runs the benchmarks for every size and returns the results document."""
+    spec_fields = spec_fields or {}
+    selected = [name for name in BENCHMARKS if not only or any(part in name for part in only)]
+    results = []
+    for size in sizes:
+        with tempfile.TemporaryDirectory(prefix='portfolio-bench-') as workdir:
+            run = BenchmarkRun(size, repeats, workdir, spec_fields)
+            print(f"\n{run.size:,} transactions (requested {size:,})")
+            for name in selected:
+                times = getattr(run, 'bench_' + name)()
+                if times is None:
+                    print(f"  {name:<28} skipped")
+                    continue
+                best, median = min(times), statistics.median(times)
+                results.append({
+                    "benchmark": name,
+                    "size": size,
+                    "transactions": run.size,
+                    "repeats": len(times),
+                    "best_seconds": best,
+                    "median_seconds": median,
+                    "microseconds_per_transaction": best / run.size * 1e6,
+                })
+                print(f"  {name:<28} best {best * 1000:9.1f} ms   median {median * 1000:9.1f} ms")
+            memory = run.transaction_memory()
+            results.append({"benchmark": "transaction_memory", "size": size, "transactions": run.size,
+                            "bytes": memory, "bytes_per_transaction": memory / run.size})
+            print(f"  {'transaction_memory':<28} {memory / run.size:9.0f} bytes per transaction")
+    return {
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": _git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": portfolio_columnar.is_available(),
+        "repeats": repeats,
+        "spec": spec_fields,
+        "results": results,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip() or None
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: dict, previous: dict, factor: float = REGRESSION_FACTOR) -> List[dict]:
+    """Prints current vs. previous best times and returns the benchmarks that got slower by more than `factor`."""
+    before: Dict[tuple, dict] = {(r["benchmark"], r["size"]): r for r in previous.get("results", [])}
+    regressions = []
+    print(f"\nCompared with {previous.get('created')} ({previous.get('git_commit') or 'unknown commit'}):")
+    for result in current["results"]:
+        old = before.get((result["benchmark"], result["size"]))
+        key = "best_seconds" if "best_seconds" in result else "bytes"
+        if old is None or not old.get(key):
+            continue
+        ratio = result[key] / old[key]
+        flag = ''
+        if ratio > factor:
+            flag = '  <-- slower' if key == "best_seconds" else '  <-- larger'
+            regressions.append({**result, "previous": old[key], "ratio": ratio})
+        print(f"  {result['benchmark']:<28} {result['size']:>9,}  x{ratio:5.2f}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the portfolio tools on synthetic data.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="approximate transaction counts")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--only', nargs='+', help=f"run benchmarks whose name contains any of these ({', '.join(BENCHMARKS)})")
+    parser.add_argument('--symbols', type=int, default=20)
+    parser.add_argument('--output', default='benchmark_results.json', help="where to save the results")
+    parser.add_argument('--compare', help="an earlier results file to compare with")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+    current = run_benchmarks(args.sizes, args.repeats, args.only, {'symbols': args.symbols})
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(current, f, indent=2)
+    print(f"\nResults saved to '{args.output}'.")
+    if previous is not None and compare(current, previous):
+        sys.exit(1)
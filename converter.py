@@ -1,133 +1,310 @@
+import argparse
 import csv
+import glob
 import json
 import os
-from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Optional, Set
+
+from portfolio_lib import StockTransaction, normalize_date
+from portfolio_store import SqlitePortfolioStore, is_sqlite_path
 
 # --- Configuration ---
 # The CSV file should contain ONLY THE NEW transactions you want to add.
 CSV_INPUT_FILE = 'new_transactions.csv'
 # This is your main portfolio file. The script will add new data to it.
+# It can also be a SQLite database (e.g. 'portfolio.db', see portfolio_store.py).
 PORTFOLIO_JSON_FILE = 'portfolio.json'
+# Rows that could not be imported are listed here instead of being printed one by one.
+REJECTION_REPORT_FILE = 'import_rejections.json'
 
-def append_csv_to_json():
+def convert_row(row: Dict[str, str]) -> Dict:
     """
-    Reads new transactions from a CSV file and appends them to an existing
-    portfolio.json file. If portfolio.json doesn't exist, it will be created.
+    Converts one CSV row into a transaction dict in the portfolio.json format.
+    Raises ValueError (or TypeError) if the row cannot be converted.
     """
-    # 1. Check if the CSV input file exists
-    if not os.path.exists(CSV_INPUT_FILE):
-        print(f"Error: Input file '{CSV_INPUT_FILE}' not found.")
-        print("Please create a CSV with your new transactions and name it 'new_transactions.csv'.")
-        return
+    tx_type = row.get('Type', '').upper().strip()
 
-    # 2. Load existing portfolio data from the main JSON file
-    existing_transactions: List[Dict] = []
-    if os.path.exists(PORTFOLIO_JSON_FILE):
-        try:
-            with open(PORTFOLIO_JSON_FILE, 'r', encoding='utf-8') as f:
-                existing_transactions = json.load(f)
-            print(f"Loaded {len(existing_transactions)} existing transactions from '{PORTFOLIO_JSON_FILE}'.")
-        except json.JSONDecodeError:
-            print(f"Warning: '{PORTFOLIO_JSON_FILE}' is corrupted or empty. Starting with a new list.")
-            existing_transactions = []
-    else:
-        print(f"'{PORTFOLIO_JSON_FILE}' not found. A new file will be created.")
+    # Basic validation
+    if not tx_type or not row.get('Date') or not row.get('Symbol'):
+        raise ValueError("Missing required fields (Type, Date, Symbol)")
 
-    # Create a set of existing lot numbers for quick duplicate checking
-    existing_lot_numbers = {
-        tx.get('mylotnumber')
-        for tx in existing_transactions
-        if tx.get('mylotnumber')
+    transaction = {
+        "symbol": row.get('Symbol', '').upper().strip(),
+        "date": normalize_date(row.get('Date', '').strip()),
+        "type": tx_type,
+        "volume": 0,
+        "price_per_unit": 0.0,
+        "commission": 0.0,
+        "mylotnumber": None,
+        "closes_lot_number": None,
+        "total_amount": None, # Will be calculated by the app
+        "remark": row.get('Remark', '').strip() or None,
+        "tax_rate": None,
+        "realized_pl": None,
+        "cumulative_pl_for_symbol": None
     }
 
-    # 3. Read and convert new transactions from the CSV file
-    newly_converted_transactions: List[Dict] = []
+    if tx_type in ['BUY', 'SELL']:
+        transaction['volume'] = int(row.get('Volume', 0))
+        transaction['price_per_unit'] = float(row.get('Price per Share', 0.0))
+        transaction['commission'] = float(row.get('Commission', 0.0))
+    elif tx_type == 'DIVIDEND':
+        div_per_share = float(row.get('Price per Share', 0.0))
+        volume = int(row.get('Volume', 0))
+        tax_rate = float(row.get('Tax Rate (%)', 10.0))
+
+        gross_amount = div_per_share * volume
+        net_amount = gross_amount * (1 - (tax_rate / 100))
+
+        transaction['volume'] = volume
+        transaction['price_per_unit'] = div_per_share
+        transaction['tax_rate'] = tax_rate
+        transaction['total_amount'] = round(net_amount, 2)
+    elif tx_type == 'CASH_RETURN':
+        return_per_share = float(row.get('Price per Share', 0.0))
+        volume = int(row.get('Volume', 0))
+
+        total_return = return_per_share * volume
+
+        transaction['volume'] = volume
+        transaction['price_per_unit'] = return_per_share
+        transaction['total_amount'] = round(total_return, 2)
+
+    # Handle Lot Number logic
+    lot_number = row.get('Lot Number', '').strip()
+    if tx_type == 'BUY':
+        transaction['mylotnumber'] = lot_number
+    elif tx_type in ['SELL', 'DIVIDEND', 'CASH_RETURN']:
+        transaction['closes_lot_number'] = lot_number
+
+    return transaction
+
+def parse_csv_file(csv_path: str) -> Dict:
+    """
+    Parses and validates one CSV file. Runs in a worker process, so it only
+    returns plain data: the converted rows and the rejected ones.
+    """
+    accepted: List[Dict] = []
+    rejected: List[Dict] = []
     try:
-        with open(CSV_INPUT_FILE, mode='r', encoding='utf-8') as csv_file:
+        with open(csv_path, mode='r', encoding='utf-8') as csv_file:
             # DictReader uses the first row as headers
-            csv_reader = csv.DictReader(csv_file)
-            
-            print("Starting conversion...")
-            for index, row in enumerate(csv_reader):
+            for index, row in enumerate(csv.DictReader(csv_file)):
                 try:
-                    tx_type = row.get('Type', '').upper().strip()
-                    
-                    # Basic validation
-                    if not tx_type or not row.get('Date') or not row.get('Symbol'):
-                        print(f"Warning: Skipping row {index + 2} due to missing required fields (Type, Date, Symbol).")
+                    accepted.append({"row": index + 2, "transaction": convert_row(row)})
+                except (ValueError, TypeError) as e:
+                    rejected.append({"file": csv_path, "row": index + 2, "reason": f"Invalid data format: {e}"})
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        rejected.append({"file": csv_path, "row": None, "reason": f"Could not read file: {e}"})
+    return {"file": csv_path, "accepted": accepted, "rejected": rejected}
+
+def expand_csv_paths(paths: List[str]) -> List[str]:
+    """Expands directories into the CSV files they contain, keeping the given order."""
+    csv_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            csv_paths.extend(sorted(glob.glob(os.path.join(path, '*.csv'))))
+        else:
+            csv_paths.append(path)
+    return csv_paths
+
+# --- Persistent lot number index (JSON portfolios) ---
+class LotNumberIndex:
+    """
+    The set of lot numbers already in a portfolio.json, kept in a small sidecar
+    file so imports do not have to re-read the portfolio. The index remembers
+    the size and modification time of the portfolio it describes and is rebuilt
+    automatically if the portfolio was changed by anything else.
+    """
+
+    def __init__(self, portfolio_path: str):
+        self.portfolio_path = portfolio_path
+        self.path = portfolio_path + '.lots.json'
+        self.lot_numbers: Set[str] = set()
+
+    def _portfolio_signature(self) -> Optional[List[int]]:
+        try:
+            stat = os.stat(self.portfolio_path)
+        except FileNotFoundError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def load(self) -> Set[str]:
+        signature = self._portfolio_signature()
+        if signature is None:
+            self.lot_numbers = set()
+            return self.lot_numbers
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('portfolio_signature') == signature:
+                self.lot_numbers = set(saved['lot_numbers'])
+                return self.lot_numbers
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        self.rebuild()
+        return self.lot_numbers
+
+    def rebuild(self):
+        """Re-reads the portfolio once to rebuild a missing or stale index."""
+        try:
+            with open(self.portfolio_path, 'r', encoding='utf-8') as f:
+                transactions = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            transactions = []
+        self.lot_numbers = {tx.get('mylotnumber') for tx in transactions if tx.get('mylotnumber')}
+        self.save()
+
+    def save(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "portfolio_signature": self._portfolio_signature(),
+                "lot_numbers": sorted(self.lot_numbers),
+            }, f, ensure_ascii=False)
+
+def _format_json_item(item: Dict) -> str:
+    """Formats one transaction exactly as json.dump(..., indent=2) does inside the top-level array."""
+    return '\n'.join('  ' + line for line in json.dumps(item, indent=2, ensure_ascii=False).split('\n'))
+
+def append_to_portfolio_json(portfolio_path: str, transactions: List[Dict]):
+    """
+    Appends transactions to portfolio.json in place: only the closing bracket is
+    rewritten, and the result is identical to dumping the whole list with indent=2.
+    """
+    if not transactions:
+        return
+    if not os.path.exists(portfolio_path) or os.path.getsize(portfolio_path) == 0:
+        with open(portfolio_path, 'w', encoding='utf-8') as f:
+            json.dump(transactions, f, indent=2, ensure_ascii=False)
+        return
+
+    with open(portfolio_path, 'r+b') as f:
+        # Walk back over trailing whitespace to the closing bracket
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            f.seek(end - 1)
+            char = f.read(1)
+            if char not in b' \t\r\n':
+                break
+            end -= 1
+        if char != b']':
+            raise ValueError(f"'{portfolio_path}' does not end with a JSON array")
+        bracket = end - 1
+
+        # Is the array empty? Look for the last significant character before ']'
+        pos = bracket
+        while pos > 0:
+            f.seek(pos - 1)
+            char = f.read(1)
+            if char not in b' \t\r\n':
+                break
+            pos -= 1
+        is_empty = char == b'['
+
+        new_items = ',\n'.join(_format_json_item(tx) for tx in transactions)
+        f.seek(pos)
+        f.write((('\n' if is_empty else ',\n') + new_items + '\n]').encode('utf-8'))
+        f.truncate()
+
+def import_csv_files(csv_paths: List[str], portfolio_path: str = PORTFOLIO_JSON_FILE,
+                     report_path: Optional[str] = REJECTION_REPORT_FILE, workers: Optional[int] = None) -> Dict:
+    """
+    Imports any number of broker CSV exports in one batch. Files are parsed and
+    validated in a process pool, BUY lots are checked for duplicates against the
+    persisted lot number index, and all accepted rows are committed in a single
+    append. Rejected rows are written to a JSON report. Returns the report.
+    """
+    csv_paths = expand_csv_paths(csv_paths)
+
+    # 1. Parse and validate all files (in parallel when there is more than one)
+    if len(csv_paths) > 1 and workers != 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parsed_files = list(pool.map(parse_csv_file, csv_paths))
+    else:
+        parsed_files = [parse_csv_file(path) for path in csv_paths]
+
+    # 2. Duplicate check against existing lots (and earlier rows of this batch)
+    store = SqlitePortfolioStore(portfolio_path) if is_sqlite_path(portfolio_path) else None
+    lot_index = None
+    try:
+        if store is not None:
+            existing_lot_numbers = store.lot_numbers()
+        else:
+            lot_index = LotNumberIndex(portfolio_path)
+            existing_lot_numbers = lot_index.load()
+
+        accepted: List[Dict] = []
+        rejected: List[Dict] = []
+        for parsed in parsed_files:
+            rejected.extend(parsed['rejected'])
+            for item in parsed['accepted']:
+                transaction = item['transaction']
+                lot_number = transaction['mylotnumber']
+                if transaction['type'] == 'BUY' and lot_number:
+                    if lot_number in existing_lot_numbers:
+                        rejected.append({"file": parsed['file'], "row": item['row'], "lot_number": lot_number,
+                                         "reason": "Lot number already exists in the portfolio"})
                         continue
+                    existing_lot_numbers.add(lot_number)
+                accepted.append(transaction)
 
-                    transaction = {
-                        "symbol": row.get('Symbol', '').upper().strip(),
-                        "date": row.get('Date', '').strip(),
-                        "type": tx_type,
-                        "volume": 0,
-                        "price_per_unit": 0.0,
-                        "commission": 0.0,
-                        "mylotnumber": None,
-                        "closes_lot_number": None,
-                        "total_amount": None, # Will be calculated by the app
-                        "remark": row.get('Remark', '').strip() or None,
-                        "tax_rate": None,
-                        "realized_pl": None,
-                        "cumulative_pl_for_symbol": None
-                    }
-
-                    if tx_type in ['BUY', 'SELL']:
-                        transaction['volume'] = int(row.get('Volume', 0))
-                        transaction['price_per_unit'] = float(row.get('Price per Share', 0.0))
-                        transaction['commission'] = float(row.get('Commission', 0.0))
-                    elif tx_type == 'DIVIDEND':
-                        div_per_share = float(row.get('Price per Share', 0.0))
-                        volume = int(row.get('Volume', 0))
-                        tax_rate = float(row.get('Tax Rate (%)', 10.0))
-                        
-                        gross_amount = div_per_share * volume
-                        net_amount = gross_amount * (1 - (tax_rate / 100))
-
-                        transaction['volume'] = volume
-                        transaction['price_per_unit'] = div_per_share
-                        transaction['tax_rate'] = tax_rate
-                        transaction['total_amount'] = round(net_amount, 2)
-                    elif tx_type == 'CASH_RETURN':
-                        return_per_share = float(row.get('Price per Share', 0.0))
-                        volume = int(row.get('Volume', 0))
-                        
-                        total_return = return_per_share * volume
-                        
-                        transaction['volume'] = volume
-                        transaction['price_per_unit'] = return_per_share
-                        transaction['total_amount'] = round(total_return, 2)
-
-                    # Handle Lot Number logic
-                    lot_number = row.get('Lot Number', '').strip()
-                    if tx_type == 'BUY':
-                        # --- DUPLICATE CHECK ---
-                        if lot_number in existing_lot_numbers:
-                            print(f"Info: Skipping row {index + 2}. Lot Number '{lot_number}' already exists in the portfolio.")
-                            continue
-                        # --- END DUPLICATE CHECK ---
-                        transaction['mylotnumber'] = lot_number
-                    elif tx_type in ['SELL', 'DIVIDEND', 'CASH_RETURN']:
-                        transaction['closes_lot_number'] = lot_number
-
-                    newly_converted_transactions.append(transaction)
+        # 3. Commit everything in one append
+        if store is not None:
+            store.append_many(StockTransaction(**tx) for tx in accepted)
+        elif accepted:
+            append_to_portfolio_json(portfolio_path, accepted)
+            lot_index.save()
+    finally:
+        if store is not None:
+            store.close()
 
-                except (ValueError, TypeError) as e:
-                    print(f"Warning: Could not process row {index + 2}. Invalid data format. Error: {e}")
-                    continue
-
-        # 4. Combine old and new transactions and save back to the main portfolio file
-        all_transactions = existing_transactions + newly_converted_transactions
-        with open(PORTFOLIO_JSON_FILE, 'w', encoding='utf-8') as json_file:
-            json.dump(all_transactions, json_file, indent=2, ensure_ascii=False)
-        
-        print(f"\nSuccess! Conversion complete.")
-        print(f"Added {len(newly_converted_transactions)} new transactions.")
-        print(f"'{PORTFOLIO_JSON_FILE}' now contains a total of {len(all_transactions)} transactions.")
+    report = {
+        "portfolio": portfolio_path,
+        "files": csv_paths,
+        "accepted": len(accepted),
+        "rejected": rejected,
+    }
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    return report
+
+def append_csv_to_json():
+    """
+    Reads new transactions from a CSV file and appends them to an existing
+    portfolio.json file. If portfolio.json doesn't exist, it will be created.
+    """
+    # 1. Check if the CSV input file exists
+    if not os.path.exists(CSV_INPUT_FILE):
+        print(f"Error: Input file '{CSV_INPUT_FILE}' not found.")
+        print("Please create a CSV with your new transactions and name it 'new_transactions.csv'.")
+        return
 
+    try:
+        report = import_csv_files([CSV_INPUT_FILE], PORTFOLIO_JSON_FILE, REJECTION_REPORT_FILE)
+        print_summary(report, REJECTION_REPORT_FILE)
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
 
+def print_summary(report: Dict, report_path: Optional[str]):
+    print(f"Success! Conversion complete.")
+    print(f"Added {report['accepted']} new transactions to '{report['portfolio']}' from {len(report['files'])} file(s).")
+    if report['rejected']:
+        print(f"Skipped {len(report['rejected'])} row(s); see '{report_path}' for the reasons.")
+
 if __name__ == "__main__":
-    append_csv_to_json()
+    parser = argparse.ArgumentParser(description="Import broker CSV exports into the portfolio.")
+    parser.add_argument('paths', nargs='*', default=[CSV_INPUT_FILE],
+                        help=f"CSV files or directories of CSV files (default: {CSV_INPUT_FILE})")
+    parser.add_argument('--portfolio', default=PORTFOLIO_JSON_FILE,
+                        help="portfolio.json or a SQLite database (.db) to append to")
+    parser.add_argument('--report', default=REJECTION_REPORT_FILE, help="where to write the rejected rows as JSON")
+    parser.add_argument('--workers', type=int, default=None, help="number of parser processes")
+    args = parser.parse_args()
+
+    missing = [path for path in args.paths if not os.path.exists(path)]
+    if missing:
+        print(f"Error: Input file(s) not found: {', '.join(missing)}")
+    else:
+        print_summary(import_csv_files(args.paths, args.portfolio, args.report, args.workers), args.report)
@@ -1,21 +1,15 @@
 import json
 import os
-from datetime import datetime
+
+from portfolio_lib import date_normalizer
 
 # --- Configuration ---
 PORTFOLIO_JSON_FILE = 'portfolio.json'
 BACKUP_FILE_PATH = 'portfolio.backup.json'
 
-# List of possible incorrect date formats (Day-Month-Year)
-# Add more formats here if needed, e.g., '%d.%m.%Y'
-INCORRECT_FORMATS = [
-    '%d/%m/%Y',  # e.g., 21/11/2018
-    '%d-%m-%Y',  # e.g., 21-11-2018
-    '%d/%m/%y',  # e.g., 21/11/18
-    '%d-%m-%y',  # e.g., 21-11-18
-    '%d %b %Y',  # e.g., 21 Mar 2019
-]
-CORRECT_FORMAT = '%Y-%m-%d'
+# The formats that can be fixed are listed in portfolio_lib.DATE_FORMATS.
+# Dates are normalized with the same DateNormalizer that the app uses when it
+# loads data, so fixing the file here only saves that work permanently.
 
 def fix_date_formats():
     """
@@ -45,29 +39,8 @@ def fix_date_formats():
         print(f"Error: Could not read '{PORTFOLIO_JSON_FILE}'. It might be corrupted.")
         return
 
-    # 4. Iterate and fix dates
-    records_fixed = 0
-    for index, tx in enumerate(transactions):
-        date_str = tx.get('date')
-        if not date_str:
-            continue
-
-        try:
-            datetime.strptime(date_str, CORRECT_FORMAT)
-            continue
-        except ValueError:
-            pass
-
-        for fmt in INCORRECT_FORMATS:
-            try:
-                dt_object = datetime.strptime(date_str, fmt)
-                correct_date_str = dt_object.strftime(CORRECT_FORMAT)
-                tx['date'] = correct_date_str
-                print(f"Fixed record {index + 1}: Changed date from '{date_str}' to '{correct_date_str}'")
-                records_fixed += 1
-                break
-            except ValueError:
-                continue
+    # 4. Fix all dates in one bulk pass (each distinct date string is parsed only once)
+    records_fixed = date_normalizer.normalize_records(transactions)
 
     # 5. Save the corrected data back to the file
     if records_fixed > 0:
@@ -78,4 +51,4 @@ def fix_date_formats():
         print("\nNo records needed fixing. All dates appear to be in the correct format.")
 
 if __name__ == "__main__":
-    fix_date_formats()
\ No newline at end of file
+    fix_date_formats()
@@ -1,36 +1,156 @@
+import argparse
 import json
+import os
+import time
 from dataclasses import asdict
 from typing import List
 
 # --- นำเข้าฟังก์ชันและคลาสจากไลบรารีกลางของเรา ---
-from portfolio_lib import StockTransaction, analyze_portfolio_by_lot
+from portfolio_lib import (
+    StockTransaction, OpenLot, ClosedTrade, analyze_portfolio_by_lot, LOT_POLICIES, DEFAULT_LOT_POLICY,
+    PortfolioFormatError, require_known_date,
+)
+from portfolio_store import SqlitePortfolioStore, is_sqlite_path
+from portfolio_rollups import RollupAnalyzer, ROLLUP_GROUPINGS
 
 def load_portfolio(filepath: str) -> List[StockTransaction]:
     """
-    Loads portfolio data from a JSON file.
-    Returns an empty list if the file doesn't exist or is empty.
+    Loads portfolio data from a JSON file or a SQLite database (.db/.sqlite).
+    Returns an empty list if the file doesn't exist or is empty, and raises
+    PortfolioFormatError if a transaction's date is in none of the known formats.
     """
+    if is_sqlite_path(filepath):
+        if not os.path.exists(filepath):
+            return []
+        with SqlitePortfolioStore(filepath) as store:
+            portfolio = store.load_all()
+    else:
+        try:
+            with open(filepath, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            # If file not found or is empty/corrupt, start with an empty portfolio
+            return []
+        portfolio = [StockTransaction(**item) for item in data]
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return [StockTransaction(**item) for item in data]
-    except (FileNotFoundError, json.JSONDecodeError):
-        # If file not found or is empty/corrupt, start with an empty portfolio
-        return []
+        for number, tx in enumerate(portfolio, 1):
+            require_known_date(tx, number)
+    except PortfolioFormatError as e:
+        raise PortfolioFormatError(f"{filepath}: {e}") from None
+    return portfolio
 
 def save_portfolio(filepath: str, portfolio: List[StockTransaction]):
-    """Saves the entire portfolio to a JSON file."""
+    """
+    Saves the entire portfolio to a JSON file or a SQLite database (.db/.sqlite).
+    To add or edit single transactions in a database, use SqlitePortfolioStore directly.
+    """
+    if is_sqlite_path(filepath):
+        with SqlitePortfolioStore(filepath) as store:
+            store.replace_all(portfolio)
+        return
     with open(filepath, 'w', encoding='utf-8') as f:
         # Convert list of dataclass objects to list of dictionaries for JSON serialization
         data_to_save = [asdict(transaction) for transaction in portfolio]
         json.dump(data_to_save, f, indent=2, ensure_ascii=False)
 
+def print_totals(total_investment: float, total_realized_pl: float, total_dividends: float):
+    print(f"Total investment cost (all BUYs): {total_investment:,.2f} THB")
+    print(f"Total realized P/L: {total_realized_pl:,.2f} THB")
+    print(f"Total dividends received: {total_dividends:,.2f} THB")
+
+def print_open_lots(open_lots: List[OpenLot]):
+    for lot in open_lots:
+        print(f"  Lot {lot.lot_number}: {lot.symbol} - {lot.remaining_volume}/{lot.original_volume} shares @ {lot.buy_price:,.2f} THB | Dividends: {lot.dividends_received:,.2f} THB")
+
+def print_closed_trades(closed_trades: List[ClosedTrade]):
+    for trade in closed_trades:
+        print(f"  Sold {trade.symbol} (Lot): Realized P/L: {trade.realized_pl:,.2f} THB | Cumulative P/L: {trade.cumulative_pl_for_symbol:,.2f} THB")
+
+def print_report(rows: List[dict], fields: tuple):
+    for row in rows:
+        label = ' '.join('undated' if row[field] is None else str(row[field]) for field in fields) or 'All'
+        print(f"  {label}: Invested: {row['invested_capital']:,.2f} | Realized P/L: {row['realized_pl']:,.2f} | "
+              f"Dividends: {row['dividends_gross']:,.2f} gross, {row['dividend_tax_withheld']:,.2f} tax, "
+              f"{row['dividends_net']:,.2f} net | Cash returns: {row['cash_returns']:,.2f} THB")
+
+def watch_portfolio(portfolio_file: str, drop_dir: str = None, interval: float = 1.0,
+                    publish_path: str = None, use_inotify: bool = True, lot_policy: str = DEFAULT_LOT_POLICY):
+    """
+    Keeps the analysis in memory and prints the totals and the holdings of the
+    symbols that changed every time the portfolio (or the drop folder) changes.
+    With `publish_path`, the full analysis is also written there as JSON (the
+    same data as /analyze) after every change.
+    """
+    from portfolio_watch import PortfolioWatcher, inotify_available
+    from portfolio_batch import build_analysis_response
+
+    watcher = PortfolioWatcher(portfolio_file, drop_dir=drop_dir, interval=interval, lot_policy=lot_policy)
+
+    def on_update(update):
+        started = time.perf_counter()
+        analysis = watcher.analyzer.analyze()
+        analysis_seconds = time.perf_counter() - started
+        parts = []
+        if update.imported_files:
+            parts.append(f"imported {', '.join(update.imported_files)}")
+            if update.rejected_rows:
+                parts.append(f"{update.rejected_rows} row(s) rejected")
+        if update.appended:
+            parts.append(f"+{update.appended} transaction(s)")
+        if update.changed:
+            parts.append(f"{update.changed} transaction(s) changed")
+        print(f"\n[{time.strftime('%H:%M:%S')}] {portfolio_file}: {', '.join(parts) or 'no changes'} "
+              f"({len(watcher.analyzer)} in total; read in {update.seconds * 1000:.1f} ms, "
+              f"analyzed in {analysis_seconds * 1000:.1f} ms)")
+        print_totals(*analysis[2:])
+        changed_lots = [lot for lot in analysis[0] if lot.symbol in update.symbols]
+        if changed_lots:
+            print(f"--- Holdings of {', '.join(sorted({lot.symbol for lot in changed_lots}))} ---")
+            print_open_lots(changed_lots)
+        if publish_path:
+            temp_path = publish_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(build_analysis_response(analysis, len(watcher.analyzer)), f, ensure_ascii=False)
+            os.replace(temp_path, publish_path)
+
+    mode = "inotify" if use_inotify and inotify_available() else f"polling every {interval:g}s"
+    print(f"Watching '{portfolio_file}'" + (f" and '{drop_dir}'" if drop_dir else '') + f" ({mode}). Press Ctrl+C to stop.")
+    try:
+        watcher.run(on_update, use_inotify=use_inotify)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze the portfolio, once or continuously.")
+    parser.add_argument('portfolio', nargs='?', default='portfolio.json', help="portfolio.json or a SQLite database (.db)")
+    parser.add_argument('--backend', choices=['auto', 'python', 'numpy', 'parallel'], default='auto',
+                        help="analysis engine; 'parallel' splits a large portfolio by symbol across CPU cores")
+    parser.add_argument('--lot-policy', choices=LOT_POLICIES, default=DEFAULT_LOT_POLICY,
+                        help="how SELLs without a lot number are matched: specific (ignored, the default), "
+                             "fifo, lifo, hifo (highest buy price first) or average (average cost)")
+    parser.add_argument('--report', choices=list(ROLLUP_GROUPINGS),
+                        help="also print invested capital, realized P/L, dividends and cash returns by this grouping")
+    parser.add_argument('--watch', action='store_true', help="keep running and update the analysis when the portfolio changes")
+    parser.add_argument('--drop-dir', help="with --watch: import CSV files placed in this folder")
+    parser.add_argument('--interval', type=float, default=1.0, help="with --watch: seconds between checks (default: 1)")
+    parser.add_argument('--publish', help="with --watch: write the analysis to this JSON file after every change")
+    parser.add_argument('--no-inotify', action='store_true', help="with --watch: poll even when inotify is available")
+    args = parser.parse_args()
+    if args.backend == 'numpy' and args.lot_policy != DEFAULT_LOT_POLICY:
+        parser.error("the numpy backend only supports --lot-policy specific")
+
     # Define the path to our data file
-    portfolio_file = 'portfolio.json'
+    portfolio_file = args.portfolio
+
+    if args.watch:
+        watch_portfolio(portfolio_file, args.drop_dir, args.interval, args.publish, not args.no_inotify, args.lot_policy)
+        raise SystemExit(0)
 
     # 1. Load existing data from the file
-    my_portfolio = load_portfolio(portfolio_file)
+    try:
+        my_portfolio = load_portfolio(portfolio_file)
+    except PortfolioFormatError as e:
+        raise SystemExit(f"Error: {e}")
     print(f"Portfolio loaded. Found {len(my_portfolio)} transaction(s).")
 
     # --- ข้อควรระวัง ---
@@ -48,17 +168,18 @@ if __name__ == "__main__":
     """
 
     # 4. วิเคราะห์ข้อมูลจากพอร์ตของเราด้วยฟังก์ชันใหม่
-    open_lots, closed_trades, total_investment, total_realized_pl, total_dividends = analyze_portfolio_by_lot(my_portfolio)
+    open_lots, closed_trades, total_investment, total_realized_pl, total_dividends = analyze_portfolio_by_lot(my_portfolio, backend=args.backend, lot_policy=args.lot_policy)
 
     print(f"\n--- Portfolio Analysis ---")
-    print(f"Total investment cost (all BUYs): {total_investment:,.2f} THB")
-    print(f"Total realized P/L: {total_realized_pl:,.2f} THB")
-    print(f"Total dividends received: {total_dividends:,.2f} THB")
+    print_totals(total_investment, total_realized_pl, total_dividends)
 
     print("\n--- Current Holdings (Open Lots) ---")
-    for lot in open_lots:
-        print(f"  Lot {lot.lot_number}: {lot.symbol} - {lot.remaining_volume}/{lot.original_volume} shares @ {lot.buy_price:,.2f} THB | Dividends: {lot.dividends_received:,.2f} THB")
+    print_open_lots(open_lots)
 
     print("\n--- Closed Trades (Realized P/L) ---")
-    for trade in closed_trades:
-        print(f"  Sold {trade.symbol} (Lot): Realized P/L: {trade.realized_pl:,.2f} THB | Cumulative P/L: {trade.cumulative_pl_for_symbol:,.2f} THB")
\ No newline at end of file
+    print_closed_trades(closed_trades)
+
+    if args.report:
+        grouping = '' if args.report == 'total' else f" by {args.report.replace('_', ' and ')}"
+        print(f"\n--- Totals{grouping} ---")
+        print_report(RollupAnalyzer(my_portfolio, args.lot_policy).report(args.report), ROLLUP_GROUPINGS[args.report])
@@ -0,0 +1,401 @@
+"""
+Optional request metrics for the web app, served in the Prometheus text format.
+
+Turned on with METRICS_ENABLED=1. Each worker process keeps its own counters
+and histograms and writes them to METRICS_DIR/metrics-<pid>.json every
+METRICS_FLUSH_SECONDS (from a background thread, so idle workers stay current)
+and when it exits. /metrics adds up the files of every running worker, so any
+gunicorn worker can answer a scrape. The file of a worker that has exited is
+folded into METRICS_DIR/metrics-retired.json before it is removed, so counters
+and histograms never go down when workers are replaced (gauges of exited
+workers are dropped). When metrics are off nothing is installed: no request
+hooks, no analysis phase hook, and the helpers below return immediately.
+
+Configuration (environment variables):
+    METRICS_ENABLED        1 to collect metrics (default: off)
+    METRICS_DIR            folder shared by the workers (default: <tmp>/portfolio-metrics)
+    METRICS_FLUSH_SECONDS  how often a worker writes its file (default: 5)
+"""
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, Dict, List, Optional, Tuple
+
+import portfolio_lib
+
+try:
+    import fcntl  # Serializes folding between worker processes; not available on Windows
+except ImportError:
+    fcntl = None
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes', 'on')
+METRICS_DIR = os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'portfolio-metrics')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KB .. 256 MB
+COUNT_BUCKETS = (10, 100, 1_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000)
+
+_HELP = {
+    'portfolio_requests_total': ('counter', "Requests handled, by endpoint and status."),
+    'portfolio_request_errors_total': ('counter', "Requests that failed with an internal error, by endpoint and exception."),
+    'portfolio_request_duration_seconds': ('histogram', "Request latency by endpoint."),
+    'portfolio_phase_duration_seconds': ('histogram', "Time spent per request in each processing phase."),
+    'portfolio_upload_bytes': ('histogram', "Size of uploaded request bodies by endpoint."),
+    'portfolio_transactions': ('histogram', "Transactions per analyzed portfolio by endpoint."),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class MetricsRegistry:
+    """The counters and histograms of one process."""
+
+    def __init__(self):
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        # (name, labels) -> [bucket bounds, per-bucket counts (+ overflow), sum, count]
+        self.histograms: Dict[Tuple[str, Labels], list] = {}
+        self.collectors: List[Callable[[], List[Tuple[str, str, str, Labels, float]]]] = []
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, labels: Labels = (), value: float = 1):
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets: tuple, labels: Labels = ()):
+        with self._lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = [list(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+            histogram[1][bisect_left(buckets, value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def snapshot(self) -> dict:
+        """Plain-data copy for the worker's metrics file."""
+        with self._lock:
+            snapshot = {
+                "counters": [[name, labels, value] for (name, labels), value in self.counters.items()],
+                "histograms": [[name, labels, bounds, list(counts), total, count]
+                               for (name, labels), (bounds, counts, total, count) in self.histograms.items()],
+            }
+        # Collected values (e.g. cache counters) are written as they are now
+        snapshot["collected"] = [list(sample) for collect in self.collectors for sample in collect()]
+        return snapshot
+
+
+registry = MetricsRegistry()
+_request = threading.local()  # Phase times and details of the request being handled on this thread
+_last_flush = 0.0
+_flush_lock = threading.Lock()
+_flusher_pid: Optional[int] = None  # Process whose background flusher is running
+_fold_lock = threading.Lock()
+RETIRED_FILE = 'metrics-retired.json'
+
+
+# --- Recording ---
+def _record_phase(phase: str, seconds: float):
+    phases = getattr(_request, 'phases', None)
+    if phases is None:
+        # Outside a request (e.g. while an NDJSON response streams): one observation per call
+        registry.observe('portfolio_phase_duration_seconds', seconds, SECONDS_BUCKETS, (('phase', phase),))
+    else:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+
+class _Timed:
+    __slots__ = ('phase', 'started')
+
+    def __init__(self, phase: str):
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        _record_phase(self.phase, time.perf_counter() - self.started)
+
+
+_NOT_TIMED = nullcontext()
+
+
+def timed(phase: str):
+    """Context manager that adds the time spent in its block to a phase (a no-op when metrics are off)."""
+    return _Timed(phase) if METRICS_ENABLED else _NOT_TIMED
+
+
+def add_phase_time(phase: str, seconds: float):
+    """Adds already measured time to a phase."""
+    if METRICS_ENABLED:
+        _record_phase(phase, seconds)
+
+
+def note_transactions(count: int):
+    """Records how many transactions the current request analyzed."""
+    if METRICS_ENABLED:
+        _request.transactions = (getattr(_request, 'transactions', None) or 0) + count
+
+
+def note_error(e: BaseException):
+    """Records the exception behind an internal error response."""
+    if METRICS_ENABLED:
+        _request.error = type(e).__name__
+
+
+def start_request():
+    _start_flusher()
+    _request.started = time.perf_counter()
+    _request.phases = {}
+    _request.transactions = None
+    _request.error = None
+
+
+def end_request(endpoint: str, status: int, upload_bytes: Optional[int]):
+    """Turns what was noted during the request into observations."""
+    started = getattr(_request, 'started', None)
+    if started is None:
+        return
+    endpoint_label = (('endpoint', endpoint),)
+    registry.observe('portfolio_request_duration_seconds', time.perf_counter() - started, SECONDS_BUCKETS, endpoint_label)
+    registry.inc('portfolio_requests_total', (('endpoint', endpoint), ('status', str(status))))
+    if _request.error:
+        registry.inc('portfolio_request_errors_total', (('endpoint', endpoint), ('exception', _request.error)))
+    if upload_bytes:
+        registry.observe('portfolio_upload_bytes', upload_bytes, BYTES_BUCKETS, endpoint_label)
+    if _request.transactions is not None:
+        registry.observe('portfolio_transactions', _request.transactions, COUNT_BUCKETS, endpoint_label)
+    for phase, seconds in _request.phases.items():
+        registry.observe('portfolio_phase_duration_seconds', seconds, SECONDS_BUCKETS, (('phase', phase),))
+    _request.started = _request.phases = None
+    maybe_flush()
+
+
+# --- Sharing between workers ---
+def _metrics_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{pid}.json")
+
+
+def flush():
+    """Writes this worker's metrics file."""
+    global _last_flush
+    with _flush_lock:
+        _last_flush = time.monotonic()
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _metrics_path(os.getpid())
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(registry.snapshot(), f)
+        os.replace(temp_path, path)
+
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_SECONDS:
+        flush()
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_SECONDS)
+        try:
+            maybe_flush()
+        except OSError:
+            pass
+
+
+def _start_flusher():
+    """Starts this process's flush thread (threads do not survive a fork, so each worker starts its own)."""
+    global _flusher_pid
+    if _flusher_pid == os.getpid():
+        return
+    with _flush_lock:
+        if _flusher_pid != os.getpid():
+            _flusher_pid = os.getpid()
+            threading.Thread(target=_flush_periodically, name='metrics-flush', daemon=True).start()
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _read_snapshot(path: str) -> Optional[dict]:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _sample_key(name: str, labels) -> tuple:
+    return name, tuple(map(tuple, labels))
+
+
+def _add_snapshot(target: dict, snapshot: dict):
+    """Adds a worker's counters and histograms (and collected counters, but not gauges) to `target`."""
+    counters = {_sample_key(sample[0], sample[1]): sample for sample in target["counters"]}
+    for name, labels, value in snapshot.get("counters", []):
+        counters.setdefault(_sample_key(name, labels), [name, labels, 0])[2] += value
+    histograms = {_sample_key(sample[0], sample[1]): sample for sample in target["histograms"]}
+    for name, labels, bounds, counts, total, count in snapshot.get("histograms", []):
+        merged = histograms.setdefault(_sample_key(name, labels), [name, labels, bounds, [0] * len(counts), 0.0, 0])
+        if merged[2] == bounds:
+            merged[3] = [a + b for a, b in zip(merged[3], counts)]
+            merged[4] += total
+            merged[5] += count
+    collected = {_sample_key(sample[0], sample[3]): sample for sample in target["collected"]}
+    for name, kind, help_text, labels, value in snapshot.get("collected", []):
+        if kind == 'counter':
+            collected.setdefault(_sample_key(name, labels), [name, kind, help_text, labels, 0])[4] += value
+    target["counters"] = list(counters.values())
+    target["histograms"] = list(histograms.values())
+    target["collected"] = list(collected.values())
+
+
+def _retire(path: str):
+    """
+    Folds the metrics file of an exited worker into the retired totals and
+    removes it. The file is first renamed, so when several workers notice the
+    same exit only one of them folds it.
+    """
+    claimed = f"{path}.{os.getpid()}.retiring"
+    try:
+        os.rename(path, claimed)
+    except OSError:
+        return  # Already taken by another worker
+    snapshot = _read_snapshot(claimed)
+    retired_path = os.path.join(METRICS_DIR, RETIRED_FILE)
+    with _fold_lock, open(os.path.join(METRICS_DIR, RETIRED_FILE + '.lock'), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if snapshot is not None:
+            retired = _read_snapshot(retired_path) or {"counters": [], "histograms": [], "collected": []}
+            _add_snapshot(retired, snapshot)
+            temp_path = f"{retired_path}.{os.getpid()}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(retired, f)
+            os.replace(temp_path, retired_path)
+        os.remove(claimed)
+
+
+def _load_snapshots() -> List[dict]:
+    """
+    The metrics files of all running workers plus the retired totals; files
+    of workers that have exited are folded into the retired totals first.
+    """
+    snapshots = []
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return snapshots
+    for name in names:
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        try:
+            pid = int(name[len('metrics-'):-len('.json')])
+        except ValueError:
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        if not _is_running(pid):
+            try:
+                _retire(path)
+            except OSError:
+                pass
+            continue
+        snapshot = _read_snapshot(path)
+        if snapshot is not None:
+            snapshots.append(snapshot)
+    retired = _read_snapshot(os.path.join(METRICS_DIR, RETIRED_FILE))
+    if retired is not None:
+        snapshots.append(retired)
+    return snapshots
+
+
+def _format_labels(labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = [tuple(pair) for pair in labels] + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus() -> str:
+    """All workers' metrics, added up, in the Prometheus text exposition format."""
+    flush()  # Include everything this worker has recorded so far
+    counters: Dict[tuple, float] = {}
+    histograms: Dict[tuple, list] = {}
+    collected: Dict[tuple, float] = {}
+    kinds: Dict[str, Tuple[str, str]] = dict(_HELP)
+    for snapshot in _load_snapshots():
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, bounds, counts, total, count in snapshot.get("histograms", []):
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.get(key)
+            if merged is None or merged[0] != bounds:
+                histograms[key] = [bounds, list(counts), total, count]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += total
+                merged[3] += count
+        for name, kind, help_text, labels, value in snapshot.get("collected", []):
+            key = (name, tuple(map(tuple, labels)))
+            collected[key] = collected.get(key, 0) + value
+            kinds.setdefault(name, (kind, help_text))
+
+    lines = []
+    for name, (kind, help_text) in sorted(kinds.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for (sample_name, labels), value in sorted(list(counters.items()) + list(collected.items())):
+            if sample_name == name:
+                lines.append(f"{name}{_format_labels(labels)} {_number(value)}")
+        for (sample_name, labels), (bounds, counts, total, count) in sorted(histograms.items()):
+            if sample_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels, (('le', _number(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {_number(total)}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+def install(app, collectors: Optional[List[Callable]] = None):
+    """Adds the request hooks to a Flask app and the phase hook to the analysis (only when metrics are on)."""
+    if not METRICS_ENABLED:
+        return
+    from flask import request
+
+    registry.collectors.extend(collectors or [])
+    portfolio_lib.set_phase_hook(_record_phase)
+    _start_flusher()
+    atexit.register(flush)  # A worker's last requests are kept when it exits
+
+    @app.before_request
+    def _start_request_metrics():
+        start_request()
+
+    @app.after_request
+    def _end_request_metrics(response):
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        end_request(endpoint, response.status_code, request.content_length)
+        return response
@@ -0,0 +1,429 @@
+"""
+History compaction: moves closed history out of the live portfolio into
+immutable yearly archive segments.
+
+Compacting through a date splits the portfolio into
+  - one segment per calendar year of the transactions dated on or before that
+    date, each saved as its own JSON file (named by the hash of its content,
+    and never changed afterwards) with a stored summary of its investment,
+    realized P/L and dividends, overall and per symbol;
+  - a live portfolio that starts with one carried-forward BUY per lot still
+    open on that date, followed by every later transaction.
+
+Normal analysis then only replays the live portfolio. Each open lot is carried
+forward as its own BUY of the shares still held, costing what those shares
+cost in the open lot (dividends a lot received before the cut-off, and the
+shares already sold from it, are in the archive). A lot partly sold before
+the cut-off is charged the cost of the shares carried forward, whereas the
+full history charges its remaining shares on the whole lot's cost (see
+_lot_cost_per_share in portfolio_lib), so the later P/L of such a lot differs
+from the full-history figure. compact() checks the later P/L of every other
+open lot against the full history.
+Full-history reports add the archived summaries to the analysis of the live
+portfolio without reading the segments again.
+
+An archive is described by an index file named by its id, which is also
+written into the remark of every carried-forward BUY. Compacting a live
+portfolio again creates a new index that keeps the earlier segments and adds
+the new ones, so every archive id stays valid.
+
+Usage:
+    python portfolio_archive.py compact portfolio.json --through 2023-12-31
+    python portfolio_archive.py report portfolio.json
+
+Configuration (environment variables):
+    ARCHIVE_DIR  folder for segment and index files (default: archives)
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+from collections import defaultdict
+from dataclasses import asdict, fields
+from datetime import date
+from typing import Callable, Dict, List, Optional, Tuple
+
+from portfolio_lib import (
+    StockTransaction, TransactionType, analyze_portfolio_by_lot, date_normalizer, normalize_date,
+    DEFAULT_LOT_POLICY, LOT_POLICIES,
+)
+
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', 'archives')
+ARCHIVE_FORMAT_VERSION = 1
+# Remark of a carried-forward BUY; it also lets a live portfolio find its archive
+CARRIED_REMARK = "Carried forward from archive {archive_id} (history through {through})"
+_ARCHIVE_ID_PATTERN = re.compile(r'^Carried forward from archive ([0-9a-f]{64}) ')
+
+_TRANSACTION_FIELDS = [f.name for f in fields(StockTransaction)]
+
+
+class ArchiveError(Exception):
+    """The portfolio cannot be compacted as asked, or an archive file is missing or damaged."""
+
+
+def _year_of(value: str) -> Optional[int]:
+    parsed = date_normalizer.parse(value) if value else None
+    return date.fromordinal(parsed[1]).year if parsed else None
+
+
+def _empty_totals() -> dict:
+    return {"transaction_count": 0, "investment": 0.0, "realized_pl": 0.0, "dividends": 0.0}
+
+
+def _add_totals(target: dict, source: dict):
+    for key in ("transaction_count", "investment", "realized_pl", "dividends"):
+        target[key] += source[key]
+
+
+def _carried_test(carried_lots: Dict[str, str], through_ordinal: int) -> Callable[[StockTransaction], bool]:
+    """
+    Recognizes the carried-forward BUYs of an archive: a BUY of a carried lot
+    dated on or before the archive's cut-off (carried lots keep their buy date).
+    """
+    def is_carried(tx: StockTransaction) -> bool:
+        return (tx.type is TransactionType.BUY and tx.date_ordinal <= through_ordinal
+                and carried_lots.get(tx.mylotnumber) == tx.symbol)
+    return is_carried
+
+
+def period_totals(transactions: List[StockTransaction], closed_trades, year_of_undated: int,
+                  is_carried: Optional[Callable[[StockTransaction], bool]] = None) -> Dict[int, dict]:
+    """
+    Investment, realized P/L and dividends by year, overall and per symbol.
+    Transactions count in the year of their date and trades in the year of their
+    sale; undated ones count in `year_of_undated`. Carried-forward BUYs were
+    counted in the year the lot was really bought, so they are skipped.
+    """
+    years: Dict[int, dict] = {}
+
+    def bucket(year: Optional[int], symbol: str) -> Tuple[dict, dict]:
+        year = year if year is not None else year_of_undated
+        totals = years.get(year)
+        if totals is None:
+            totals = years[year] = {**_empty_totals(), "by_symbol": {}}
+        by_symbol = totals["by_symbol"].get(symbol)
+        if by_symbol is None:
+            by_symbol = totals["by_symbol"][symbol] = _empty_totals()
+        return totals, by_symbol
+
+    for tx in transactions:
+        if is_carried is not None and is_carried(tx):
+            continue
+        year = date.fromordinal(tx.date_ordinal).year if tx.date_ordinal > 0 else None
+        for totals in bucket(year, tx.symbol):
+            totals["transaction_count"] += 1
+            if tx.type is TransactionType.BUY:
+                totals["investment"] += tx.get_total_amount()
+            elif tx.type in (TransactionType.DIVIDEND, TransactionType.CASH_RETURN) and tx.closes_lot_number:
+                totals["dividends"] += tx.get_total_amount()
+    for trade in closed_trades:
+        for totals in bucket(_year_of(trade.sell_date), trade.symbol):
+            totals["realized_pl"] += trade.realized_pl
+    return years
+
+
+def _carried_buys(portfolio: List[StockTransaction], open_lots) -> List[StockTransaction]:
+    """
+    One BUY per lot still open at the cut-off, in the order of the open lots:
+    the BUY that supplies the lot in the analysis (the last one in date order)
+    with the volume still held and its commission (and total amount, if it
+    has one) scaled to those shares. The open lots therefore cost the same
+    before and after compaction.
+
+    A BUY without a total amount keeps none: a lot-specific sale charges a
+    lot with a total amount that amount over the shares left, so giving one
+    to every carried lot would change the cost of its later sales.
+    """
+    buys: Dict[str, Tuple[tuple, StockTransaction]] = {}
+    for position, tx in enumerate(portfolio):
+        if tx.type is TransactionType.BUY and tx.mylotnumber:
+            key = (tx.date_ordinal, position)
+            if tx.mylotnumber not in buys or key > buys[tx.mylotnumber][0]:
+                buys[tx.mylotnumber] = (key, tx)
+
+    carried = []
+    for lot in open_lots:
+        buy = buys[lot.lot_number][1]
+        values = {name: getattr(buy, name) for name in _TRANSACTION_FIELDS}
+        values["volume"] = lot.remaining_volume
+        if buy.volume:
+            if buy.commission:
+                values["commission"] = buy.commission * lot.remaining_volume / buy.volume
+            if buy.total_amount is not None:
+                values["total_amount"] = buy.total_amount * lot.remaining_volume / buy.volume
+        carried.append(values)
+    return carried
+
+
+def _later_pl(closed_trades, lots: set, cut: int) -> List[Tuple[str, float]]:
+    """(lot, realized P/L) of the trades of `lots` sold after the day `cut`, in trade order."""
+    return [(trade.lot_number, trade.realized_pl) for trade in closed_trades
+            if trade.lot_number in lots and (date_normalizer.parse(trade.sell_date) or ('', 0))[1] > cut]
+
+
+def find_archive_id(portfolio: List[StockTransaction]) -> Optional[str]:
+    """The archive a live portfolio was compacted into, from the remarks of its carried-forward BUYs."""
+    for tx in portfolio:
+        if tx.type is TransactionType.BUY and tx.remark:
+            match = _ARCHIVE_ID_PATTERN.match(tx.remark)
+            if match:
+                return match.group(1)
+    return None
+
+
+class ArchiveStore:
+    """
+    Segment and index files in one folder. Files are named by a hash of their
+    content and written once, so they can be shared by any number of archives.
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIR):
+        self.directory = directory
+
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.directory, kind, name + '.json')
+
+    def _write_once(self, kind: str, body: bytes) -> str:
+        digest = hashlib.sha256(body).hexdigest()
+        path = self._path(kind, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(body)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, path)
+        return digest
+
+    def _read(self, kind: str, name: str) -> bytes:
+        label = 'archive' if kind == 'indexes' else 'segment'
+        if not name or not all(c in '0123456789abcdef' for c in name):
+            raise ArchiveError(f"Invalid {label} id: {name!r}")
+        try:
+            with open(self._path(kind, name), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise ArchiveError(f"Unknown {label}: {name} (not found in {self.directory})") from None
+        if hashlib.sha256(body).hexdigest() != name:
+            raise ArchiveError(f"{label.capitalize()} {name} is damaged (its content does not match its name)")
+        return body
+
+    def save_segment(self, transactions: List[StockTransaction]) -> str:
+        body = json.dumps([asdict(tx) for tx in transactions], indent=2, ensure_ascii=False).encode('utf-8')
+        return self._write_once('segments', body)
+
+    def load_segment(self, segment_id: str) -> List[StockTransaction]:
+        return [StockTransaction(**item) for item in json.loads(self._read('segments', segment_id))]
+
+    def save_index(self, index: dict) -> str:
+        return self._write_once('indexes', json.dumps(index, indent=2, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+    def load_index(self, archive_id: str) -> dict:
+        """An archive's index. Raises ArchiveError if it, or any of its segments, is missing."""
+        index = json.loads(self._read('indexes', archive_id))
+        missing = [segment["year"] for segment in index["segments"]
+                   if not os.path.exists(self._path('segments', segment["segment_id"]))]
+        if missing:
+            raise ArchiveError(f"Archive {archive_id} is incomplete: the segments of {', '.join(map(str, missing))} "
+                               f"are missing from {self.directory}")
+        return index
+
+
+def archive_lot_policy(index: dict) -> str:
+    """The lot policy an archive was compacted with; its live portfolio must be analyzed with it too."""
+    return index.get("lot_policy", DEFAULT_LOT_POLICY)
+
+
+def compact(portfolio: List[StockTransaction], through: str, store: ArchiveStore,
+            base_archive_id: Optional[str] = None,
+            lot_policy: str = DEFAULT_LOT_POLICY) -> Tuple[str, dict, List[StockTransaction]]:
+    """
+    Archives every transaction dated on or before `through` and returns
+    (archive id, archive index, live portfolio). With `base_archive_id` the
+    portfolio is the live portfolio of that archive, and the new archive
+    continues it.
+
+    `lot_policy` matches SELLs without a lot as in analyze_portfolio_by_lot.
+    The carried-forward lots keep their buy date and price, so FIFO, LIFO and
+    HIFO sales after the cut-off match the same lots; the pooled cost of
+    'average' cannot be carried forward as lots and is refused.
+    """
+    if lot_policy == 'average':
+        raise ArchiveError("A portfolio analyzed at average cost cannot be compacted into lots")
+    if lot_policy not in LOT_POLICIES:
+        raise ArchiveError(f"Unknown lot policy: {lot_policy!r}")
+    through = normalize_date(through)
+    cut = date.fromisoformat(through).toordinal()
+    base = store.load_index(base_archive_id) if base_archive_id else None
+    if base and archive_lot_policy(base) != lot_policy:
+        raise ArchiveError(f"The archive was compacted with the {archive_lot_policy(base)!r} lot policy, "
+                           f"not {lot_policy!r}")
+    first_day = date.fromisoformat(base["through"]).toordinal() + 1 if base else 0
+    if cut < first_day:
+        raise ArchiveError(f"The archive already covers everything through {base['through']}")
+    is_carried = _carried_test(base["carried_lots"] if base else {}, first_day - 1)
+
+    archived = [tx for tx in portfolio if tx.date_ordinal <= cut]
+    if base:
+        backdated = [tx for tx in archived if 0 < tx.date_ordinal < first_day and not is_carried(tx)]
+        if backdated:
+            raise ArchiveError(f"{len(backdated)} transaction(s) are dated on or before {base['through']}, "
+                               f"which is already archived (first: {backdated[0].date} {backdated[0].symbol})")
+
+    open_lots, closed_trades, _, _, _ = analyze_portfolio_by_lot(archived, lot_policy=lot_policy)
+    carried = _carried_buys(archived, open_lots)
+    # The carried BUYs on their own must open the same lots, at the same cost
+    carried_lots, _, _, _, _ = analyze_portfolio_by_lot([StockTransaction(**values) for values in carried], backend='python')
+    if len(carried_lots) != len(open_lots) or any(
+            carried.lot_number != lot.lot_number or carried.remaining_volume != lot.remaining_volume
+            or not math.isclose(carried.total_cost, lot.total_cost, rel_tol=1e-9, abs_tol=1e-9)
+            for carried, lot in zip(carried_lots, open_lots)):
+        raise ArchiveError("The carried-forward lots do not match the open lots at the cut-off")
+    # Later sales of a lot not yet sold from must come out as with the full history
+    unsold = {lot.lot_number for lot in open_lots if lot.remaining_volume == lot.original_volume}
+    later = [tx for tx in portfolio if tx.date_ordinal > cut]
+    if unsold and later:
+        live_carried = [StockTransaction(**values) for values in carried]
+        expected = _later_pl(analyze_portfolio_by_lot(portfolio, lot_policy=lot_policy)[1], unsold, cut)
+        actual = _later_pl(analyze_portfolio_by_lot(live_carried + later, lot_policy=lot_policy)[1], unsold, cut)
+        if len(actual) != len(expected) or any(
+                lot != expected_lot or not math.isclose(pl, expected_pl, rel_tol=1e-9, abs_tol=1e-6)
+                for (lot, pl), (expected_lot, expected_pl) in zip(actual, expected)):
+            raise ArchiveError("Sales after the cut-off would not give the same P/L as with the full history")
+
+    # --- One segment per year (undated transactions go with the first year) ---
+    new_rows = [tx for tx in archived if not is_carried(tx)]
+    dated_years = sorted({date.fromordinal(tx.date_ordinal).year for tx in new_rows if tx.date_ordinal > 0})
+    first_year = dated_years[0] if dated_years else date.fromordinal(cut).year
+    totals_by_year = period_totals(new_rows, closed_trades, first_year)
+    rows_by_year: Dict[int, List[StockTransaction]] = defaultdict(list)
+    for tx in new_rows:
+        rows_by_year[date.fromordinal(tx.date_ordinal).year if tx.date_ordinal > 0 else first_year].append(tx)
+
+    segments = list(base["segments"]) if base else []
+    for year in sorted(set(rows_by_year) | set(totals_by_year)):
+        start = max(date(year, 1, 1).toordinal(), first_day)
+        end = min(date(year, 12, 31).toordinal(), cut)
+        rows = rows_by_year.get(year, [])
+        segments.append({
+            "year": year,
+            "start": date.fromordinal(start).isoformat(),
+            "end": date.fromordinal(end).isoformat(),
+            "segment_id": store.save_segment(rows),
+            "summary": totals_by_year.get(year) or {**_empty_totals(), "by_symbol": {}},
+        })
+
+    index = {
+        "version": ARCHIVE_FORMAT_VERSION,
+        "base_archive_id": base_archive_id,
+        "through": through,
+        "lot_policy": lot_policy,
+        "segments": segments,
+        "carried_lots": {values["mylotnumber"]: values["symbol"] for values in carried},
+    }
+    archive_id = store.save_index(index)
+    remark = CARRIED_REMARK.format(archive_id=archive_id, through=through)
+    live = [StockTransaction(**{**values, "remark": remark}) for values in carried]
+    live.extend(tx for tx in portfolio if tx.date_ordinal > cut)
+    return archive_id, index, live
+
+
+def history_report(index: dict, live_portfolio: List[StockTransaction], live_analysis) -> dict:
+    """
+    Investment, realized P/L and dividends by year and in total over the whole
+    history: the stored summaries of the archived segments plus the live
+    portfolio's analysis (made with the archive's lot policy).
+    """
+    through_year = date.fromisoformat(index["through"]).year
+    years: Dict[int, dict] = {}
+    for segment in index["segments"]:
+        totals = years.setdefault(segment["year"], {**_empty_totals(), "by_symbol": {}, "archived": True})
+        _add_totals(totals, segment["summary"])
+        for symbol, values in segment["summary"]["by_symbol"].items():
+            _add_totals(totals["by_symbol"].setdefault(symbol, _empty_totals()), values)
+
+    is_carried = _carried_test(index["carried_lots"], date.fromisoformat(index["through"]).toordinal())
+    live_years = period_totals(live_portfolio, live_analysis[1], through_year, is_carried)
+    for year, live_totals in live_years.items():
+        totals = years.setdefault(year, {**_empty_totals(), "by_symbol": {}, "archived": False})
+        _add_totals(totals, live_totals)
+        for symbol, values in live_totals["by_symbol"].items():
+            _add_totals(totals["by_symbol"].setdefault(symbol, _empty_totals()), values)
+
+    overall = _empty_totals()
+    for totals in years.values():
+        _add_totals(overall, totals)
+    open_lots = live_analysis[0]
+    overall["open_lot_count"] = len(open_lots)
+    overall["open_cost"] = sum(lot.total_cost for lot in open_lots)
+    return {
+        "archived_through": index["through"],
+        "years": [{"year": year, **years[year]} for year in sorted(years)],
+        "totals": overall,
+    }
+
+
+# --- Command line ---
+def _compact_file(portfolio_path: str, through: str, store: ArchiveStore, archive_id: Optional[str], lot_policy: str):
+    from main import load_portfolio, save_portfolio
+
+    portfolio = load_portfolio(portfolio_path)
+    base_archive_id = archive_id or find_archive_id(portfolio)
+    base_segments = len(store.load_index(base_archive_id)["segments"]) if base_archive_id else 0
+    archive_id, index, live = compact(portfolio, through, store, base_archive_id, lot_policy)
+
+    stem, extension = os.path.splitext(portfolio_path)
+    backup_path = f"{stem}.before-compaction-{index['through']}{extension}"
+    os.replace(portfolio_path, backup_path)
+    save_portfolio(portfolio_path, live)
+    new_segments = index["segments"][base_segments:]
+    print(f"Archived {sum(s['summary']['transaction_count'] for s in new_segments):,} transaction(s) through "
+          f"{index['through']} into {len(new_segments)} segment(s) in '{store.directory}'.")
+    print(f"Archive id: {archive_id}")
+    print(f"'{portfolio_path}' now holds {len(live):,} transaction(s), including {len(index['carried_lots']):,} "
+          f"carried-forward lot(s). The previous file was kept as '{backup_path}'.")
+
+
+def _print_report(portfolio_path: str, store: ArchiveStore, archive_id: Optional[str]):
+    from main import load_portfolio
+
+    portfolio = load_portfolio(portfolio_path)
+    archive_id = archive_id or find_archive_id(portfolio)
+    if archive_id is None:
+        print(f"No archive found for '{portfolio_path}' (pass --archive-id if it has no carried-forward lots).")
+        return
+    index = store.load_index(archive_id)
+    report = history_report(index, portfolio, analyze_portfolio_by_lot(portfolio, lot_policy=archive_lot_policy(index)))
+    print(f"--- Full History (archived through {report['archived_through']}) ---")
+    for row in report["years"]:
+        print(f"  {row['year']}{' (archived)' if row['archived'] else '':<11} investment {row['investment']:>16,.2f}  "
+              f"realized P/L {row['realized_pl']:>14,.2f}  dividends {row['dividends']:>14,.2f} THB")
+    totals = report["totals"]
+    print(f"Total investment cost (all BUYs): {totals['investment']:,.2f} THB")
+    print(f"Total realized P/L: {totals['realized_pl']:,.2f} THB")
+    print(f"Total dividends received: {totals['dividends']:,.2f} THB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive closed history out of the live portfolio.")
+    parser.add_argument('--archive-dir', default=ARCHIVE_DIR, help=f"where archives are stored (default: {ARCHIVE_DIR})")
+    parser.add_argument('--archive-id', help="the portfolio's archive, when it cannot be found from its carried-forward lots")
+    commands = parser.add_subparsers(dest='command', required=True)
+    compact_parser = commands.add_parser('compact', help="archive everything dated on or before --through")
+    compact_parser.add_argument('portfolio', help="portfolio.json or a SQLite database (.db)")
+    compact_parser.add_argument('--through', required=True, help="last date to archive, e.g. 2023-12-31")
+    compact_parser.add_argument('--lot-policy', choices=[p for p in LOT_POLICIES if p != 'average'], default=DEFAULT_LOT_POLICY,
+                                help="how SELLs without a lot number are matched (default: specific, which ignores them)")
+    report_parser = commands.add_parser('report', help="print totals by year over the archived and live history")
+    report_parser.add_argument('portfolio')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'compact':
+            _compact_file(args.portfolio, args.through, ArchiveStore(args.archive_dir), args.archive_id, args.lot_policy)
+        else:
+            _print_report(args.portfolio, ArchiveStore(args.archive_dir), args.archive_id)
+    except (ArchiveError, ValueError) as e:
+        print(f"Error: {e}")
@@ -0,0 +1,375 @@
+"""
+Multi-account analysis on a warm process pool.
+
+Each account's portfolio is parsed and analyzed by analyze_portfolio_by_lot in
+a worker process, so many portfolios are analyzed in parallel instead of one
+after another inside a single request thread. The pool is started on first use
+and then kept for later batches.
+
+Configuration (environment variables):
+    ANALYSIS_POOL_SIZE    number of worker processes (default: CPU count;
+                          0 analyzes in the calling thread)
+    ANALYSIS_JOB_TIMEOUT  seconds one account may run before it is reported
+                          as timed out (default: 60)
+
+A worker cannot be stopped on its own without breaking the whole pool, so a
+timeout retires the pool instead: later jobs go to a fresh pool, jobs still
+queued on the old one are moved to the new one, and the old workers are
+terminated as soon as the jobs already running on them have finished. The
+timed-out job therefore holds its worker only until then, not until it ends.
+The timeout counts from when a worker reports that it has started a job, since
+ProcessPoolExecutor already calls a job running while it waits for a worker.
+"""
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, Future, CancelledError, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from portfolio_lib import (
+    StockTransaction, OpenLot, analyze_portfolio_by_lot,
+    iter_portfolio_json, PortfolioFormatError, require_known_date, DEFAULT_LOT_POLICY,
+)
+from analysis_output import Analysis, analysis_summary, open_lot_rows, closed_trade_rows
+
+ANALYSIS_POOL_SIZE = int(os.environ.get('ANALYSIS_POOL_SIZE', os.cpu_count() or 1))
+ANALYSIS_JOB_TIMEOUT = float(os.environ.get('ANALYSIS_JOB_TIMEOUT', 60))
+
+# An account is either the raw bytes of a portfolio.json or the already decoded list of transaction dicts.
+AccountData = Union[bytes, List[dict]]
+# What a worker sends back: the account's totals and its analysis already serialized as JSON
+AccountResult = Tuple[dict, bytes]
+
+
+class AnalysisTimeoutError(Exception):
+    """An account's analysis did not finish within the job timeout."""
+
+
+def build_analysis_response(analysis: Analysis, transaction_count: int) -> dict:
+    """Shapes the result of analyze_portfolio_by_lot into the JSON the web page expects."""
+    response = analysis_summary(analysis, transaction_count)
+    # แปลงผลลัพธ์ให้อยู่ในรูปแบบที่ส่งผ่าน JSON ได้
+    response["open_lots"] = open_lot_rows(analysis[0])
+    response["closed_trades"] = closed_trade_rows(analysis[1])
+    return response
+
+
+def analyze_account(data: AccountData, max_bytes: Optional[int] = None,
+                    lot_policy: str = DEFAULT_LOT_POLICY) -> AccountResult:
+    """
+    Parses and analyzes one account. Runs in a worker process, so the response
+    is serialized here too: only a small totals dict and the JSON bytes are
+    sent back to the web server instead of every OpenLot and ClosedTrade.
+    """
+    if isinstance(data, (bytes, bytearray)):
+        portfolio = list(iter_portfolio_json(io.BytesIO(data), max_bytes=max_bytes))
+    else:
+        if not isinstance(data, list):
+            raise PortfolioFormatError("Portfolio must be a JSON array of transactions")
+        portfolio = []
+        for index, item in enumerate(data):
+            if not isinstance(item, dict):
+                raise PortfolioFormatError(f"Transaction {index + 1} is not a JSON object")
+            try:
+                tx = StockTransaction(**item)
+            except TypeError as e:
+                raise PortfolioFormatError(f"Invalid transaction {index + 1}: {e}") from None
+            portfolio.append(require_known_date(tx, index + 1))
+    response = build_analysis_response(analyze_portfolio_by_lot(portfolio, lot_policy=lot_policy), len(portfolio))
+    body = json.dumps(response, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    totals = {key: value for key, value in response.items() if key not in ('open_lots', 'closed_trades')}
+    return totals, body
+
+
+def year_end_portfolio(open_lots: List[OpenLot], closing_date: str) -> List[dict]:
+    """
+    One BUY per open lot, dated `closing_date`, carrying the lot's remaining
+    shares and cost: the starting balance of a new period.
+    """
+    new_portfolio_as_dicts = []
+    for lot in open_lots:
+        if lot.remaining_volume <= 0:
+            continue
+
+        avg_cost_per_share = lot.total_cost / lot.remaining_volume if lot.remaining_volume > 0 else 0
+
+        new_tx = StockTransaction(
+            symbol=lot.symbol, date=closing_date, type='BUY',
+            volume=lot.remaining_volume,
+            price_per_unit=round(avg_cost_per_share, 4),
+            commission=0, mylotnumber=lot.lot_number,
+            total_amount=round(lot.total_cost, 2),
+            remark=f"Year-end closing balance from lot bought on {lot.buy_date}",
+        )
+        new_portfolio_as_dicts.append(asdict(new_tx))
+    return new_portfolio_as_dicts
+
+
+def close_year_account(data: bytes, closing_date: str, max_bytes: Optional[int] = None,
+                       lot_policy: str = DEFAULT_LOT_POLICY) -> bytes:
+    """The /close_year response for one portfolio, serialized as JSON (runs in a worker process)."""
+    portfolio = list(iter_portfolio_json(io.BytesIO(data), max_bytes=max_bytes))
+    if not portfolio:
+        raise PortfolioFormatError("No portfolio data provided")
+    open_lots = analyze_portfolio_by_lot(portfolio, lot_policy=lot_policy)[0]
+    return json.dumps(year_end_portfolio(open_lots, closing_date), ensure_ascii=False, sort_keys=True,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def _warm_up() -> int:
+    """Runs once in each new worker so the first real job does not pay for imports."""
+    analyze_portfolio_by_lot([])
+    return os.getpid()
+
+
+# Set in each worker by _init_worker: where the worker reports the jobs it starts
+_started_jobs = None
+
+
+def _init_worker(started_jobs):
+    global _started_jobs
+    _started_jobs = started_jobs
+
+
+def _run_job(job_id: int, fn: Callable, *args):
+    """Reports that job `job_id` has started, then runs it (in a worker process)."""
+    _started_jobs.put(job_id)
+    return fn(*args)
+
+
+class AnalysisPool:
+    """
+    A lazily started, reusable process pool for analyze_account jobs.
+
+    Workers use the 'spawn' start method: the web server is multi-threaded,
+    and forking a threaded process is not safe.
+    """
+
+    def __init__(self, workers: int = ANALYSIS_POOL_SIZE, job_timeout: float = ANALYSIS_JOB_TIMEOUT):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.RLock()
+        self._job_ids = itertools.count()
+        self._jobs: Dict[Future, ProcessPoolExecutor] = {}  # Unfinished job -> the pool it was submitted to
+        self._job_id_of: Dict[Future, int] = {}
+        self._started: Dict[int, Optional[float]] = {}  # Job id -> when it was seen to start (None: not yet)
+        self._started_queues: Dict[ProcessPoolExecutor, object] = {}  # Pool -> the queue its workers report starts to
+        self._timed_out: Dict[ProcessPoolExecutor, set] = {}  # Retired pool -> its jobs that timed out
+        self._requeue: set = set()  # Jobs lost with a retired pool's workers before they started
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context('spawn')
+                started_jobs = context.SimpleQueue()
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                                     initializer=_init_worker, initargs=(started_jobs,))
+                self._started_queues[self._executor] = started_jobs
+                # Start every worker now instead of one per job
+                wait([self._executor.submit(_warm_up) for _ in range(self.workers)])
+            return self._executor
+
+    def _submit(self, fn: Callable, *args) -> Future:
+        executor = self._get_executor()
+        with self._lock:
+            job_id = next(self._job_ids)
+            self._started[job_id] = None  # Before submitting, as the worker may report the start straight away
+        try:
+            future = executor.submit(_run_job, job_id, fn, *args)
+        except BrokenProcessPool:
+            with self._lock:
+                del self._started[job_id]
+            self.shutdown()
+            raise
+        with self._lock:
+            self._jobs[future] = executor
+            self._job_id_of[future] = job_id
+        future.add_done_callback(self._forget)
+        return future
+
+    def _forget(self, future: Future):
+        with self._lock:
+            self._jobs.pop(future, None)
+            self._started.pop(self._job_id_of.pop(future, None), None)
+            if future.cancelled() or not isinstance(future.exception(), BrokenProcessPool):
+                self._requeue.discard(future)
+
+    def _started_at(self, future: Future) -> Optional[float]:
+        """
+        When `future` started running in a worker, or None while it waits.
+        (Future.running() is no use here: it is also true of a job waiting in
+        the pool's call queue for a worker to become free.)
+        """
+        with self._lock:
+            now = time.monotonic()
+            for started_jobs in self._started_queues.values():
+                while not started_jobs.empty():
+                    job_id = started_jobs.get()
+                    if job_id in self._started:
+                        self._started[job_id] = now
+            return self._started.get(self._job_id_of.get(future))
+
+    def _take_requeued(self, future: Future) -> bool:
+        """True (once) if `future` failed only because its retired pool was terminated before it started."""
+        with self._lock:
+            if future in self._requeue:
+                self._requeue.discard(future)
+                return True
+            return False
+
+    def _retire(self, future: Future):
+        """
+        Called when `future` has timed out: its pool takes no new jobs, and a
+        background thread terminates the pool's workers once its other jobs
+        are done (see the module docstring).
+        """
+        with self._lock:
+            executor = self._jobs.get(future)
+            if executor is None:
+                return  # It finished after all
+            if executor in self._timed_out:
+                self._timed_out[executor].add(future)
+                return
+            self._timed_out[executor] = {future}
+            if self._executor is executor:
+                self._executor = None
+        threading.Thread(target=self._reap, args=(executor,), name='analysis-pool-reaper', daemon=True).start()
+
+    def _unfinished(self, executor: ProcessPoolExecutor) -> List[Future]:
+        """The jobs submitted to `executor` that are neither finished nor timed out."""
+        with self._lock:
+            timed_out = self._timed_out[executor]
+            return [future for future, owner in self._jobs.items() if owner is executor and future not in timed_out]
+
+    def _reap(self, executor: ProcessPoolExecutor):
+        while True:
+            # Jobs that have not reached a worker are cancelled; their callers resubmit them to the new pool
+            others = [future for future in self._unfinished(executor) if not future.cancel()]
+            running = [future for future in others if self._started_at(future) is not None]
+            if not running:
+                break
+            # Checked again every round, as more of the running jobs may time out meanwhile
+            wait(running, timeout=0.05)
+        with self._lock:
+            # Jobs still waiting in the call queue fail with the workers; their callers resubmit them too
+            self._requeue.update(self._unfinished(executor))
+        # ปิด worker ที่ยังค้างอยู่ทิ้ง แม้งานที่หมดเวลาจะยังไม่จบ
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            del self._timed_out[executor]
+            del self._started_queues[executor]
+
+    def run(self, fn: Callable, *args):
+        """
+        Runs one job on the pool and returns its result (inline when there are
+        no workers). Raises AnalysisTimeoutError once the job has been running
+        for longer than job_timeout seconds, and retires the pool's worker.
+        """
+        if self.workers <= 0:
+            return fn(*args)
+        future = self._submit(fn, *args)
+        while True:
+            try:
+                return future.result(timeout=0.05)
+            except TimeoutError:
+                pass
+            except CancelledError:
+                # Still queued when its pool was retired after another job timed out
+                future = self._submit(fn, *args)
+                continue
+            except BrokenProcessPool:
+                if self._take_requeued(future):
+                    future = self._submit(fn, *args)
+                    continue
+                self.shutdown()
+                raise
+            started = self._started_at(future)
+            if started is not None and time.monotonic() - started > self.job_timeout:
+                self._retire(future)
+                raise AnalysisTimeoutError(f"Analysis did not finish within {self.job_timeout:g} seconds")
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._started_queues.pop(self._executor, None)
+                self._executor = None
+
+    def analyze_accounts(self, accounts: Dict[str, AccountData], max_bytes: Optional[int] = None) -> Dict[str, Union[AccountResult, Exception]]:
+        """
+        Analyzes every account and returns, in the same order, either its
+        (totals, json_body) result or the exception that account raised.
+        A job that has been running for longer than job_timeout seconds is
+        reported as AnalysisTimeoutError and its worker is retired.
+        """
+        if self.workers <= 0:
+            return {name: self._run_inline(data, max_bytes) for name, data in accounts.items()}
+
+        futures = {self._submit(analyze_account, data, max_bytes): name for name, data in accounts.items()}
+
+        results: Dict[str, Union[AccountResult, Exception]] = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    results[futures[future]] = future.result()
+                except (CancelledError, BrokenProcessPool) as e:
+                    if isinstance(e, BrokenProcessPool) and not self._take_requeued(future):
+                        self.shutdown()
+                        raise
+                    # Still queued when its pool was retired after a job timed out
+                    name = futures[future]
+                    resubmitted = self._submit(analyze_account, accounts[name], max_bytes)
+                    futures[resubmitted] = name
+                    pending.add(resubmitted)
+                except Exception as e:
+                    results[futures[future]] = e
+            # The timeout counts from when a job starts running, not from when it was queued.
+            now = time.monotonic()
+            for future in list(pending):
+                started = self._started_at(future)
+                if started is not None and now - started > self.job_timeout:
+                    pending.discard(future)
+                    self._retire(future)
+                    results[futures[future]] = AnalysisTimeoutError(
+                        f"Analysis did not finish within {self.job_timeout:g} seconds")
+        return {name: results[name] for name in accounts}
+
+    @staticmethod
+    def _run_inline(data: AccountData, max_bytes: Optional[int]):
+        try:
+            return analyze_account(data, max_bytes)
+        except Exception as e:
+            return e
+
+
+def consolidate(totals: List[dict]) -> dict:
+    """Cross-account summary from the totals of the successfully analyzed accounts."""
+    summary = {
+        "accounts": len(totals),
+        "total_investment": 0,
+        "total_realized_pl": 0,
+        "total_dividends": 0,
+        "transaction_count": 0,
+    }
+    symbols = set()
+    for account in totals:
+        for key in ("total_investment", "total_realized_pl", "total_dividends", "transaction_count"):
+            summary[key] += account[key]
+        symbols.update(account["all_symbols"])
+    summary["all_symbols"] = sorted(symbols)
+    return summary
+
+
+# Shared pool for the web app (one per server process)
+analysis_pool = AnalysisPool()
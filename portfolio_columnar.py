@@ -0,0 +1,213 @@
+"""
+NumPy backend for analyze_portfolio_by_lot.
+
+Transactions are loaded into column arrays once, and per-lot remaining volume,
+cost basis, dividends and realized P/L are computed with grouped array
+operations instead of a per-transaction Python loop. The results are the same
+OpenLot/ClosedTrade lists and totals as the pure Python analysis.
+
+NumPy is optional: use is_available() before calling analyze_columnar().
+"""
+from typing import List, Dict
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - depends on the environment
+    np = None
+
+from portfolio_lib import StockTransaction, OpenLot, ClosedTrade
+
+# --- Type codes ---
+TYPE_BUY, TYPE_SELL, TYPE_DIVIDEND, TYPE_OTHER = 0, 1, 2, 3
+_TYPE_CODES = {'BUY': TYPE_BUY, 'SELL': TYPE_SELL, 'DIVIDEND': TYPE_DIVIDEND, 'CASH_RETURN': TYPE_DIVIDEND}
+
+
+def is_available() -> bool:
+    """True when NumPy is installed."""
+    return np is not None
+
+
+class TransactionColumns:
+    """A portfolio stored as parallel column arrays, one row per transaction."""
+
+    def __init__(self, portfolio: List[StockTransaction]):
+        self.transactions = portfolio
+        self.lot_codes: Dict[str, int] = {}  # lot number -> code, for BUY lots and closed lots alike
+        symbol_codes: Dict[str, int] = {}
+
+        types, symbols, lots, closes = [], [], [], []
+        has_total, total = [], []
+        for tx in portfolio:
+            code = _TYPE_CODES.get(tx.type, TYPE_OTHER)
+            types.append(code)
+            symbols.append(symbol_codes.setdefault(tx.symbol, len(symbol_codes)))
+            own_lot = tx.mylotnumber if code == TYPE_BUY and tx.mylotnumber else None
+            lots.append(self.lot_codes.setdefault(own_lot, len(self.lot_codes)) if own_lot else -1)
+            closes.append(self.lot_codes.setdefault(tx.closes_lot_number, len(self.lot_codes)) if tx.closes_lot_number else -1)
+            has_total.append(tx.total_amount is not None)
+            total.append(tx.total_amount if tx.total_amount is not None else 0.0)
+
+        self.symbols = list(symbol_codes)
+        self.lot_numbers = list(self.lot_codes)
+        self.type_code = np.array(types, dtype=np.int8)
+        self.symbol_code = np.array(symbols, dtype=np.int64)
+        self.lot_id = np.array(lots, dtype=np.int64)
+        self.closes_lot_id = np.array(closes, dtype=np.int64)
+        self.date_ordinal = np.array([tx.date_ordinal for tx in portfolio], dtype=np.int64)
+        self.volume = np.array([tx.volume if tx.volume is not None else 0 for tx in portfolio], dtype=np.int64)
+        self.price = np.array([tx.price_per_unit if tx.price_per_unit is not None else 0.0 for tx in portfolio], dtype=np.float64)
+        self.commission = np.array([tx.commission if tx.commission is not None else 0.0 for tx in portfolio], dtype=np.float64)
+        self.has_total = np.array(has_total, dtype=bool)
+        self.total = np.array(total, dtype=np.float64)
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def total_amounts(self) -> 'np.ndarray':
+        """Vectorized StockTransaction.get_total_amount() for every row."""
+        gross = self.volume * self.price
+        computed = np.where(self.type_code == TYPE_BUY, gross + self.commission,
+                            np.where(self.type_code == TYPE_SELL, gross - self.commission,
+                                     np.where(self.type_code == TYPE_DIVIDEND, gross, 0.0)))
+        return np.where(self.has_total, self.total, computed)
+
+
+def _segment_starts(keys: 'np.ndarray') -> 'np.ndarray':
+    """Start index of every run of equal values in an already grouped array."""
+    if not len(keys):
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def _sequential_sum(values) -> float:
+    """Left-to-right sum, so totals match the Python backend bit for bit."""
+    return sum(values.tolist()) if len(values) else 0
+
+
+def analyze_columnar(portfolio: List[StockTransaction]) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+    """Same contract as analyze_portfolio_by_lot, computed on column arrays."""
+    if np is None:
+        raise RuntimeError("The numpy backend requires NumPy (pip install numpy)")
+
+    cols = TransactionColumns(portfolio)
+    n = len(cols)
+    positions = np.arange(n)
+    amounts = cols.total_amounts()
+    is_buy = cols.type_code == TYPE_BUY
+
+    if (cols.volume[is_buy | (cols.type_code == TYPE_SELL)] < 0).any():
+        # Negative volumes break the closed-form remaining-volume arithmetic below.
+        from portfolio_lib import analyze_portfolio_by_lot
+        return analyze_portfolio_by_lot(portfolio, backend='python')
+
+    total_investment = _sequential_sum(amounts[is_buy])
+    order = np.argsort(cols.date_ordinal, kind='stable')  # Date order, ties in input order
+
+    # --- Resolve lots: last BUY in date order wins, last in input order gives the original ---
+    num_lots = len(cols.lot_numbers)
+    buy_rows = np.flatnonzero(cols.lot_id >= 0)
+    buy_rows_by_date = order[cols.lot_id[order] >= 0]
+    winner = np.full(num_lots, -1, dtype=np.int64)
+    first = np.full(num_lots, -1, dtype=np.int64)
+    original = np.full(num_lots, -1, dtype=np.int64)
+    winner[cols.lot_id[buy_rows_by_date]] = buy_rows_by_date  # Later assignments win
+    first[cols.lot_id[buy_rows_by_date[::-1]]] = buy_rows_by_date[::-1]
+    original[cols.lot_id[buy_rows]] = buy_rows
+    is_buy_lot = winner >= 0
+
+    # --- Dividends: summed per lot in date order ---
+    div_rows = order[(cols.type_code[order] == TYPE_DIVIDEND) & (cols.closes_lot_id[order] >= 0)]
+    div_lots = cols.closes_lot_id[div_rows]
+    dividends_per_lot = np.bincount(div_lots, weights=amounts[div_rows], minlength=num_lots)
+    _, first_seen = np.unique(div_lots, return_index=True)
+    total_dividends = _sequential_sum(dividends_per_lot[div_lots[np.sort(first_seen)]])
+
+    # --- Sells: grouped per lot to get the remaining volume before and after each sale ---
+    sell_lot_all = cols.closes_lot_id[order]
+    sell_mask = (cols.type_code[order] == TYPE_SELL) & (sell_lot_all >= 0)
+    sell_mask[sell_mask] = is_buy_lot[sell_lot_all[sell_mask]]
+    sells = order[sell_mask]  # Processing order
+    sell_lots = cols.closes_lot_id[sells]
+    by_lot = np.argsort(sell_lots, kind='stable')
+    grouped_lots = sell_lots[by_lot]
+    grouped_volume = cols.volume[sells][by_lot]
+    cumulative = np.cumsum(grouped_volume)
+    starts = _segment_starts(grouped_lots)
+    offsets = np.repeat(cumulative[starts] - grouped_volume[starts], np.diff(np.r_[starts, len(grouped_lots)]))
+    sold_after = cumulative - offsets
+    lot_volume = cols.volume[winner[grouped_lots]]
+    remaining_before = np.empty(len(sells), dtype=np.int64)
+    remaining_after = np.empty(len(sells), dtype=np.int64)
+    remaining_before[by_lot] = np.maximum(lot_volume - (sold_after - grouped_volume), 0)
+    remaining_after[by_lot] = np.maximum(lot_volume - sold_after, 0)
+    if (remaining_before == 0).any():
+        raise ZeroDivisionError("float division by zero")
+    volume_sold = remaining_before - remaining_after
+
+    buys = winner[sell_lots]
+    lot_total = np.where(cols.has_total[buys], cols.total[buys],
+                         (remaining_before * cols.price[buys]) + cols.commission[buys])
+    cost_per_share = lot_total / remaining_before
+    money_in = cost_per_share * volume_sold
+    money_out = amounts[sells]
+    realized_pl = money_out - money_in
+
+    # Cumulative P/L per symbol, accumulated in processing order
+    sell_symbols = cols.symbol_code[buys]
+    by_symbol = np.argsort(sell_symbols, kind='stable')
+    grouped_pl = realized_pl[by_symbol]
+    cumulative_pl = np.empty(len(sells), dtype=np.float64)
+    bounds = np.r_[_segment_starts(sell_symbols[by_symbol]), len(sells)]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        cumulative_pl[by_symbol[start:end]] = np.cumsum(grouped_pl[start:end])
+
+    sold_per_lot = np.bincount(sell_lots, weights=volume_sold, minlength=num_lots).astype(np.int64)
+    final_remaining = np.where(is_buy_lot, np.maximum(cols.volume[np.maximum(winner, 0)] - sold_per_lot, 0), 0)
+    fully_sold = final_remaining[sell_lots] == 0
+
+    # --- Build the result rows ---
+    tx = portfolio
+    symbols, lot_numbers = cols.symbols, cols.lot_numbers
+    closed_trades = [
+        ClosedTrade(
+            symbol=symbols[sym], buy_date=tx[b].date, sell_date=tx[s].date,
+            volume_sold=vs, money_in=mi, money_out=mo,
+            realized_pl=pl, cumulative_pl_for_symbol=cpl,
+            lot_number=tx[b].mylotnumber,
+            buy_price_per_share=tx[b].price_per_unit,
+            buy_cost_per_share_incl_comm=cps,
+            sell_price_per_share=tx[s].price_per_unit,
+            remaining_in_lot_after_sale=ra,
+            is_lot_fully_sold=fs,
+        )
+        for s, b, sym, vs, mi, mo, pl, cpl, cps, ra, fs in zip(
+            sells.tolist(), buys.tolist(), sell_symbols.tolist(), volume_sold.tolist(),
+            money_in.tolist(), money_out.tolist(), realized_pl.tolist(), cumulative_pl.tolist(),
+            cost_per_share.tolist(), remaining_after.tolist(), fully_sold.tolist())
+    ]
+
+    open_mask = is_buy_lot & (final_remaining > 0)
+    open_ids = np.flatnonzero(open_mask)
+    open_winner, open_first = winner[open_ids], first[open_ids]
+    open_ids = open_ids[np.lexsort((positions[open_first], cols.date_ordinal[open_first], cols.date_ordinal[open_winner]))]
+    open_winner, open_original = winner[open_ids], original[open_ids]
+    original_volume = cols.volume[open_original]
+    remaining = final_remaining[open_ids]
+    safe_volume = np.where(original_volume > 0, original_volume, 1)
+    total_cost = np.where(original_volume > 0, (amounts[open_original] / safe_volume) * remaining, 0)
+    open_lots = [
+        OpenLot(
+            symbol=tx[w].symbol, buy_date=tx[w].date,
+            original_volume=ov, remaining_volume=rv,
+            buy_price=tx[w].price_per_unit,
+            total_cost=tc,
+            lot_number=lot_numbers[lot],
+            dividends_received=dv,
+        )
+        for lot, w, ov, rv, tc, dv in zip(
+            open_ids.tolist(), open_winner.tolist(), original_volume.tolist(), remaining.tolist(),
+            total_cost.tolist(), dividends_per_lot[open_ids].tolist())
+    ]
+
+    total_realized_pl = _sequential_sum(realized_pl)
+    return open_lots, closed_trades, total_investment, total_realized_pl, total_dividends
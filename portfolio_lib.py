@@ -1,11 +1,180 @@
 from dataclasses import dataclass
-from typing import List, Optional, Dict
-from collections import defaultdict
-import copy
+from datetime import date, datetime
+from enum import Enum
+from typing import List, Optional, Dict, BinaryIO, Iterator, Tuple, Union, Callable
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from copy import copy
+from fractions import Fraction
+from operator import attrgetter, itemgetter
+import codecs
+import heapq
+import json
+import sys
+from time import perf_counter
+
+# --- Timing hooks ---
+# Called with (phase name, seconds) when installed with set_phase_hook(); None means timing is off.
+_phase_hook: Optional[Callable[[str, float], None]] = None
+
+
+def set_phase_hook(hook: Optional[Callable[[str, float], None]]):
+    """Installs (or with None removes) the function that receives the duration of each analysis phase."""
+    global _phase_hook
+    _phase_hook = hook
+
+
+class _PhaseLaps:
+    """Reports the time since the previous lap to the phase hook."""
+    __slots__ = ('hook', 'last')
+
+    def __init__(self, hook: Callable[[str, float], None]):
+        self.hook = hook
+        self.last = perf_counter()
+
+    def __call__(self, phase: str):
+        now = perf_counter()
+        self.hook(phase, now - self.last)
+        self.last = now
+
+
+def _phase_laps() -> Optional[_PhaseLaps]:
+    """A lap timer when a phase hook is installed, otherwise None (so callers only pay for an `if`)."""
+    return _PhaseLaps(_phase_hook) if _phase_hook is not None else None
+
+
+# --- Dates ---
+ISO_DATE_FORMAT = '%Y-%m-%d'
+# Formats tried when inferring how a date is written; add more here if needed, e.g. '%d.%m.%Y'
+DATE_FORMATS = [
+    ISO_DATE_FORMAT,  # e.g., 2018-11-21
+    '%d/%m/%Y',  # e.g., 21/11/2018
+    '%d-%m-%Y',  # e.g., 21-11-2018
+    '%d/%m/%y',  # e.g., 21/11/18
+    '%d-%m-%y',  # e.g., 21-11-18
+    '%d %b %Y',  # e.g., 21 Mar 2019
+]
+# Maps a date string to its "shape": digits become 9 and letters become a, e.g. '21 Mar 2019' -> '99 aaa 9999'
+_SHAPE_TABLE = str.maketrans('0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ', '9' * 10 + 'a' * 52)
+
+
+class DateNormalizer:
+    """
+    Converts dates written in any of DATE_FORMATS to 'YYYY-MM-DD' plus an
+    integer ordinal. The format is inferred once per shape of input (so every
+    '21/11/2018'-style date after the first is parsed with the right format
+    straight away) and results are cached per distinct date string.
+    """
+
+    def __init__(self, formats: List[str] = DATE_FORMATS, max_cache_size: int = 100_000):
+        self.formats = list(formats)
+        self.max_cache_size = max_cache_size
+        self._format_by_shape: Dict[str, str] = {}
+        self._cache: Dict[str, Optional[Tuple[str, int]]] = {}
+
+    def parse(self, value: str) -> Optional[Tuple[str, int]]:
+        """Returns (iso_date, ordinal), or None if the date is not in a known format."""
+        try:
+            return self._cache[value]
+        except KeyError:
+            pass
+        except TypeError:  # Not hashable, so certainly not a date string
+            return None
+        result = self._parse_uncached(value) if isinstance(value, str) else None
+        if len(self._cache) >= self.max_cache_size:
+            self._cache.clear()
+        self._cache[value] = result
+        return result
+
+    def _parse_uncached(self, value: str) -> Optional[Tuple[str, int]]:
+        shape = value.translate(_SHAPE_TABLE)
+        known = self._format_by_shape.get(shape)
+        candidates = [known] + [f for f in self.formats if f != known] if known else self.formats
+        for fmt in candidates:
+            try:
+                parsed = date.fromisoformat(value) if fmt == ISO_DATE_FORMAT and shape == '9999-99-99' \
+                    else datetime.strptime(value, fmt).date()
+            except ValueError:
+                continue
+            self._format_by_shape[shape] = fmt
+            return parsed.isoformat(), parsed.toordinal()
+        return None
+
+    def normalize(self, value: str) -> Tuple[str, int]:
+        """Returns (iso_date, ordinal); unrecognized dates are returned unchanged with ordinal 0."""
+        try:
+            result = self._cache[value]  # Fast path for dates seen before
+        except (KeyError, TypeError):
+            result = self.parse(value)
+        return result if result is not None else (value, 0)
+
+    def normalize_records(self, records: List[dict], key: str = 'date') -> int:
+        """Bulk mode: rewrites the date of every record dict in place, returning how many changed."""
+        changed = 0
+        for record in records:
+            value = record.get(key)
+            if not value:
+                continue
+            result = self.parse(value)
+            if result is not None and result[0] != value:
+                record[key] = result[0]
+                changed += 1
+        return changed
+
+
+# Shared instance, so every part of the app benefits from the same caches
+date_normalizer = DateNormalizer()
+
+
+def normalize_date(value: str) -> str:
+    """Returns the date as 'YYYY-MM-DD'. Raises ValueError for unrecognized dates."""
+    result = date_normalizer.parse(value)
+    if result is None:
+        raise ValueError(f"Unrecognized date: {value!r}")
+    return result[0]
+
 
 # --- Data Structures ---
-@dataclass
-class StockTransaction:
+class TransactionType(str, Enum):
+    """
+    Transaction types. Members are also plain strings, so they compare equal
+    to 'BUY', 'SELL', ... and are written to JSON as those strings.
+    """
+    BUY = 'BUY'
+    SELL = 'SELL'
+    DIVIDEND = 'DIVIDEND'
+    CASH_RETURN = 'CASH_RETURN'
+
+    def __str__(self) -> str:
+        return self.value
+
+
+# Type spellings seen so far -> normalized type, so each record costs one dict lookup
+_TYPE_LOOKUP: Dict[str, Union['TransactionType', str]] = {}
+
+
+def _normalize_type(value) -> Union[TransactionType, str]:
+    """Maps 'buy', 'Buy' etc. to TransactionType; unknown types stay as upper-case strings."""
+    if not isinstance(value, str):
+        return value
+    normalized = value.upper()
+    result = TransactionType(normalized) if normalized in TransactionType.__members__ else sys.intern(normalized)
+    if len(_TYPE_LOOKUP) < 1000:
+        _TYPE_LOOKUP[value] = result
+    return result
+
+
+_INCOME_TYPES = (TransactionType.DIVIDEND, TransactionType.CASH_RETURN)
+_intern = sys.intern
+
+
+class _DerivedFields:
+    """Values derived from a StockTransaction's fields. Kept outside the dataclass fields so they are never serialized."""
+    __slots__ = ('date_ordinal', '_amount')
+
+
+@dataclass(slots=True)
+class StockTransaction(_DerivedFields):
     """Class to represent one stock transaction."""
     symbol: str
     date: str
@@ -26,17 +195,42 @@ class StockTransaction:
     closes_lot_number: Optional[str] = None
     profit: Optional[float] = None
 
+    def __post_init__(self):
+        # Normalize the date once; sorting and as-of comparisons use the integer ordinal.
+        self.date, self.date_ordinal = date_normalizer.normalize(self.date)
+        try:
+            self.type = _TYPE_LOOKUP[self.type]
+        except (KeyError, TypeError):
+            self.type = _normalize_type(self.type)
+        # Symbols and lot numbers repeat across many records, so share one string object per value.
+        if type(self.symbol) is str:
+            self.symbol = _intern(self.symbol)
+        if type(self.mylotnumber) is str:
+            self.mylotnumber = _intern(self.mylotnumber)
+        if type(self.closes_lot_number) is str:
+            self.closes_lot_number = _intern(self.closes_lot_number)
+        # The total amount is computed once here. Transactions are treated as
+        # immutable after construction: edits replace the whole record.
+        try:
+            self._amount = self._compute_total_amount()
+        except TypeError:  # e.g. a BUY without a volume; reported when the amount is used
+            self._amount = None
+
     def get_total_amount(self) -> float:
         """Calculates the total amount if not present in the data."""
+        amount = self._amount
+        return amount if amount is not None else self._compute_total_amount()
+
+    def _compute_total_amount(self) -> float:
         if self.total_amount is not None:
             return self.total_amount
         
         # Fallback calculation logic for older data formats or incomplete entries
-        if self.type.upper() == 'BUY':
+        if self.type is TransactionType.BUY:
             return (self.volume * self.price_per_unit) + self.commission
-        elif self.type.upper() == 'SELL':
+        elif self.type is TransactionType.SELL:
             return (self.volume * self.price_per_unit) - self.commission
-        elif self.type.upper() in ['DIVIDEND', 'CASH_RETURN']:
+        elif self.type in _INCOME_TYPES:
             # If total_amount is missing, try to calculate from volume and price_per_unit
             if self.volume is not None and self.price_per_unit is not None:
                 return self.volume * self.price_per_unit
@@ -74,93 +268,1095 @@ class ClosedTrade:
     remaining_in_lot_after_sale: int
     is_lot_fully_sold: bool = False
 
-def analyze_portfolio_by_lot(portfolio: List[StockTransaction]) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+class _LotState:
+    """Per-lot bookkeeping while replaying transactions; the BUY itself is never mutated."""
+    __slots__ = ('buy', 'buy_key', 'original', 'remaining', 'first_key', 'trade_indices', 'pooled')
+
+    def __init__(self, buy: StockTransaction, key: tuple):
+        self.buy = buy              # The BUY that wins the lot (last one in date order)
+        self.buy_key = key
+        self.original = buy         # The BUY that supplies the original volume/cost (last one in input order)
+        self.remaining = buy.volume
+        self.first_key = key        # (date ordinal, position) of the first BUY with this lot number
+        self.trade_indices: List[int] = []
+        self.pooled = False         # Added to its symbol's lot queue (lot policies other than 'specific')
+
+
+def _lot_cost_per_share(state: _LotState) -> float:
+    """Cost per share of the lot as it stands, the basis a lot-specific sale is charged."""
+    buy = state.buy
+    lot_total = buy.total_amount if buy.total_amount is not None else (state.remaining * buy.price_per_unit) + buy.commission
+    return lot_total / state.remaining
+
+
+def _sell_from_lot(state: _LotState, tx: StockTransaction, cumulative_pl: Dict[str, float],
+                   volume: Optional[int] = None, money_out: Optional[float] = None,
+                   cost_per_share: Optional[float] = None) -> ClosedTrade:
+    """
+    Applies one SELL to its lot and returns the resulting trade. A SELL split
+    across lots passes the `volume` and `money_out` of this lot's part, and an
+    average-cost sale passes the pool's `cost_per_share`.
+    """
+    buy = state.buy
+
+    # --- Logic for Partial Sale ---
+    # Ensure we don't sell more than we have in the lot
+    volume_to_sell = min(tx.volume if volume is None else volume, state.remaining)
+
+    # Cost basis is taken from the lot as it stands before this sale
+    if cost_per_share is None:
+        cost_per_share = _lot_cost_per_share(state)
+    money_in = cost_per_share * volume_to_sell
+
+    if money_out is None:
+        money_out = tx.get_total_amount()
+    realized_pl = money_out - money_in
+
+    cumulative_pl[buy.symbol] += realized_pl
+    state.remaining -= volume_to_sell
+
+    return ClosedTrade(
+        symbol=buy.symbol, buy_date=buy.date, sell_date=tx.date,
+        volume_sold=volume_to_sell, money_in=money_in, money_out=money_out,
+        realized_pl=realized_pl, cumulative_pl_for_symbol=cumulative_pl[buy.symbol],
+        lot_number=buy.mylotnumber,
+        buy_price_per_share=buy.price_per_unit,
+        buy_cost_per_share_incl_comm=cost_per_share,
+        sell_price_per_share=tx.price_per_unit,
+        remaining_in_lot_after_sale=state.remaining,
+        is_lot_fully_sold=state.remaining == 0
+    )
+
+
+# --- Automatic lot selection ---
+# SELLs that name no lot (or a lot that does not exist) are dropped under the
+# default 'specific' policy. The other policies match them against the symbol's
+# open lots, splitting a sale across lots when one is not enough.
+LOT_POLICIES = ('specific', 'fifo', 'lifo', 'hifo', 'average')
+DEFAULT_LOT_POLICY = 'specific'
+
+
+class _FifoLots:
+    """A symbol's open lots, oldest first. Lots are added in date order, so a deque keeps them sorted."""
+    __slots__ = ('lots',)
+
+    def __init__(self):
+        self.lots = deque()
+
+    def add(self, state: _LotState):
+        self.lots.append(state)
+
+    def first(self) -> Optional[_LotState]:
+        """The lot to sell from next; fully sold lots are dropped on the way."""
+        lots = self.lots
+        while lots and lots[0].remaining <= 0:
+            lots.popleft()
+        return lots[0] if lots else None
+
+
+class _LifoLots:
+    """A symbol's open lots, newest first."""
+    __slots__ = ('lots',)
+
+    def __init__(self):
+        self.lots = []
+
+    def add(self, state: _LotState):
+        self.lots.append(state)
+
+    def first(self) -> Optional[_LotState]:
+        lots = self.lots
+        while lots and lots[-1].remaining <= 0:
+            lots.pop()
+        return lots[-1] if lots else None
+
+
+class _HighestCostLots:
+    """A symbol's open lots, highest buy price first (the oldest first among equal prices), in a heap."""
+    __slots__ = ('heap',)
+
+    def __init__(self):
+        self.heap = []
+
+    def add(self, state: _LotState):
+        heapq.heappush(self.heap, (-state.buy.price_per_unit, state.buy_key, state))
+
+    def first(self) -> Optional[_LotState]:
+        heap = self.heap
+        while heap and heap[0][2].remaining <= 0:
+            heapq.heappop(heap)
+        return heap[0][2] if heap else None
+
+
+class _AverageCostLots(_FifoLots):
+    """
+    Average cost: every sale is charged the average cost per share of all the
+    symbol's open shares, which are taken from the oldest lots first.
+    """
+    __slots__ = ('shares', 'cost')
+
+    def __init__(self):
+        super().__init__()
+        self.shares = 0
+        self.cost = 0.0
+
+    def add(self, state: _LotState):
+        super().add(state)
+        self.shares += state.remaining
+        self.cost += _lot_cost_per_share(state) * state.remaining
+
+    def remove(self, volume: int, money_in: float):
+        """Takes sold shares and their cost out of the pool."""
+        self.shares -= volume
+        self.cost = self.cost - money_in if self.shares > 0 else 0.0
+
+
+_LOT_QUEUES = {'fifo': _FifoLots, 'lifo': _LifoLots, 'hifo': _HighestCostLots, 'average': _AverageCostLots}
+
+
+def _lot_queue_type(lot_policy: str):
+    """The open-lot queue class of a policy, or None for 'specific'."""
+    if lot_policy == 'specific':
+        return None
+    try:
+        return _LOT_QUEUES[lot_policy]
+    except KeyError:
+        raise ValueError(f"Unknown lot policy: {lot_policy!r} (expected one of {', '.join(LOT_POLICIES)})") from None
+
+
+@dataclass
+class _AnalysisResult:
+    """Analysis results, each row paired with the (date ordinal, position) key that orders it."""
+    open_lots: List[tuple]
+    closed_trades: List[tuple]
+    total_investment: float
+    total_realized_pl: float
+    total_dividends: float
+    # With keep_terms: the (key, amount) terms of the investment and dividend
+    # totals, so results of several partitions add up in the serial order.
+    investment_terms: Optional[List[tuple]] = None
+    dividend_terms: Optional[List[tuple]] = None
+
+
+def _replay_lots(portfolio: List[StockTransaction], positions: Optional[List] = None,
+                 lot_policy: str = DEFAULT_LOT_POLICY, keep_terms: bool = False) -> _AnalysisResult:
+    """
+    Core of analyze_portfolio_by_lot. Makes one scan in input order to register
+    BUY lots, then a single pass in date order for dividends and sells.
+    `positions` overrides the input index used to break date ties.
+    `keep_terms` is for partitions whose results are combined by _merge_results.
+    """
+    queue_type = _lot_queue_type(lot_policy)
+    laps = _phase_laps()
+    if positions is None:
+        positions = range(len(portfolio))
+    # --- Register lots (input order) ---
+    total_investment = 0
+    investment_terms = [] if keep_terms else None
+    lots: Dict[str, _LotState] = {}
+    for tx, pos in zip(portfolio, positions):
+        if tx.type is not TransactionType.BUY:
+            continue
+        amount = tx.get_total_amount()
+        total_investment += amount
+        if keep_terms:
+            investment_terms.append((pos, amount))
+        if not tx.mylotnumber:
+            continue
+        key = (tx.date_ordinal, pos)
+        state = lots.get(tx.mylotnumber)
+        if state is None:
+            lots[tx.mylotnumber] = _LotState(tx, key)
+            continue
+        # Duplicate lot number: the last BUY in date order supplies the lot,
+        # the last one in input order supplies the original volume and cost.
+        if key > state.buy_key:
+            state.buy, state.buy_key, state.remaining = tx, key, tx.volume
+        state.first_key = min(state.first_key, key)
+        state.original = tx
+
+    if laps:
+        laps('analysis.register_lots')
+
+    # --- Dividends and sells (date order) ---
+    order = sorted(range(len(portfolio)), key=lambda i: portfolio[i].date_ordinal)
+    if laps:
+        laps('analysis.sort')
+    dividends_per_lot: Dict[str, float] = defaultdict(float)
+    first_dividend_keys: Dict[str, tuple] = {}  # With keep_terms: where each lot's dividends enter the total
+    cumulative_pl: Dict[str, float] = defaultdict(float)
+    closed_trades: List[tuple] = []
+    queues = defaultdict(queue_type) if queue_type else None  # symbol -> open lots in policy order
+
+    def record(key: tuple, state: _LotState, trade: ClosedTrade):
+        state.trade_indices.append(len(closed_trades))
+        closed_trades.append((key, trade))
+        # Once the lot is fully sold, flag every earlier trade from it; each index is visited once
+        if state.remaining == 0:
+            for index in state.trade_indices:
+                closed_trades[index][1].is_lot_fully_sold = True
+            state.trade_indices.clear()
+
+    for i in order:
+        tx = portfolio[i]
+        kind = tx.type
+        if kind in _INCOME_TYPES:
+            if tx.closes_lot_number:
+                # The amount is the cash received
+                if keep_terms and tx.closes_lot_number not in dividends_per_lot:
+                    first_dividend_keys[tx.closes_lot_number] = (tx.date_ordinal, positions[i])
+                dividends_per_lot[tx.closes_lot_number] += tx.get_total_amount()
+        elif kind is TransactionType.SELL:
+            state = lots.get(tx.closes_lot_number) if tx.closes_lot_number else None
+            key = (tx.date_ordinal, positions[i])
+            if state is not None and (queues is None or state.remaining > 0):
+                trade = _sell_from_lot(state, tx, cumulative_pl)
+                if state.pooled and queue_type is _AverageCostLots:
+                    queues[state.buy.symbol].remove(trade.volume_sold, trade.money_in)
+                record(key, state, trade)
+            elif queues is not None and tx.volume:
+                # No lot, an unknown lot, or one already emptied by earlier automatic matches.
+                # A named lot decides the symbol sold, as it does for the lot-specific sale
+                # (and for the partition the SELL is in, see IncrementalPortfolioAnalyzer).
+                _sell_by_policy(queues[state.buy.symbol if state is not None else tx.symbol], tx, key, cumulative_pl, record)
+        elif queues is not None and tx.mylotnumber:
+            # A lot can be matched automatically from the date of the BUY that supplies it
+            state = lots[tx.mylotnumber]
+            if state.buy is tx and not state.pooled and state.remaining > 0:
+                state.pooled = True
+                queues[tx.symbol].add(state)
+    if laps:
+        # Dividends and sells share one pass in date order, so they are timed together
+        laps('analysis.dividends_and_sells')
+
+    open_lots = []
+    for state in lots.values():
+        if state.remaining <= 0:
+            continue
+        original = state.original
+        open_lots.append(((state.buy.date_ordinal,) + state.first_key, OpenLot(
+            symbol=state.buy.symbol, buy_date=state.buy.date,
+            original_volume=original.volume,
+            remaining_volume=state.remaining,
+            buy_price=state.buy.price_per_unit,
+            # Cost basis for the *remaining* shares, not the original total cost.
+            total_cost=(original.get_total_amount() / original.volume) * state.remaining if original.volume > 0 else 0,
+            lot_number=state.buy.mylotnumber,
+            dividends_received=dividends_per_lot.get(state.buy.mylotnumber, 0.0)
+        )))
+    open_lots.sort(key=lambda item: item[0])
+    if laps:
+        laps('analysis.open_lots')
+
+    return _AnalysisResult(
+        open_lots=open_lots,
+        closed_trades=closed_trades,
+        total_investment=total_investment,
+        total_realized_pl=sum(trade.realized_pl for _, trade in closed_trades),
+        total_dividends=sum(dividends_per_lot.values()),
+        investment_terms=investment_terms,
+        dividend_terms=[(first_dividend_keys[lot], amount) for lot, amount in dividends_per_lot.items()] if keep_terms else None,
+    )
+
+
+def _merge_results(results: List[_AnalysisResult]) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+    """
+    Combines the results of symbol partitions (replayed with keep_terms) into
+    exactly what one replay of the whole portfolio returns. Rows and total
+    terms are merged by their keys, and the totals are added up in that same
+    order, so even the floating-point rounding is the same.
+    """
+    key = itemgetter(0)
+    open_lots = [lot for _, lot in heapq.merge(*(r.open_lots for r in results), key=key)]
+    closed_trades = [trade for _, trade in heapq.merge(*(r.closed_trades for r in results), key=key)]
+    # Each total is added up with the same construct as in _replay_lots
+    total_investment = 0
+    for _, amount in heapq.merge(*(r.investment_terms for r in results), key=key):
+        total_investment += amount
+    return (
+        open_lots,
+        closed_trades,
+        total_investment,
+        sum(trade.realized_pl for trade in closed_trades),
+        sum(amount for _, amount in heapq.merge(*(r.dividend_terms for r in results), key=key)),
+    )
+
+
+def _sell_by_policy(queue, tx: StockTransaction, key: tuple, cumulative_pl: Dict[str, float], record: Callable):
+    """
+    Matches a SELL without a lot against the symbol's open lots in policy
+    order. Each lot it takes shares from gets its own trade with that part of
+    the proceeds; shares beyond what is held are ignored.
+    """
+    money_out = tx.get_total_amount()
+    average = isinstance(queue, _AverageCostLots)
+    unsold = tx.volume
+    allocated = 0.0
+    part = 0
+    while unsold > 0:
+        state = queue.first()
+        if state is None:
+            break
+        volume = min(unsold, state.remaining)
+        unsold -= volume
+        # The last part gets the rest of the proceeds, so the parts add up exactly
+        part_out = money_out - allocated if unsold == 0 else money_out * volume / tx.volume
+        allocated += part_out
+        cost_per_share = queue.cost / queue.shares if average else None
+        trade = _sell_from_lot(state, tx, cumulative_pl, volume, part_out, cost_per_share)
+        if average:
+            queue.remove(volume, trade.money_in)
+        # Parts of one SELL share its sort key, so later parts get a suffix
+        record(key + (part,) if part else key, state, trade)
+        part += 1
+
+
+# Portfolios at least this large use the NumPy backend when backend='auto'.
+NUMPY_BACKEND_THRESHOLD = 50_000
+
+
+def _use_numpy_backend(backend: str, size: int, lot_policy: str = DEFAULT_LOT_POLICY) -> bool:
+    if backend == 'python':
+        return False
+    if lot_policy != 'specific' and backend == 'auto':
+        return False
+    if backend not in ('auto', 'numpy'):
+        raise ValueError(f"Unknown analysis backend: {backend!r}")
+    import portfolio_columnar
+    if backend == 'numpy':
+        return True
+    return size >= NUMPY_BACKEND_THRESHOLD and portfolio_columnar.is_available()
+
+
+def analyze_portfolio_by_lot(portfolio: List[StockTransaction], backend: str = 'auto',
+                             lot_policy: str = DEFAULT_LOT_POLICY) -> (List[OpenLot], List[ClosedTrade], float, float, float):
     """
     Analyzes portfolio by matching SELLs to specific BUYs using lot numbers.
-    This is NOT FIFO; it relies on the user specifying which lot to close.
+    A SELL that names its lot closes that lot. `lot_policy` decides what
+    happens to a SELL without one (or naming a lot that does not exist, or
+    that automatic matches have already emptied):
+    'specific' ignores it; 'fifo', 'lifo' and 'hifo' (highest buy price first)
+    sell from the symbol's open lots in that order (the symbol of the named
+    lot, if it exists, else the SELL's own); 'average' charges the
+    average cost of all the symbol's open shares and takes them oldest first.
     Returns a tuple of (open_lots, closed_trades, total_investment, total_realized_pl, total_dividends).
+
+    `backend` is 'python', 'numpy' (see portfolio_columnar), 'parallel' (see
+    portfolio_parallel) or 'auto', which picks NumPy for portfolios of at least
+    NUMPY_BACKEND_THRESHOLD transactions when it is installed.
+    The NumPy backend only supports the 'specific' policy.
     """
-    # Use a deep copy to work on a temporary version of the data, preserving the original list
-    transactions = sorted([copy.deepcopy(tx) for tx in portfolio], key=lambda t: t.date)
-    
-    buy_lots_pool: Dict[str, StockTransaction] = {
-        tx.mylotnumber: tx for tx in transactions if tx.type.upper() == 'BUY' and tx.mylotnumber
-    }
-    
-    closed_trades_results: List[ClosedTrade] = []
-    cumulative_pl: Dict[str, float] = defaultdict(float)
-    total_investment = sum(tx.get_total_amount() for tx in portfolio if tx.type.upper() == 'BUY')
+    _lot_queue_type(lot_policy)
+    if backend == 'parallel':
+        from portfolio_parallel import analyze_parallel
+        return analyze_parallel(portfolio, lot_policy=lot_policy)
+    if _use_numpy_backend(backend, len(portfolio), lot_policy):
+        if lot_policy != 'specific':
+            raise ValueError(f"The numpy backend does not support the {lot_policy!r} lot policy")
+        from portfolio_columnar import analyze_columnar
+        laps = _phase_laps()
+        result = analyze_columnar(portfolio)
+        if laps:
+            laps('analysis.columnar')
+        return result
 
-    # --- NEW: Process Dividends ---
-    dividends_per_lot: Dict[str, float] = defaultdict(float)
-    dividend_transactions = [tx for tx in transactions if tx.type.upper() in ['DIVIDEND', 'CASH_RETURN']]
-    for div_tx in dividend_transactions:
-        if div_tx.closes_lot_number:
-            # The amount is the cash received
-            dividends_per_lot[div_tx.closes_lot_number] += div_tx.get_total_amount()
-
-    total_dividends = sum(dividends_per_lot.values())
-
-    sell_transactions = [tx for tx in transactions if tx.type.upper() == 'SELL']
-
-    for sell_tx in sell_transactions:
-        lot_to_close = sell_tx.closes_lot_number
-        if lot_to_close and lot_to_close in buy_lots_pool:
-            buy_lot = buy_lots_pool[lot_to_close]
-            
-            # --- Logic for Partial Sale ---
-            # Ensure we don't sell more than we have in the lot
-            volume_to_sell = min(sell_tx.volume, buy_lot.volume)
-            
-            # Calculate cost basis for the portion being sold
-            cost_per_share = buy_lot.get_total_amount() / buy_lot.volume
-            money_in = cost_per_share * volume_to_sell
-            
-            money_out = sell_tx.get_total_amount()
-            realized_pl = money_out - money_in
-            
-            cumulative_pl[buy_lot.symbol] += realized_pl
-            
-            # Reduce volume *before* creating the trade object to get the remaining amount
-            buy_lot.volume -= volume_to_sell
-            
-            is_lot_now_fully_sold = buy_lot.volume == 0
-
-            closed_trades_results.append(ClosedTrade(
-                symbol=buy_lot.symbol, buy_date=buy_lot.date, sell_date=sell_tx.date,
-                volume_sold=volume_to_sell, money_in=money_in, money_out=money_out,
-                realized_pl=realized_pl, cumulative_pl_for_symbol=cumulative_pl[buy_lot.symbol],
-                lot_number=buy_lot.mylotnumber,
-                buy_price_per_share=buy_lot.price_per_unit,
-                buy_cost_per_share_incl_comm=cost_per_share,
-                sell_price_per_share=sell_tx.price_per_unit,
-                remaining_in_lot_after_sale=buy_lot.volume, # The new remaining volume
-                is_lot_fully_sold=is_lot_now_fully_sold
+    result = _replay_lots(portfolio, lot_policy=lot_policy)
+    return (
+        [lot for _, lot in result.open_lots],
+        [trade for _, trade in result.closed_trades],
+        result.total_investment,
+        result.total_realized_pl,
+        result.total_dividends,
+    )
+
+
+# --- Streaming JSON Input ---
+class PortfolioFormatError(ValueError):
+    """The portfolio JSON is malformed or contains an invalid transaction."""
+
+
+class PortfolioTooLargeError(PortfolioFormatError):
+    """The portfolio JSON is larger than the allowed maximum size."""
+
+
+def require_known_date(tx: StockTransaction, number: int) -> StockTransaction:
+    """
+    Raises PortfolioFormatError if the date of transaction `number` (1-based)
+    matches none of DATE_FORMATS; it would otherwise sort before all history.
+    """
+    if not tx.date_ordinal:
+        raise PortfolioFormatError(f"Transaction {number} has an unrecognized date: {tx.date!r}")
+    return tx
+
+
+_WHITESPACE = ' \t\n\r'
+
+
+def iter_portfolio_json(stream: BinaryIO, max_bytes: Optional[int] = None, chunk_size: int = 64 * 1024) -> Iterator[StockTransaction]:
+    """
+    Reads a JSON array of transactions from a binary stream chunk by chunk and
+    yields one StockTransaction per element, so the raw bytes, the decoded text
+    and the list of dicts never have to be held in memory all at once.
+    Raises PortfolioFormatError for malformed input and PortfolioTooLargeError
+    once more than `max_bytes` have been read.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    pos = 0
+    bytes_read = 0
+    eof = False
+
+    def fill() -> bool:
+        """Appends the next chunk to the buffer; False once the stream is exhausted."""
+        nonlocal buffer, pos, bytes_read, eof
+        if eof:
+            return False
+        chunk = stream.read(chunk_size)
+        bytes_read += len(chunk)
+        if max_bytes is not None and bytes_read > max_bytes:
+            raise PortfolioTooLargeError(f"Portfolio is larger than the maximum of {max_bytes:,} bytes")
+        try:
+            text = utf8.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            raise PortfolioFormatError(f"Portfolio is not valid UTF-8: {e}") from None
+        buffer = buffer[pos:] + text
+        pos = 0
+        eof = not chunk
+        return True
+
+    def next_char() -> str:
+        """Skips whitespace and returns the next character without consuming it ('' at the end)."""
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return buffer[pos:pos + 1]
+
+    if next_char() == '\ufeff':
+        pos += 1
+    if next_char() != '[':
+        raise PortfolioFormatError("Portfolio must be a JSON array of transactions")
+    pos += 1
+
+    index = 0
+    # Reading and decoding vs. building StockTransactions, when a phase hook is installed
+    hook = _phase_hook
+    decode_seconds = build_seconds = 0.0
+    if next_char() == ']':
+        pos += 1
+    else:
+        while True:
+            started = perf_counter() if hook else 0.0
+            next_char()
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                    break
+                except json.JSONDecodeError as e:
+                    # The element may simply be cut off at the end of the buffer.
+                    if not fill():
+                        raise PortfolioFormatError(f"Malformed JSON in transaction {index + 1}: {e.msg}") from None
+            pos = end
+            if not isinstance(item, dict):
+                raise PortfolioFormatError(f"Transaction {index + 1} is not a JSON object")
+            try:
+                if hook:
+                    decoded = perf_counter()
+                    tx = StockTransaction(**item)
+                    built = perf_counter()
+                    decode_seconds += decoded - started
+                    build_seconds += built - decoded
+                else:
+                    tx = StockTransaction(**item)
+            except TypeError as e:
+                raise PortfolioFormatError(f"Invalid transaction {index + 1}: {e}") from None
+            yield require_known_date(tx, index + 1)
+            index += 1
+
+            separator = next_char()
+            pos += 1
+            if separator == ']':
+                break
+            if separator != ',':
+                raise PortfolioFormatError(f"Expected ',' or ']' after transaction {index}")
+
+    if next_char():
+        raise PortfolioFormatError("Unexpected data after the end of the portfolio array")
+    if hook:
+        hook('upload.json_decode', decode_seconds)
+        hook('upload.build_transactions', build_seconds)
+
+
+# --- Incremental Analysis ---
+def _lot_key(tx: StockTransaction) -> Optional[str]:
+    """The lot a transaction belongs to: its own lot for BUYs, the lot it closes otherwise."""
+    if tx.type is TransactionType.BUY:
+        return tx.mylotnumber or None
+    return tx.closes_lot_number or None
+
+
+class _MergedRows:
+    """
+    One kind of (key, value) row of every partition, merged by key as in
+    _merge_results, that is patched after replays instead of merged again.
+    `amount`, if given, picks the number each row adds to its total; they
+    are kept in `amounts`.
+    """
+    __slots__ = ('keys', 'values', 'amounts', 'amount')
+
+    def __init__(self, amount: Optional[Callable] = None):
+        self.keys: list = []
+        self.values: list = []
+        self.amounts: Optional[list] = [] if amount else None
+        self.amount = amount
+
+    def update(self, changes: List[tuple], parts: List[list]) -> int:
+        """
+        Takes the (old rows, new rows) of each replayed partition and the rows
+        of every partition as they are now. A row that kept its key is replaced
+        where it is; from the first key that was added or removed on, the rows
+        of all partitions are merged again. Returns the first index whose value
+        may have changed (the length when none did).
+        """
+        keys, values = self.keys, self.values
+        start = None  # Smallest key added or removed
+        replaced = []
+        for old, new in changes:
+            same = 0
+            shortest = min(len(old), len(new))
+            while same < shortest and old[same][0] == new[same][0]:
+                same += 1
+            if same < len(old) or same < len(new):
+                first_key = min(rows[same][0] for rows in (old, new) if same < len(rows))
+                start = first_key if start is None else min(start, first_key)
+            replaced.extend(new[i] for i in range(same) if old[i][1] != new[i][1])
+
+        first = len(keys)
+        for key, value in replaced:
+            if start is not None and key >= start:
+                continue  # Merged again below
+            index = bisect_left(keys, key)
+            values[index] = value
+            if self.amounts is not None:
+                self.amounts[index] = self.amount(value)
+            first = min(first, index)
+        if start is not None:
+            index = bisect_left(keys, start)
+            tails = [rows[bisect_left(rows, start, key=itemgetter(0)):] for rows in parts]
+            merged = list(heapq.merge(*tails, key=itemgetter(0)))
+            keys[index:] = [key for key, _ in merged]
+            values[index:] = [value for _, value in merged]
+            if self.amounts is not None:
+                self.amounts[index:] = [self.amount(value) for _, value in merged]
+            first = min(first, index)
+        return first
+
+
+class IncrementalPortfolioAnalyzer:
+    """
+    Keeps a portfolio and its analysis in memory so that edits only replay the
+    symbol they touch instead of the whole history.
+
+    Lot matching, dividends and cumulative P/L never cross symbols, so the
+    portfolio is split into partitions keyed by the symbol that owns each lot.
+    Transactions are addressed by their position in the portfolio list, which
+    is the same index the web page uses for its transaction log. Each one also
+    has a rank that sorts like its position (an insert between two ranks gets
+    the exact midpoint), so date ties are broken in list order without
+    renumbering the others.
+
+    `lot_policy` is passed on to every replay, as in analyze_portfolio_by_lot.
+    A SELL matched by the policy is in its own symbol's partition, unless it
+    names an existing lot: then, like the lot-specific sale, it is in the
+    partition of the lot's symbol and falls back to that symbol's open lots.
+
+    The merged analysis is kept between calls. Only the rows of replayed
+    partitions are swapped in, and rows are merged again (and the investment
+    total added up again) only from the earliest key that was added or
+    removed, so an edit to recent history costs little however long the
+    portfolio is. Realized P/L and dividends are re-added with sum() over the
+    kept amounts, like the full analysis does.
+    """
+
+    def __init__(self, portfolio: Optional[List[StockTransaction]] = None, lot_policy: str = DEFAULT_LOT_POLICY):
+        _lot_queue_type(lot_policy)
+        self.lot_policy = lot_policy
+        self._next_seq = 0
+        self._next_rank = 0
+        self._order: List[int] = []  # position -> sequence id
+        self._rank: Dict[int, Union[int, Fraction]] = {}  # sequence id -> rank
+        self._transactions: Dict[int, StockTransaction] = {}
+        self._partition_of: Dict[int, str] = {}
+        self._partitions: Dict[str, set] = defaultdict(set)
+        self._lot_refs: Dict[str, set] = defaultdict(set)  # lot number -> sequence ids
+        self._lot_owner: Dict[str, str] = {}  # lot number -> symbol of the BUY that wins the pool
+        self._results: Dict[str, _AnalysisResult] = {}
+        self._dirty: set = set()
+        # Merged analysis: partitions replayed since the last merge -> their result as merged (None if new)
+        self._unmerged: Dict[str, Optional[_AnalysisResult]] = {}
+        self._open_lots = _MergedRows()
+        self._closed_trades = _MergedRows(attrgetter('realized_pl'))
+        self._investment_terms = _MergedRows()
+        self._investment_totals: list = []  # Running investment total after each term
+        self._dividend_terms = _MergedRows()
+        self._analysis = None
+        for tx in portfolio or []:
+            self._add(tx)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    @property
+    def transactions(self) -> List[StockTransaction]:
+        return [self._transactions[seq] for seq in self._order]
+
+    # --- Deltas ---
+    def insert(self, tx: StockTransaction, index: Optional[int] = None):
+        """Inserts a transaction at `index` (appends when omitted)."""
+        if index is not None and index < 0:
+            index = max(0, index + len(self._order))
+        if index is None or index >= len(self._order):
+            self._add(tx)
+            return
+        after = self._rank[self._order[index]]
+        before = self._rank[self._order[index - 1]] if index > 0 else after - 1
+        middle = Fraction(before + after, 2)
+        self._add(tx, index, int(middle) if middle.denominator == 1 else middle)
+
+    def update(self, index: int, tx: StockTransaction):
+        """Replaces the transaction at `index`."""
+        seq = self._order[index]
+        old_tx = self._transactions[seq]
+        self._detach(seq, old_tx)
+        self._attach(seq, tx)
+        self._refresh_lots({_lot_key(old_tx), _lot_key(tx)})
+
+    def delete(self, index: int):
+        """Removes the transaction at `index`."""
+        seq = self._order.pop(index)
+        tx = self._transactions[seq]
+        self._detach(seq, tx)
+        del self._transactions[seq]
+        del self._rank[seq]
+        self._refresh_lots({_lot_key(tx)})
+
+    def apply_changes(self, changes: List[dict]):
+        """
+        Applies a list of delta operations, in order. Each change is a dict with
+        an 'op' of 'insert', 'update' or 'delete', an 'index' (optional for
+        inserts) and, except for deletes, a 'transaction' dict. A transaction
+        with an unrecognized date raises PortfolioFormatError, numbered by change.
+        """
+        for number, change in enumerate(changes, 1):
+            op = change.get('op')
+            if op == 'insert':
+                self.insert(require_known_date(StockTransaction(**change['transaction']), number), change.get('index'))
+            elif op == 'update':
+                self.update(change['index'], require_known_date(StockTransaction(**change['transaction']), number))
+            elif op == 'delete':
+                self.delete(change['index'])
+            else:
+                raise ValueError(f"Unknown change op: {op!r}")
+
+    # --- Results ---
+    def analyze(self) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+        """Returns the same tuple as analyze_portfolio_by_lot, replaying only changed partitions."""
+        self._replay_changed()
+        if self._analysis is None or self._unmerged:
+            laps = _phase_laps()
+            self._merge_changed()
+            if laps:
+                laps('analysis.merge')
+        open_lots, closed_trades, total_investment, total_realized_pl, total_dividends = self._analysis
+        return list(open_lots), list(closed_trades), total_investment, total_realized_pl, total_dividends
+
+    def _merge_changed(self):
+        """Brings the merged analysis up to date with the partitions replayed since the last merge."""
+        old = self._unmerged
+        results = list(self._results.values())
+
+        def update(rows: _MergedRows, field: str) -> int:
+            changes = [(getattr(result, field) if result else [],
+                        getattr(self._results[key], field) if key in self._results else [])
+                       for key, result in old.items()]
+            return rows.update(changes, [getattr(result, field) for result in results])
+
+        update(self._open_lots, 'open_lots')
+        update(self._closed_trades, 'closed_trades')
+        update(self._dividend_terms, 'dividend_terms')
+        # The same running total as _replay_lots, continued from the first changed term
+        first = update(self._investment_terms, 'investment_terms')
+        totals = self._investment_totals
+        del totals[first:]
+        total_investment = totals[-1] if totals else 0
+        for amount in self._investment_terms.values[first:]:
+            total_investment += amount
+            totals.append(total_investment)
+        old.clear()
+        self._analysis = (
+            self._open_lots.values,
+            self._closed_trades.values,
+            total_investment,
+            sum(self._closed_trades.amounts),
+            sum(self._dividend_terms.values),
+        )
+
+    # --- Internals ---
+    def _replay_changed(self) -> set:
+        """Replays the partitions changed since the last call and returns their keys."""
+        changed = set(self._dirty)
+        for key in changed:
+            self._unmerged.setdefault(key, self._results.get(key))
+            members = self._partitions.get(key)
+            if members:
+                seqs = sorted(members, key=self._rank.__getitem__)
+                self._results[key] = _replay_lots([self._transactions[seq] for seq in seqs],
+                                                  [self._rank[seq] for seq in seqs], self.lot_policy, keep_terms=True)
+            else:
+                self._results.pop(key, None)
+        self._dirty.clear()
+        return changed
+
+    def _add(self, tx: StockTransaction, index: Optional[int] = None, rank: Union[int, Fraction, None] = None) -> int:
+        seq = self._next_seq
+        self._next_seq += 1
+        if rank is None:
+            rank = self._next_rank
+            self._next_rank += 1
+        self._rank[seq] = rank
+        if index is None:
+            self._order.append(seq)
+        else:
+            self._order.insert(index, seq)
+        self._attach(seq, tx)
+        self._refresh_lots({_lot_key(tx)})
+        return seq
+
+    def _attach(self, seq: int, tx: StockTransaction):
+        self._transactions[seq] = tx
+        lot = _lot_key(tx)
+        if lot:
+            self._lot_refs[lot].add(seq)
+        self._place(seq)
+
+    def _detach(self, seq: int, tx: StockTransaction):
+        lot = _lot_key(tx)
+        if lot:
+            self._lot_refs[lot].discard(seq)
+            if not self._lot_refs[lot]:
+                del self._lot_refs[lot]
+        key = self._partition_of.pop(seq)
+        self._partitions[key].discard(seq)
+        self._dirty.add(key)
+
+    def _partition_key(self, tx: StockTransaction) -> str:
+        lot = _lot_key(tx)
+        return self._lot_owner.get(lot, tx.symbol) if lot else tx.symbol
+
+    def _place(self, seq: int):
+        """(Re)assigns a transaction to the partition it currently belongs to."""
+        key = self._partition_key(self._transactions[seq])
+        old_key = self._partition_of.get(seq)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self._partitions[old_key].discard(seq)
+            self._dirty.add(old_key)
+        self._partition_of[seq] = key
+        self._partitions[key].add(seq)
+        self._dirty.add(key)
+
+    def _refresh_lots(self, lots: set):
+        """Recomputes lot ownership and moves every transaction that references a lot whose owner changed."""
+        for lot in lots:
+            if not lot:
+                continue
+            # Like the BUY pool in analyze_portfolio_by_lot, the last BUY in date order wins.
+            buys = [
+                (self._transactions[seq].date_ordinal, self._rank[seq], seq) for seq in self._lot_refs.get(lot, ())
+                if self._transactions[seq].type is TransactionType.BUY
+            ]
+            owner = self._transactions[max(buys)[2]].symbol if buys else None
+            if owner == self._lot_owner.get(lot):
+                continue
+            if owner is None:
+                del self._lot_owner[lot]
+            else:
+                self._lot_owner[lot] = owner
+            for seq in self._lot_refs.get(lot, ()):
+                self._place(seq)
+
+
+# --- Point-in-time (As-of) Analysis ---
+class _Checkpoint:
+    """Replay state after the first `position` transactions in date order."""
+    __slots__ = ('position', 'trade_count', 'remaining', 'cumulative_pl')
+
+    def __init__(self, position: int, trade_count: int, remaining: Dict[str, int], cumulative_pl: Dict[str, float]):
+        self.position = position
+        self.trade_count = trade_count
+        self.remaining = remaining  # Only lots that still hold (or owe) shares; all others are at 0
+        self.cumulative_pl = cumulative_pl
+
+
+def _month_of(ordinal: int) -> Optional[tuple]:
+    if ordinal <= 0:
+        return None
+    day = date.fromordinal(ordinal)
+    return day.year, day.month
+
+
+class HoldingsTimeline:
+    """
+    Answers "what did I hold and what was my realized P/L as of date X" without
+    re-analyzing the whole history for every date. as_of(X) returns the same
+    tuple as analyze_portfolio_by_lot on only the transactions dated on or
+    before X.
+
+    Those transactions are a prefix of the date order in which the analysis
+    replays sells and dividends, so the replay is run once and the open lots
+    are checkpointed every `checkpoint_every` transactions (or at the start of
+    each month with checkpoint_every='month'). A query binary-searches for the
+    last checkpoint before X and replays only the transactions between the two.
+    Adding a transaction dated before ones already replayed drops the
+    checkpoints after it; they are rebuilt on the next query. Each checkpoint
+    holds the lots open at that point, so fewer checkpoints use less memory
+    and more make queries replay less.
+
+    If a lot number is used by more than one BUY, or a SELL is dated before the
+    BUY of its lot, the prefix property does not hold and as_of() falls back to
+    analyzing the truncated history in full.
+    """
+
+    def __init__(self, portfolio: Optional[List[StockTransaction]] = None, checkpoint_every: Union[int, str] = 5000):
+        if checkpoint_every != 'month' and (not isinstance(checkpoint_every, int) or checkpoint_every <= 0):
+            raise ValueError("checkpoint_every must be a positive number of transactions or 'month'")
+        self.checkpoint_every = checkpoint_every
+        self._transactions: List[StockTransaction] = []  # Input order
+        self._buys: List[StockTransaction] = []  # BUYs in input order, for total_investment
+        self._sorted: List[StockTransaction] = []  # Date order, ties in input order
+        self._sorted_ordinals: List[int] = []
+        self._lot_buy_key: Dict[str, tuple] = {}  # Lot number -> (date ordinal, position) of its BUY
+        self._first_sell_key: Dict[str, tuple] = {}  # Lot number -> key of the earliest SELL from it
+        self._replay_safe = True
+        self._reset()
+        for tx in portfolio or []:
+            self.add(tx)
+
+    def __len__(self) -> int:
+        return len(self._transactions)
+
+    @property
+    def transactions(self) -> List[StockTransaction]:
+        return list(self._transactions)
+
+    def add(self, tx: StockTransaction):
+        """Appends a transaction; a back-dated one invalidates the checkpoints after its date."""
+        key = (tx.date_ordinal, len(self._transactions))
+        self._transactions.append(tx)
+        if tx.type is TransactionType.BUY:
+            self._buys.append(tx)
+            lot = tx.mylotnumber
+            if lot:
+                if lot in self._lot_buy_key or key > self._first_sell_key.get(lot, key):
+                    self._replay_safe = False
+                self._lot_buy_key.setdefault(lot, key)
+        elif tx.type is TransactionType.SELL and tx.closes_lot_number:
+            lot = tx.closes_lot_number
+            if self._lot_buy_key.get(lot, key) > key:
+                self._replay_safe = False
+            first = self._first_sell_key.get(lot)
+            if first is None or key < first:
+                self._first_sell_key[lot] = key
+
+        index = bisect_right(self._sorted_ordinals, tx.date_ordinal)
+        self._sorted.insert(index, tx)
+        self._sorted_ordinals.insert(index, tx.date_ordinal)
+        if index < self._built:
+            while self._checkpoints[-1].position > index:
+                self._checkpoints.pop()
+            self._restore(self._checkpoints[-1])
+
+    def count_as_of(self, as_of_date: Union[str, date]) -> int:
+        """Number of transactions dated on or before the given date."""
+        return bisect_right(self._sorted_ordinals, self._ordinal(as_of_date))
+
+    def as_of(self, as_of_date: Union[str, date]) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+        """Same tuple as analyze_portfolio_by_lot for the transactions dated on or before `as_of_date`."""
+        limit = self._ordinal(as_of_date)
+        if not self._replay_safe:
+            return analyze_portfolio_by_lot([tx for tx in self._transactions if tx.date_ordinal <= limit])
+
+        self._build()
+        end = bisect_right(self._sorted_ordinals, limit)
+        if self._failure is not None and end > self._built:
+            raise ZeroDivisionError(*self._failure.args)
+
+        # --- Replay the tail after the nearest checkpoint ---
+        checkpoint = self._checkpoints[bisect_right(self._checkpoints, end, key=attrgetter('position')) - 1]
+        remaining = dict(checkpoint.remaining)
+        for tx in self._sorted[checkpoint.position:end]:
+            kind = tx.type
+            if kind is TransactionType.BUY:
+                if tx.mylotnumber:
+                    remaining[tx.mylotnumber] = tx.volume
+            elif kind is TransactionType.SELL:
+                lot = tx.closes_lot_number
+                if lot in self._lots:  # Registered before this sell, since SELLs follow their BUY here
+                    left = remaining.get(lot, 0)
+                    remaining[lot] = left - min(tx.volume, left)
+
+        # --- Dividends: each lot's running total at the date, summed in first-dividend order ---
+        dividends_per_lot = {}
+        for lot in self._dividend_lots[:bisect_left(self._dividend_first_positions, end)]:
+            positions, totals = self._dividend_history[lot]
+            dividends_per_lot[lot] = totals[bisect_left(positions, end) - 1]
+
+        # --- Trades up to the date, flagged by whether their lot was sold out by then ---
+        trade_count = bisect_left(self._trade_positions, end)
+        closed_trades = []
+        for trade in self._trades[:trade_count]:
+            fully_sold = remaining.get(trade.lot_number, 0) == 0
+            if trade.is_lot_fully_sold != fully_sold:
+                trade = copy(trade)
+                trade.is_lot_fully_sold = fully_sold
+            closed_trades.append(trade)
+
+        # Lots are registered in date order, which is also the order of the open lots
+        open_lots = []
+        for lot in self._lot_numbers[:bisect_left(self._lot_positions, end)]:
+            left = remaining.get(lot, 0)
+            if left <= 0:
+                continue
+            buy = self._lots[lot].buy
+            open_lots.append(OpenLot(
+                symbol=buy.symbol, buy_date=buy.date,
+                original_volume=buy.volume,
+                remaining_volume=left,
+                buy_price=buy.price_per_unit,
+                total_cost=(buy.get_total_amount() / buy.volume) * left if buy.volume > 0 else 0,
+                lot_number=buy.mylotnumber,
+                dividends_received=dividends_per_lot.get(lot, 0.0)
             ))
-            
-            # If the lot is now fully sold, go back and update all previous trades for this lot
-            if is_lot_now_fully_sold:
-                for trade in closed_trades_results:
-                    if trade.lot_number == lot_to_close:
-                        trade.is_lot_fully_sold = True
-
-    # The remaining lots in the pool (with volume > 0) are the open lots
-    # We need the original portfolio to get the original volume
-    original_buy_lots = {tx.mylotnumber: tx for tx in portfolio if tx.type.upper() == 'BUY' and tx.mylotnumber}
-
-    open_lots_results = [
-        OpenLot(
-            symbol=lot.symbol, buy_date=lot.date,
-            original_volume=original_buy_lots[lot.mylotnumber].volume,
-            remaining_volume=lot.volume,
-            buy_price=lot.price_per_unit,
-            # FIX: Calculate cost basis for the *remaining* shares, not the original total cost.
-            total_cost=(original_buy_lots[lot.mylotnumber].get_total_amount() / original_buy_lots[lot.mylotnumber].volume) * lot.volume if original_buy_lots[lot.mylotnumber].volume > 0 else 0,
-            lot_number=lot.mylotnumber,
-            dividends_received=dividends_per_lot.get(lot.mylotnumber, 0.0)
-        ) for lot in buy_lots_pool.values() if lot.volume > 0
-    ]
-    
-    total_realized_pl = sum(trade.realized_pl for trade in closed_trades_results)
-    
-    return sorted(open_lots_results, key=lambda x: x.buy_date), sorted(closed_trades_results, key=lambda x: x.sell_date), total_investment, total_realized_pl, total_dividends
\ No newline at end of file
+
+        return (
+            open_lots,
+            closed_trades,
+            sum(tx.get_total_amount() for tx in self._buys if tx.date_ordinal <= limit),
+            self._realized[trade_count],
+            sum(dividends_per_lot.values()),
+        )
+
+    # --- Internals ---
+    @staticmethod
+    def _ordinal(as_of_date: Union[str, date]) -> int:
+        if isinstance(as_of_date, date):
+            return as_of_date.toordinal()
+        result = date_normalizer.parse(as_of_date)
+        if result is None:
+            raise ValueError(f"Unrecognized date: {as_of_date!r}")
+        return result[1]
+
+    def _reset(self):
+        self._built = 0  # Transactions (in date order) replayed so far
+        self._lots: Dict[str, _LotState] = {}
+        self._lot_numbers: List[str] = []  # In the order their BUYs were replayed
+        self._lot_positions: List[int] = []  # Replay position of each of those BUYs
+        self._cumulative_pl: Dict[str, float] = defaultdict(float)
+        self._trades: List[ClosedTrade] = []
+        self._trade_positions: List[int] = []
+        self._realized: List[float] = [0]  # _realized[n] is the realized P/L of the first n trades
+        # Lot number -> ([replay positions], [running dividend total after each])
+        self._dividend_history: Dict[str, Tuple[List[int], List[float]]] = {}
+        self._dividend_lots: List[str] = []  # In the order of their first dividend
+        self._dividend_first_positions: List[int] = []
+        self._failure: Optional[ZeroDivisionError] = None
+        self._checkpoints: List[_Checkpoint] = [_Checkpoint(0, 0, {}, {})]
+
+    def _restore(self, checkpoint: _Checkpoint):
+        """Rewinds the replay to a checkpoint."""
+        position = checkpoint.position
+        self._built = position
+        lot_count = bisect_left(self._lot_positions, position)
+        for lot in self._lot_numbers[lot_count:]:
+            del self._lots[lot]
+        del self._lot_numbers[lot_count:]
+        del self._lot_positions[lot_count:]
+        for lot, state in self._lots.items():
+            state.remaining = checkpoint.remaining.get(lot, 0)
+        self._cumulative_pl = defaultdict(float, checkpoint.cumulative_pl)
+        del self._trades[checkpoint.trade_count:]
+        del self._trade_positions[checkpoint.trade_count:]
+        del self._realized[checkpoint.trade_count + 1:]
+
+        lot_count = bisect_left(self._dividend_first_positions, position)
+        for lot in self._dividend_lots[lot_count:]:
+            del self._dividend_history[lot]
+        del self._dividend_lots[lot_count:]
+        del self._dividend_first_positions[lot_count:]
+        for positions, totals in self._dividend_history.values():
+            if positions[-1] >= position:
+                keep = bisect_left(positions, position)
+                del positions[keep:]
+                del totals[keep:]
+        self._failure = None
+
+    def _checkpoint(self, position: int):
+        self._checkpoints.append(_Checkpoint(
+            position, len(self._trades),
+            {lot: state.remaining for lot, state in self._lots.items() if state.remaining},
+            dict(self._cumulative_pl),
+        ))
+
+    def _build(self):
+        """Replays the transactions not replayed yet, saving checkpoints along the way."""
+        if self._failure is not None:
+            return
+        monthly = self.checkpoint_every == 'month'
+        position = self._built
+        last_ordinal = self._sorted_ordinals[position - 1] if position else None
+        month = previous_month = _month_of(last_ordinal) if monthly and position else None
+        while position < len(self._sorted):
+            tx = self._sorted[position]
+            if monthly:
+                if tx.date_ordinal != last_ordinal:
+                    last_ordinal, month = tx.date_ordinal, _month_of(tx.date_ordinal)
+                if month != previous_month and position > self._checkpoints[-1].position:
+                    self._checkpoint(position)
+                previous_month = month
+            elif position - self._checkpoints[-1].position >= self.checkpoint_every:
+                self._checkpoint(position)
+
+            kind = tx.type
+            if kind is TransactionType.BUY:
+                if tx.mylotnumber:
+                    self._lots[tx.mylotnumber] = _LotState(tx, (tx.date_ordinal, position))
+                    self._lot_numbers.append(tx.mylotnumber)
+                    self._lot_positions.append(position)
+            elif kind in _INCOME_TYPES:
+                lot = tx.closes_lot_number
+                if lot:
+                    history = self._dividend_history.get(lot)
+                    if history is None:
+                        history = self._dividend_history[lot] = ([], [])
+                        self._dividend_lots.append(lot)
+                        self._dividend_first_positions.append(position)
+                    positions, totals = history
+                    totals.append((totals[-1] if totals else 0.0) + tx.get_total_amount())
+                    positions.append(position)
+            elif kind is TransactionType.SELL:
+                state = self._lots.get(tx.closes_lot_number) if tx.closes_lot_number else None
+                if state is not None:
+                    try:
+                        trade = _sell_from_lot(state, tx, self._cumulative_pl)
+                    except ZeroDivisionError as e:
+                        # Selling from an empty lot: analyses that include this sell fail the same way
+                        self._failure = e
+                        break
+                    self._trades.append(trade)
+                    self._trade_positions.append(position)
+                    self._realized.append(self._realized[-1] + trade.realized_pl)
+            position += 1
+        self._built = position
@@ -0,0 +1,158 @@
+"""
+Symbol-partitioned backend for analyze_portfolio_by_lot, on several processes.
+
+Lot matching, dividends and cumulative P/L never cross symbols, so the
+portfolio is split into one partition per symbol (a transaction that refers to
+a lot goes with the symbol that owns the lot, as in
+IncrementalPortfolioAnalyzer). Partitions are replayed in worker processes and
+their rows and totals merged back in the serial order, so the result is
+exactly what the pure Python analysis returns, floating-point rounding
+included.
+
+One symbol often holds most of a portfolio, so partitions are grouped into
+chunks of about equal size, largest first (a partition is never split).
+Portfolios smaller than PARALLEL_ANALYSIS_MIN_TRANSACTIONS, or with a single
+partition, are analyzed serially.
+
+Workers are forked when the caller has no other threads, so they share the
+portfolio without copying it; otherwise (e.g. inside the web server) they are
+spawned and each chunk's transactions are sent to them.
+
+Configuration (environment variables):
+    PARALLEL_ANALYSIS_WORKERS          worker processes (default: CPU count)
+    PARALLEL_ANALYSIS_MIN_TRANSACTIONS smallest portfolio analyzed in
+                                       parallel (default: 200000)
+"""
+import heapq
+import multiprocessing
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from operator import attrgetter
+from typing import List, Optional
+
+from portfolio_lib import (
+    StockTransaction, TransactionType, OpenLot, ClosedTrade, DEFAULT_LOT_POLICY,
+    analyze_portfolio_by_lot, _AnalysisResult, _replay_lots, _merge_results, _lot_key, _phase_laps,
+)
+
+PARALLEL_ANALYSIS_WORKERS = int(os.environ.get('PARALLEL_ANALYSIS_WORKERS', os.cpu_count() or 1))
+PARALLEL_ANALYSIS_MIN_TRANSACTIONS = int(os.environ.get('PARALLEL_ANALYSIS_MIN_TRANSACTIONS', 200_000))
+# Chunks per worker: more chunks even out the load, fewer cost less to send
+CHUNKS_PER_WORKER = 4
+
+# The portfolio being analyzed, inherited by forked workers
+_shared_portfolio: Optional[List[StockTransaction]] = None
+
+# Rows travel back from the workers as tuples of field values, which pickle in
+# about half the time of the dataclasses themselves.
+_open_lot_values = attrgetter(*(f.name for f in fields(OpenLot)))
+_closed_trade_values = attrgetter(*(f.name for f in fields(ClosedTrade)))
+
+
+def partition_by_symbol(portfolio: List[StockTransaction]) -> List[List[int]]:
+    """The positions of each symbol's transactions, in input order."""
+    # A lot belongs to the symbol of its last BUY in date order, the one that supplies it in the analysis
+    owners = {}
+    for position, tx in enumerate(portfolio):
+        if tx.type is TransactionType.BUY and tx.mylotnumber:
+            key = (tx.date_ordinal, position)
+            owner = owners.get(tx.mylotnumber)
+            if owner is None or key > owner[0]:
+                owners[tx.mylotnumber] = (key, tx.symbol)
+
+    partitions = defaultdict(list)
+    for position, tx in enumerate(portfolio):
+        owner = owners.get(_lot_key(tx))
+        partitions[owner[1] if owner else tx.symbol].append(position)
+    return list(partitions.values())
+
+
+def plan_chunks(sizes: List[int], chunks: int) -> List[List[int]]:
+    """
+    Groups partitions (given by size) into at most `chunks` chunks of about
+    equal total size: each partition, largest first, goes to the smallest
+    chunk so far. Chunks are returned largest first.
+    """
+    loads = [(0, chunk) for chunk in range(max(1, chunks))]
+    plan = [[] for _ in loads]
+    for index in sorted(range(len(sizes)), key=sizes.__getitem__, reverse=True):
+        load, chunk = heapq.heappop(loads)
+        plan[chunk].append(index)
+        heapq.heappush(loads, (load + sizes[index], chunk))
+    plan.sort(key=lambda indexes: sum(sizes[i] for i in indexes), reverse=True)
+    return [indexes for indexes in plan if indexes]
+
+
+def _replay_partitions(partitions: List[List[int]], lot_policy: str,
+                       transactions: Optional[List[List[StockTransaction]]] = None) -> list:
+    """Worker: replays each partition, taking its transactions from the shared portfolio unless they were sent."""
+    packed = []
+    for index, positions in enumerate(partitions):
+        if transactions is not None:
+            partition = transactions[index]
+        else:
+            partition = [_shared_portfolio[position] for position in positions]
+        result = _replay_lots(partition, positions, lot_policy, keep_terms=True)
+        packed.append((
+            [(key, _open_lot_values(lot)) for key, lot in result.open_lots],
+            [(key, _closed_trade_values(trade)) for key, trade in result.closed_trades],
+            result.total_investment, result.total_realized_pl, result.total_dividends,
+            result.investment_terms, result.dividend_terms,
+        ))
+    return packed
+
+
+def _unpack(packed: tuple) -> _AnalysisResult:
+    open_lots, closed_trades, investment, realized_pl, dividends, investment_terms, dividend_terms = packed
+    return _AnalysisResult(
+        open_lots=[(key, OpenLot(*values)) for key, values in open_lots],
+        closed_trades=[(key, ClosedTrade(*values)) for key, values in closed_trades],
+        total_investment=investment, total_realized_pl=realized_pl, total_dividends=dividends,
+        investment_terms=investment_terms, dividend_terms=dividend_terms,
+    )
+
+
+def _can_fork() -> bool:
+    return 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1
+
+
+def analyze_parallel(portfolio: List[StockTransaction], workers: Optional[int] = None,
+                     lot_policy: str = DEFAULT_LOT_POLICY,
+                     min_transactions: int = PARALLEL_ANALYSIS_MIN_TRANSACTIONS) -> (List[OpenLot], List[ClosedTrade], float, float, float):
+    """Same result as analyze_portfolio_by_lot(portfolio, backend='python', lot_policy=lot_policy)."""
+    global _shared_portfolio
+    workers = PARALLEL_ANALYSIS_WORKERS if workers is None else workers
+    if workers <= 1 or len(portfolio) < min_transactions:
+        return analyze_portfolio_by_lot(portfolio, backend='python', lot_policy=lot_policy)
+    laps = _phase_laps()
+    partitions = partition_by_symbol(portfolio)
+    if len(partitions) < 2:
+        return analyze_portfolio_by_lot(portfolio, backend='python', lot_policy=lot_policy)
+    chunks = plan_chunks([len(partition) for partition in partitions], workers * CHUNKS_PER_WORKER)
+    if laps:
+        laps('analysis.partition')
+
+    fork = _can_fork()
+    context = multiprocessing.get_context('fork' if fork else 'spawn')
+    try:
+        if fork:
+            _shared_portfolio = portfolio
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=context) as executor:
+            futures = []
+            for chunk in chunks:
+                chunk_partitions = [partitions[index] for index in chunk]
+                sent = None if fork else [[portfolio[position] for position in positions] for positions in chunk_partitions]
+                futures.append(executor.submit(_replay_partitions, chunk_partitions, lot_policy, sent))
+            results = [_unpack(packed) for future in futures for packed in future.result()]
+    finally:
+        _shared_portfolio = None
+    if laps:
+        laps('analysis.parallel')
+
+    analysis = _merge_results(results)
+    if laps:
+        laps('analysis.merge')
+    return analysis
@@ -0,0 +1,267 @@
+"""
+Report totals by symbol, year and month, kept up to date as the portfolio
+changes.
+
+RollupAnalyzer is an IncrementalPortfolioAnalyzer that also keeps one table
+per grouping in ROLLUP_GROUPINGS, each mapping a group (e.g. a symbol and a
+year) to the ROLLUP_MEASURES totals of its transactions:
+  - invested capital: the cost of every BUY, as in the analysis total;
+  - realized P/L of the closed trades, by sell date and the lot's symbol;
+  - dividends gross, tax withheld (from the dividend's tax_rate) and net (the
+    amount received);
+  - cash returns;
+  - the number of transactions and of closed trades.
+Like the analysis, only dividends and cash returns that name the lot they
+were paid on (closes_lot_number) are counted, so dividends_net plus
+cash_returns add up to the analysis's total dividends.
+
+The tables are built on the first report, so an analyzer that is never asked
+for one costs nothing extra. From then on every insert, update and delete
+adds its cash flows to (or takes them from) the groups it falls in, and the
+realized P/L of each symbol replayed by the analyzer is swapped for the new
+one. Reading one group is a dictionary lookup. A report filtered on some of
+a grouping's fields (e.g. one symbol's months) finds its groups through an
+index of each field's values, so it costs time in the number of matching
+groups, not the size of the table; an unfiltered report lists every group.
+"""
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from portfolio_lib import (
+    StockTransaction, TransactionType, IncrementalPortfolioAnalyzer, DEFAULT_LOT_POLICY, _month_of,
+)
+
+ROLLUP_MEASURES = (
+    'invested_capital', 'realized_pl', 'dividends_gross', 'dividend_tax_withheld', 'dividends_net',
+    'cash_returns', 'transactions', 'closed_trades',
+)
+# Grouping name -> the fields of its group keys
+ROLLUP_GROUPINGS = {
+    'total': (),
+    'symbol': ('symbol',),
+    'year': ('year',),
+    'month': ('year', 'month'),
+    'symbol_year': ('symbol', 'year'),
+    'symbol_month': ('symbol', 'year', 'month'),
+}
+_INVESTED, _REALIZED, _GROSS, _TAX, _NET, _CASH_RETURNS, _TRANSACTIONS, _TRADES = range(len(ROLLUP_MEASURES))
+
+
+def dividend_tax(tx: StockTransaction) -> (float, float):
+    """
+    (gross, tax withheld) of a DIVIDEND. The net amount is what the analysis
+    counts as received; the gross is volume x dividend per share when a tax
+    rate (in percent) was recorded, so the difference is the tax.
+    """
+    net = tx.get_total_amount()
+    if not tx.tax_rate:
+        return net, 0.0
+    if tx.volume and tx.price_per_unit:
+        gross = tx.volume * tx.price_per_unit
+    elif tx.tax_rate < 100:
+        gross = net / (1 - tx.tax_rate / 100)
+    else:
+        gross = net
+    return gross, gross - net
+
+
+def _group_keys(symbol: str, year: Optional[int], month: Optional[int]) -> list:
+    """(grouping, group key) of every table a cell adds up into, in ROLLUP_GROUPINGS order."""
+    return [
+        ('total', ()), ('symbol', (symbol,)), ('year', (year,)), ('month', (year, month)),
+        ('symbol_year', (symbol, year)), ('symbol_month', (symbol, year, month)),
+    ]
+
+
+def _cell(symbol: str, ordinal: int) -> tuple:
+    """The (symbol, year, month) a transaction dated `ordinal` counts in; undated ones have no year or month."""
+    return (symbol,) + (_month_of(ordinal) or (None, None))
+
+
+class RollupAnalyzer(IncrementalPortfolioAnalyzer):
+    """
+    IncrementalPortfolioAnalyzer that also maintains the report tables
+    described in the module docstring. Use report() or rollup() to read them.
+    """
+
+    def __init__(self, portfolio: Optional[List[StockTransaction]] = None, lot_policy: str = DEFAULT_LOT_POLICY):
+        self._tables: Optional[Dict[str, Dict[tuple, list]]] = None  # Built by the first report
+        self._realized_cells: Dict[str, Dict[tuple, list]] = {}  # partition -> cell -> [realized P/L, trades]
+        # (grouping, field position, value) -> keys of the groups with that value, for groupings of several fields
+        self._indexes: Dict[tuple, set] = defaultdict(set)
+        super().__init__(portfolio, lot_policy)
+
+    # --- Reports ---
+    def rollup(self, group_by: str, key: tuple) -> Optional[dict]:
+        """The totals of one group, e.g. rollup('symbol_year', ('PTT', 2023)), or None if it has no transactions."""
+        fields = _grouping_fields(group_by)
+        self._refresh()
+        values = self._tables[group_by].get(tuple(key))
+        return _row(fields, tuple(key), values) if values is not None else None
+
+    def report(self, group_by: str = 'year', symbol: Optional[str] = None,
+               year: Optional[int] = None, month: Optional[int] = None) -> List[dict]:
+        """
+        The rows of a grouping, sorted by key, optionally only those matching
+        `symbol`, `year` and `month` (each of which must be a field of the
+        grouping). With every field given this is a single lookup.
+        """
+        fields = _grouping_fields(group_by)
+        wanted = {'symbol': symbol, 'year': year, 'month': month}
+        filters = {name: value for name, value in wanted.items() if value is not None}
+        for name in filters:
+            if name not in fields:
+                raise ValueError(f"Grouping {group_by!r} has no {name} (its fields are: {', '.join(fields) or 'none'})")
+        if len(filters) == len(fields):
+            row = self.rollup(group_by, tuple(filters[name] for name in fields))
+            return [row] if row is not None else []
+
+        self._refresh()
+        table = self._tables[group_by]
+        if filters:
+            # Start from the smallest index entry and check the other filters on its keys only
+            matches = sorted((self._indexes.get((group_by, fields.index(name), value), set())
+                              for name, value in filters.items()), key=len)
+            keys = [key for key in matches[0] if all(key in other for other in matches[1:])]
+        else:
+            keys = list(table)
+        # Undated transactions (no year or month) sort last
+        keys.sort(key=lambda key: tuple((value is None, 0 if value is None else value) for value in key))
+        return [_row(fields, key, table[key]) for key in keys]
+
+    # --- Maintenance ---
+    def _refresh(self):
+        """Builds the tables on first use, then brings the realized P/L of changed symbols up to date."""
+        if self._tables is None:
+            self._build()
+        else:
+            self._replay_changed()
+
+    def _build(self):
+        # Add up each (symbol, year, month) cell first, then every cell into the tables
+        cells: Dict[tuple, list] = {}
+        for tx in self._transactions.values():
+            _add_values(cells, _cell(tx.symbol, tx.date_ordinal), _transaction_values(tx, 1))
+        self._replay_changed()
+        for key in self._results:
+            self._realized_cells[key] = realized = self._realized_of(key)
+            for cell, (realized_pl, trades) in realized.items():
+                values = cells.setdefault(cell, [0.0] * len(ROLLUP_MEASURES))
+                values[_REALIZED] += realized_pl
+                values[_TRADES] += trades
+        self._tables = {group_by: {} for group_by in ROLLUP_GROUPINGS}
+        for cell, values in cells.items():
+            self._apply(cell, values)
+
+    def _apply(self, cell: tuple, values: list):
+        """Adds `values` (negative to take them away) to every group the cell is in."""
+        tables = self._tables
+        indexes = self._indexes
+        for group_by, key in _group_keys(*cell):
+            table = tables[group_by]
+            totals = table.get(key)
+            if totals is None:
+                table[key] = totals = [0.0] * len(ROLLUP_MEASURES)
+                if len(key) > 1:
+                    for position, value in enumerate(key):
+                        indexes[group_by, position, value].add(key)
+            for i, value in enumerate(values):
+                totals[i] += value
+            # A group left without transactions or trades is removed, which also clears any rounding left in it
+            if not totals[_TRANSACTIONS] and not totals[_TRADES]:
+                del table[key]
+                if len(key) > 1:
+                    for position, value in enumerate(key):
+                        entry = indexes[group_by, position, value]
+                        entry.discard(key)
+                        if not entry:
+                            del indexes[group_by, position, value]
+
+    def _realized_of(self, key: str) -> Dict[tuple, list]:
+        """Realized P/L and number of trades per cell in the replayed partition `key`."""
+        realized: Dict[tuple, list] = {}
+        result = self._results.get(key)
+        for order_key, trade in result.closed_trades if result else ():
+            cell = _cell(trade.symbol, order_key[0])
+            totals = realized.get(cell)
+            if totals is None:
+                realized[cell] = totals = [0.0, 0]
+            totals[0] += trade.realized_pl
+            totals[1] += 1
+        return realized
+
+    def _replay_changed(self) -> set:
+        changed = super()._replay_changed()
+        if self._tables is not None:
+            for key in changed:
+                old = self._realized_cells.pop(key, {})
+                new = self._realized_of(key)
+                if new:
+                    self._realized_cells[key] = new
+                # Most cells of a replayed symbol come out the same, so only differences are applied
+                for cell in old.keys() | new.keys():
+                    old_pl, old_trades = old.get(cell, (0.0, 0))
+                    new_pl, new_trades = new.get(cell, (0.0, 0))
+                    if new_pl != old_pl or new_trades != old_trades:
+                        self._apply(cell, _trade_values(new_pl - old_pl, new_trades - old_trades))
+        return changed
+
+    def _attach(self, seq: int, tx: StockTransaction):
+        super()._attach(seq, tx)
+        if self._tables is not None:
+            self._apply(_cell(tx.symbol, tx.date_ordinal), _transaction_values(tx, 1))
+
+    def _detach(self, seq: int, tx: StockTransaction):
+        super()._detach(seq, tx)
+        if self._tables is not None:
+            self._apply(_cell(tx.symbol, tx.date_ordinal), _transaction_values(tx, -1))
+
+
+def _grouping_fields(group_by: str) -> tuple:
+    try:
+        return ROLLUP_GROUPINGS[group_by]
+    except KeyError:
+        raise ValueError(f"Unknown grouping {group_by!r}, expected one of: {', '.join(ROLLUP_GROUPINGS)}") from None
+
+
+def _transaction_values(tx: StockTransaction, sign: int) -> list:
+    """The measures one transaction adds to its groups (`sign` -1 takes them away)."""
+    values = [0.0] * len(ROLLUP_MEASURES)
+    values[_TRANSACTIONS] = sign
+    kind = tx.type
+    if kind is TransactionType.BUY:
+        values[_INVESTED] = sign * tx.get_total_amount()
+    elif not tx.closes_lot_number:
+        pass  # Income paid on no lot is left out, as in _replay_lots
+    elif kind is TransactionType.DIVIDEND:
+        gross, tax = dividend_tax(tx)
+        values[_GROSS] = sign * gross
+        values[_TAX] = sign * tax
+        values[_NET] = sign * tx.get_total_amount()
+    elif kind is TransactionType.CASH_RETURN:
+        values[_CASH_RETURNS] = sign * tx.get_total_amount()
+    return values
+
+
+def _trade_values(realized_pl: float, trades: int) -> list:
+    values = [0.0] * len(ROLLUP_MEASURES)
+    values[_REALIZED] = realized_pl
+    values[_TRADES] = trades
+    return values
+
+
+def _add_values(table: Dict[tuple, list], key: tuple, values: list) -> list:
+    totals = table.get(key)
+    if totals is None:
+        table[key] = totals = [0.0] * len(ROLLUP_MEASURES)
+    for i, value in enumerate(values):
+        totals[i] += value
+    return totals
+
+
+def _row(fields: tuple, key: tuple, values: list) -> dict:
+    row = dict(zip(fields, key))
+    row.update(zip(ROLLUP_MEASURES, values))
+    row['transactions'] = int(row['transactions'])
+    row['closed_trades'] = int(row['closed_trades'])
+    return row
@@ -0,0 +1,156 @@
+"""
+SQLite storage for the portfolio, as an alternative to rewriting portfolio.json.
+
+Every transaction is one row, so appends, edits and deletes are single-row
+transactions, and lookups by symbol, date or lot number use indexes instead of
+reading the whole history. Rows convert to and from the same JSON schema as
+portfolio.json.
+
+Usage:
+    python portfolio_store.py import portfolio.json portfolio.db
+    python portfolio_store.py export portfolio.db portfolio.json
+"""
+import json
+import sqlite3
+import sys
+from dataclasses import asdict, fields
+from typing import List, Set, Iterable
+
+from portfolio_lib import StockTransaction, require_known_date
+
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+
+# Column order follows the StockTransaction fields, so the JSON schema and the table stay in sync.
+COLUMNS = [f.name for f in fields(StockTransaction)]
+
+_SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    {', '.join(COLUMNS)}
+);
+CREATE INDEX IF NOT EXISTS idx_transactions_symbol ON transactions (symbol);
+CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (date);
+CREATE INDEX IF NOT EXISTS idx_transactions_mylotnumber ON transactions (mylotnumber);
+CREATE INDEX IF NOT EXISTS idx_transactions_closes_lot_number ON transactions (closes_lot_number);
+"""
+
+_SELECT = f"SELECT {', '.join(COLUMNS)} FROM transactions"
+_INSERT = f"INSERT INTO transactions ({', '.join(COLUMNS)}) VALUES ({', '.join('?' for _ in COLUMNS)})"
+_UPDATE = f"UPDATE transactions SET {', '.join(f'{c} = ?' for c in COLUMNS)} WHERE id = ?"
+
+
+def is_sqlite_path(filepath: str) -> bool:
+    """True if the path names a SQLite portfolio rather than a JSON file."""
+    return filepath.lower().endswith(SQLITE_EXTENSIONS)
+
+
+def _row_values(tx: StockTransaction) -> tuple:
+    return tuple(getattr(tx, c) for c in COLUMNS)
+
+
+class SqlitePortfolioStore:
+    """A portfolio stored as one indexed row per transaction."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM transactions").fetchone()[0]
+
+    # --- Reads ---
+    def _query(self, where: str = "", params: tuple = ()) -> List[StockTransaction]:
+        cursor = self.conn.execute(f"{_SELECT} {where} ORDER BY id", params)
+        return [StockTransaction(*row) for row in cursor]
+
+    def load_all(self) -> List[StockTransaction]:
+        """All transactions in the order they were added."""
+        return self._query()
+
+    def ids(self) -> List[int]:
+        """Row ids in the same order as load_all(), for addressing edits and deletes."""
+        return [row[0] for row in self.conn.execute("SELECT id FROM transactions ORDER BY id")]
+
+    def by_symbol(self, symbol: str) -> List[StockTransaction]:
+        return self._query("WHERE symbol = ?", (symbol,))
+
+    def by_lot(self, lot_number: str) -> List[StockTransaction]:
+        """The BUY that opened a lot plus every SELL, DIVIDEND and CASH_RETURN that references it."""
+        return self._query("WHERE mylotnumber = ? OR closes_lot_number = ?", (lot_number, lot_number))
+
+    def lot_numbers(self) -> Set[str]:
+        """Every lot number opened so far, read from the index."""
+        cursor = self.conn.execute("SELECT DISTINCT mylotnumber FROM transactions WHERE mylotnumber IS NOT NULL")
+        return {row[0] for row in cursor}
+
+    # --- Writes (each call is one transaction) ---
+    def append(self, tx: StockTransaction) -> int:
+        with self.conn:
+            return self.conn.execute(_INSERT, _row_values(tx)).lastrowid
+
+    def append_many(self, transactions: Iterable[StockTransaction]) -> int:
+        """Appends all transactions atomically; returns how many were added."""
+        with self.conn:
+            cursor = self.conn.executemany(_INSERT, (_row_values(tx) for tx in transactions))
+            return cursor.rowcount
+
+    def update(self, row_id: int, tx: StockTransaction):
+        with self.conn:
+            cursor = self.conn.execute(_UPDATE, _row_values(tx) + (row_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(row_id)
+
+    def delete(self, row_id: int):
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM transactions WHERE id = ?", (row_id,))
+        if cursor.rowcount == 0:
+            raise KeyError(row_id)
+
+    def replace_all(self, transactions: Iterable[StockTransaction]):
+        """Replaces the whole portfolio atomically (used by save_portfolio)."""
+        with self.conn:
+            self.conn.execute("DELETE FROM transactions")
+            self.conn.executemany(_INSERT, (_row_values(tx) for tx in transactions))
+
+    # --- JSON import/export ---
+    def import_json(self, json_path: str) -> int:
+        """
+        Appends every transaction from a portfolio.json file, or none of them if
+        one has a date in none of the known formats (PortfolioFormatError).
+        """
+        with open(json_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return self.append_many(require_known_date(StockTransaction(**item), number) for number, item in enumerate(data, 1))
+
+    def export_json(self, json_path: str):
+        """Writes the portfolio in the same format as portfolio.json."""
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump([asdict(tx) for tx in self.load_all()], f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export'):
+        print("Usage: python portfolio_store.py import <portfolio.json> <portfolio.db>")
+        print("       python portfolio_store.py export <portfolio.db> <portfolio.json>")
+        sys.exit(1)
+
+    command, source, target = sys.argv[1:]
+    if command == 'import':
+        with SqlitePortfolioStore(target) as store:
+            added = store.import_json(source)
+            print(f"Imported {added} transaction(s) from '{source}'. '{target}' now contains {len(store)} transaction(s).")
+    else:
+        with SqlitePortfolioStore(source) as store:
+            store.export_json(target)
+            print(f"Exported {len(store)} transaction(s) from '{source}' to '{target}'.")
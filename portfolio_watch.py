@@ -0,0 +1,297 @@
+"""
+Watch mode: keeps a portfolio and its analysis in memory and updates them as
+the portfolio file changes, instead of loading and replaying everything on
+every run.
+
+Changes are noticed by comparing the file's size and modification time on
+every poll, or right away through inotify when the optional inotify_simple
+package is installed (Linux). When portfolio.json only grew at the end (as
+converter.py and save_portfolio leave it after an append), only the new tail
+is parsed. Any other edit re-parses the file, but only the transactions that
+differ are handed to the IncrementalPortfolioAnalyzer, so only their symbols
+are replayed. A SQLite portfolio (.db) is reloaded and compared the same way.
+
+CSV files placed in a drop folder are imported with converter.import_csv_files
+(once they have stopped changing between two polls) and then moved into its
+'imported' subfolder; the rows they add are picked up like any other append.
+"""
+import hashlib
+import io
+import os
+import shutil
+import time
+from dataclasses import dataclass, field, fields
+from difflib import SequenceMatcher
+from operator import attrgetter
+from typing import Callable, List, Optional, Set, Tuple
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # pragma: no cover - depends on the environment
+    INotify = None
+
+from portfolio_lib import (
+    StockTransaction, IncrementalPortfolioAnalyzer, iter_portfolio_json, PortfolioFormatError, DEFAULT_LOT_POLICY,
+)
+from portfolio_store import SqlitePortfolioStore, is_sqlite_path
+import converter
+
+# Subfolder of the drop folder that imported CSV files are moved to
+IMPORTED_FOLDER = 'imported'
+# Extra wait after an inotify event, so a burst of writes is handled as one change
+INOTIFY_SETTLE_SECONDS = 0.05
+
+_WHITESPACE = b' \t\r\n'
+# A transaction's field values as a hashable tuple, for matching old and new rows
+_row_values = attrgetter(*(f.name for f in fields(StockTransaction)))
+
+
+def inotify_available() -> bool:
+    """True when inotify_simple is installed."""
+    return INotify is not None
+
+
+def _file_signature(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _records_end(data: bytes) -> int:
+    """Offset just past the last transaction of a JSON array (just past the '[' when it is empty)."""
+    end = data.rstrip(_WHITESPACE).rfind(b']')
+    before = data[:end].rstrip(_WHITESPACE)
+    if before.endswith(b'['):
+        return len(before)
+    return data.rfind(b'}', 0, end) + 1
+
+
+@dataclass
+class WatchUpdate:
+    """What one check found and applied."""
+    source: str
+    appended: int = 0
+    changed: int = 0  # Transactions inserted, updated or deleted by a full re-read
+    imported_files: List[str] = field(default_factory=list)
+    rejected_rows: int = 0
+    symbols: Set[str] = field(default_factory=set)  # Symbols whose analysis changed
+    seconds: float = 0.0
+
+
+class PortfolioWatcher:
+    """
+    The in-memory portfolio and analysis of one portfolio file (JSON or SQLite),
+    plus an optional drop folder of CSV files to import into it.
+    """
+
+    def __init__(self, portfolio_path: str, drop_dir: Optional[str] = None, interval: float = 1.0,
+                 report_path: Optional[str] = converter.REJECTION_REPORT_FILE, lot_policy: str = DEFAULT_LOT_POLICY):
+        self.portfolio_path = portfolio_path
+        self.drop_dir = drop_dir
+        self.interval = interval
+        self.report_path = report_path
+        self.analyzer = IncrementalPortfolioAnalyzer(lot_policy=lot_policy)
+        self._signature: Optional[tuple] = None
+        self._records_end = 0  # JSON only: where the parsed transactions end
+        self._prefix_hash: Optional[bytes] = None  # JSON only: hash of the bytes before _records_end
+        self._pending_csv: dict = {}  # drop folder file -> signature at the previous check
+        self._inotify = None
+
+    # --- Reading the portfolio ---
+    def _portfolio_signature(self) -> Optional[tuple]:
+        if is_sqlite_path(self.portfolio_path):
+            # Writes may sit in the write-ahead log until a checkpoint
+            return tuple(_file_signature(self.portfolio_path + suffix) for suffix in ('', '-wal'))
+        return _file_signature(self.portfolio_path)
+
+    def _remember_json(self, data: bytes):
+        self._records_end = _records_end(data)
+        self._prefix_hash = hashlib.sha256(data[:self._records_end]).digest()
+
+    def _parse_tail(self, data: bytes) -> Optional[List[StockTransaction]]:
+        """The transactions after the ones already parsed, or None if the earlier part of the file changed."""
+        if self._prefix_hash is None or len(data) < self._records_end:
+            return None
+        if hashlib.sha256(data[:self._records_end]).digest() != self._prefix_hash:
+            return None
+        tail = data[self._records_end:].lstrip(_WHITESPACE)
+        if tail.startswith(b','):
+            tail = tail[1:]
+        elif len(self.analyzer) and not tail.startswith(b']'):
+            return None
+        return list(iter_portfolio_json(io.BytesIO(b'[' + tail)))
+
+    def _read_all(self) -> Tuple[List[StockTransaction], Optional[bytes]]:
+        if is_sqlite_path(self.portfolio_path):
+            if not os.path.exists(self.portfolio_path):
+                return [], None
+            with SqlitePortfolioStore(self.portfolio_path) as store:
+                return store.load_all(), None
+        with open(self.portfolio_path, 'rb') as f:
+            data = f.read()
+        if not data.strip():
+            return [], data
+        return list(iter_portfolio_json(io.BytesIO(data))), data
+
+    def load(self) -> WatchUpdate:
+        """Reads the whole portfolio (the first time, or after a change that was not an append)."""
+        started = time.perf_counter()
+        signature = self._portfolio_signature()
+        portfolio, data = self._read_all() if os.path.exists(self.portfolio_path) else ([], None)
+        update = WatchUpdate(self.portfolio_path)
+        if len(self.analyzer) == 0:
+            for tx in portfolio:
+                self.analyzer.insert(tx)
+            update.appended = len(portfolio)
+            update.symbols = {tx.symbol for tx in portfolio}
+        else:
+            update.changed, update.symbols = self._apply_difference(portfolio)
+        if data is not None:
+            self._remember_json(data)
+        else:
+            self._prefix_hash = None
+        self._signature = signature
+        update.seconds = time.perf_counter() - started
+        return update
+
+    def _apply_difference(self, portfolio: List[StockTransaction]) -> Tuple[int, Set[str]]:
+        """
+        Brings the analyzer in line with a re-read portfolio by inserting,
+        updating and deleting only the transactions that differ.
+        """
+        current = self.analyzer.transactions
+        # Unchanged start and end are skipped before matching the rest
+        start = 0
+        limit = min(len(current), len(portfolio))
+        while start < limit and current[start] == portfolio[start]:
+            start += 1
+        end_old, end_new = len(current), len(portfolio)
+        while end_old > start and end_new > start and current[end_old - 1] == portfolio[end_new - 1]:
+            end_old -= 1
+            end_new -= 1
+
+        matcher = SequenceMatcher(None, [_row_values(tx) for tx in current[start:end_old]],
+                                  [_row_values(tx) for tx in portfolio[start:end_new]], autojunk=False)
+        changed = 0
+        symbols = set()
+        # From the end backwards, so the indexes of the earlier blocks stay valid
+        for op, old_from, old_to, new_from, new_to in reversed(matcher.get_opcodes()):
+            if op == 'equal':
+                continue
+            old_from, old_to, new_from, new_to = old_from + start, old_to + start, new_from + start, new_to + start
+            symbols.update(tx.symbol for tx in current[old_from:old_to])
+            symbols.update(tx.symbol for tx in portfolio[new_from:new_to])
+            changed += max(old_to - old_from, new_to - new_from)
+            common = min(old_to - old_from, new_to - new_from)
+            for offset in range(common):
+                self.analyzer.update(old_from + offset, portfolio[new_from + offset])
+            for index in range(old_to - 1, old_from + common - 1, -1):
+                self.analyzer.delete(index)
+            for offset in range(common, new_to - new_from):
+                self.analyzer.insert(portfolio[new_from + offset], old_from + offset)
+        return changed, symbols
+
+    # --- Checking for changes ---
+    def check(self) -> Optional[WatchUpdate]:
+        """
+        Looks for changes once and applies them. Returns None when nothing
+        changed, or when the file could not be read (e.g. it is still being
+        written); it is then read again on the next check.
+        """
+        started = time.perf_counter()
+        imported, rejected = self._import_drop_folder()
+
+        signature = self._portfolio_signature()
+        if signature == self._signature:
+            if not imported:
+                return None
+            update = WatchUpdate(self.portfolio_path)
+        else:
+            try:
+                update = self._refresh(signature)
+            except (OSError, PortfolioFormatError):
+                return None
+        update.imported_files = imported
+        update.rejected_rows = rejected
+        update.seconds = time.perf_counter() - started
+        return update
+
+    def _refresh(self, signature: tuple) -> WatchUpdate:
+        if is_sqlite_path(self.portfolio_path) or signature is None:
+            return self.load()
+        with open(self.portfolio_path, 'rb') as f:
+            data = f.read()
+        appended = self._parse_tail(data)
+        if appended is None:
+            return self.load()
+        for tx in appended:
+            self.analyzer.insert(tx)
+        self._remember_json(data)
+        self._signature = signature
+        return WatchUpdate(self.portfolio_path, appended=len(appended), symbols={tx.symbol for tx in appended})
+
+    def _import_drop_folder(self) -> Tuple[List[str], int]:
+        """Imports the CSV files that have not changed since the previous check."""
+        if not self.drop_dir or not os.path.isdir(self.drop_dir):
+            return [], 0
+        seen = {}
+        for name in sorted(os.listdir(self.drop_dir)):
+            path = os.path.join(self.drop_dir, name)
+            if name.lower().endswith('.csv') and os.path.isfile(path):
+                seen[path] = _file_signature(path)
+        ready = [path for path, signature in seen.items() if self._pending_csv.get(path) == signature]
+        self._pending_csv = {path: signature for path, signature in seen.items() if path not in ready}
+        if not ready:
+            return [], 0
+
+        report = converter.import_csv_files(ready, self.portfolio_path, self.report_path, workers=1)
+        imported_dir = os.path.join(self.drop_dir, IMPORTED_FOLDER)
+        os.makedirs(imported_dir, exist_ok=True)
+        for path in ready:
+            target = os.path.join(imported_dir, os.path.basename(path))
+            if os.path.exists(target):
+                stem, extension = os.path.splitext(target)
+                target = f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}{extension}"
+            shutil.move(path, target)
+        return [os.path.basename(path) for path in ready], len(report['rejected'])
+
+    # --- Running ---
+    def _start_inotify(self):
+        self._inotify = INotify()
+        mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE | inotify_flags.MODIFY
+        # Watch the folder, not the file: saving by replacing the file gives it a new inode
+        self._inotify.add_watch(os.path.dirname(os.path.abspath(self.portfolio_path)), mask)
+        if self.drop_dir and os.path.isdir(self.drop_dir):
+            self._inotify.add_watch(self.drop_dir, mask)
+
+    def _wait(self):
+        """Sleeps until the next check: one interval, or until inotify reports a change."""
+        # Drop folder files wait one poll interval so a half-copied CSV is not imported.
+        if self._inotify is None or self._pending_csv:
+            time.sleep(self.interval)
+            return
+        if self._inotify.read(timeout=int(self.interval * 1000)):
+            time.sleep(INOTIFY_SETTLE_SECONDS)
+            self._inotify.read(timeout=0)
+
+    def run(self, on_update: Callable[[WatchUpdate], None], use_inotify: bool = True,
+            stop: Optional[Callable[[], bool]] = None):
+        """
+        Loads the portfolio, then calls `on_update` after every change until
+        interrupted (or until `stop()` returns True).
+        """
+        on_update(self.load())
+        if use_inotify and inotify_available():
+            self._start_inotify()
+        try:
+            while not (stop and stop()):
+                self._wait()
+                update = self.check()
+                if update is not None:
+                    on_update(update)
+        finally:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
@@ -0,0 +1,263 @@
+"""
+Local price history for valuing the portfolio on the server.
+
+Prices are read from one CSV file with Date, Symbol and Close columns, or from
+a folder with one <SYMBOL>.csv file (Date and Close columns) per symbol. They
+are compiled into a binary table sorted by symbol and date, saved next to the
+source (<source>.prices.bin) and memory-mapped: worker processes share the
+same pages, and restarts do not parse the CSV again. The table is rebuilt only
+when the source file(s) change.
+
+Usage:
+    python price_store.py prices.csv     # compile and print a summary
+"""
+import csv
+import glob
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+
+from portfolio_lib import date_normalizer
+
+# Price file (or folder of per-symbol CSV files) used by the web app
+PRICE_FILE = os.environ.get('PRICE_FILE', 'prices.csv')
+
+_MAGIC = b'PRICES1\0'
+_HEADER_LENGTH = struct.Struct('<I')
+_CLOSE_COLUMNS = ('close', 'price', 'adj close', 'last')
+
+
+def _source_signature(source: str) -> Optional[list]:
+    """Size and modification time of the source file(s); None if there is no source."""
+    try:
+        if os.path.isdir(source):
+            return sorted([os.path.basename(p), os.stat(p).st_size, os.stat(p).st_mtime_ns]
+                          for p in glob.glob(os.path.join(source, '*.csv')))
+        stat = os.stat(source)
+        return [stat.st_size, stat.st_mtime_ns]
+    except FileNotFoundError:
+        return None
+
+
+def _cache_path(source: str) -> str:
+    if os.path.isdir(source):
+        return os.path.join(source, '.prices.bin')
+    return source + '.prices.bin'
+
+
+def _parse_price(value: str) -> float:
+    return float(value.replace(',', '').strip())
+
+
+def read_price_csv(path: str, symbol: Optional[str] = None) -> Tuple[Dict[str, Dict[int, float]], int]:
+    """
+    Reads one price CSV into {symbol: {date ordinal: close}}. `symbol` is used
+    for per-symbol files without a Symbol column. Returns the prices and the
+    number of rows that were skipped because they could not be read.
+    """
+    prices: Dict[str, Dict[int, float]] = {}
+    skipped = 0
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        reader = csv.DictReader(f)
+        columns = {name.strip().lower(): name for name in reader.fieldnames or []}
+        date_column = columns.get('date')
+        symbol_column = columns.get('symbol')
+        close_column = next((columns[name] for name in _CLOSE_COLUMNS if name in columns), None)
+        if date_column is None or close_column is None or (symbol_column is None and symbol is None):
+            raise ValueError(f"'{path}' needs Date, Close{'' if symbol else ' and Symbol'} columns")
+        for row in reader:
+            parsed = date_normalizer.parse((row.get(date_column) or '').strip())
+            row_symbol = (row.get(symbol_column) or '').strip().upper() if symbol_column else symbol
+            try:
+                close = _parse_price(row.get(close_column) or '')
+            except ValueError:
+                close = None
+            if parsed is None or not row_symbol or close is None:
+                skipped += 1
+                continue
+            prices.setdefault(row_symbol, {})[parsed[1]] = close  # A later row for the same day wins
+    return prices, skipped
+
+
+def compile_prices(source: str, target: str) -> dict:
+    """Parses the source CSV(s) and writes the binary price table. Returns its header."""
+    signature = _source_signature(source)
+    if signature is None:
+        raise FileNotFoundError(source)
+    prices: Dict[str, Dict[int, float]] = {}
+    skipped = 0
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, '*.csv'))):
+            symbol = os.path.splitext(os.path.basename(path))[0].strip().upper()
+            file_prices, file_skipped = read_price_csv(path, symbol)
+            skipped += file_skipped
+            for file_symbol, series in file_prices.items():
+                prices.setdefault(file_symbol, {}).update(series)
+    else:
+        prices, skipped = read_price_csv(source)
+
+    symbols = sorted(prices)
+    ordinals = array('i')
+    closes = array('d')
+    offsets = [0]
+    for symbol in symbols:
+        series = prices[symbol]
+        days = sorted(series)
+        ordinals.extend(days)
+        closes.extend(series[day] for day in days)
+        offsets.append(len(ordinals))
+
+    header = {
+        "source_signature": signature,
+        "byteorder": sys.byteorder,
+        "symbols": symbols,
+        "offsets": offsets,
+        "skipped_rows": skipped,
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    start = len(_MAGIC) + _HEADER_LENGTH.size + len(header_bytes)
+    padding = -start % 8  # Keeps both arrays aligned
+    ordinal_bytes = ordinals.tobytes()
+    middle_padding = -len(ordinal_bytes) % 8
+
+    temp_path = f"{target}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(_MAGIC + _HEADER_LENGTH.pack(len(header_bytes)) + header_bytes + b'\0' * padding)
+        f.write(ordinal_bytes + b'\0' * middle_padding)
+        f.write(closes.tobytes())
+    # Readers that already mapped the old table keep using it until they reload
+    os.replace(temp_path, target)
+    return header
+
+
+class PriceTable:
+    """
+    A read-only, date-indexed table of closing prices. Each symbol's prices
+    are one contiguous run of (date ordinal, close) pairs sorted by date, so a
+    lookup is a binary search within that run.
+    """
+
+    def __init__(self, header: dict, ordinals: memoryview, closes: memoryview, mapping: Optional[mmap.mmap] = None):
+        self.header = header
+        self.symbols: List[str] = header['symbols']
+        self._offsets: List[int] = header['offsets']
+        self._index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self._ordinals = ordinals
+        self._closes = closes
+        self._mapping = mapping  # Kept referenced so the memory map stays open
+        # Identifies the source data, e.g. for cache keys; the same in every worker process
+        self.version = hashlib.sha1(json.dumps(header['source_signature']).encode('utf-8')).hexdigest()[:16]
+
+    @classmethod
+    def open(cls, path: str) -> 'PriceTable':
+        """Memory-maps a table written by compile_prices()."""
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapping[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"'{path}' is not a price table")
+        (header_length,) = _HEADER_LENGTH.unpack_from(mapping, len(_MAGIC))
+        start = len(_MAGIC) + _HEADER_LENGTH.size
+        header = json.loads(mapping[start:start + header_length])
+        if header.get('byteorder') != sys.byteorder:
+            raise ValueError(f"'{path}' was written on a machine with a different byte order")
+        count = header['offsets'][-1]
+        ordinals_start = start + header_length
+        ordinals_start += -ordinals_start % 8
+        closes_start = ordinals_start + 4 * count
+        closes_start += -closes_start % 8
+        view = memoryview(mapping)
+        return cls(header,
+                   view[ordinals_start:ordinals_start + 4 * count].cast('i'),
+                   view[closes_start:closes_start + 8 * count].cast('d'),
+                   mapping)
+
+    def __len__(self) -> int:
+        return len(self._ordinals)
+
+    def __contains__(self, symbol: str) -> bool:
+        return symbol in self._index
+
+    def _bounds(self, symbol: str) -> Tuple[int, int]:
+        i = self._index.get(symbol)
+        if i is None:
+            return 0, 0
+        return self._offsets[i], self._offsets[i + 1]
+
+    def series(self, symbol: str) -> Tuple[memoryview, memoryview]:
+        """The (date ordinals, closes) of one symbol, oldest first, without copying."""
+        start, end = self._bounds(symbol)
+        return self._ordinals[start:end], self._closes[start:end]
+
+    def price_on(self, symbol: str, ordinal: Optional[int] = None) -> Optional[Tuple[int, float]]:
+        """(date ordinal, close) of the last price on or before the date, or the latest price if no date is given."""
+        start, end = self._bounds(symbol)
+        if start == end:
+            return None
+        i = end if ordinal is None else bisect_right(self._ordinals, ordinal, start, end)
+        if i == start:
+            return None
+        return self._ordinals[i - 1], self._closes[i - 1]
+
+    def daily_closes(self, symbol: str, first_day: int, days: int) -> List[Optional[float]]:
+        """Close for each of `days` consecutive days from `first_day`, carrying the last price over non-trading days."""
+        start, end = self._bounds(symbol)
+        i = bisect_right(self._ordinals, first_day, start, end)
+        price = self._closes[i - 1] if i > start else None
+        result = []
+        for day in range(first_day, first_day + days):
+            while i < end and self._ordinals[i] <= day:
+                price = self._closes[i]
+                i += 1
+            result.append(price)
+        return result
+
+
+def load_price_table(source: str) -> PriceTable:
+    """Opens the compiled table for a source, compiling it first if it is missing or out of date."""
+    target = _cache_path(source)
+    signature = _source_signature(source)
+    try:
+        table = PriceTable.open(target)
+        if table.header['source_signature'] == signature:
+            return table
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    compile_prices(source, target)
+    return PriceTable.open(target)
+
+
+class PriceStore:
+    """Keeps the price table for a source loaded, reloading it when the source changes."""
+
+    def __init__(self, source: str = PRICE_FILE):
+        self.source = source
+        self._table: Optional[PriceTable] = None
+        self._signature = None
+        self._lock = threading.Lock()
+
+    def get(self) -> Optional[PriceTable]:
+        """The current table, or None if the source does not exist."""
+        signature = _source_signature(self.source)
+        with self._lock:
+            if signature is None:
+                self._table = self._signature = None
+            elif signature != self._signature:
+                self._table = load_price_table(self.source)
+                self._signature = signature
+            return self._table
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python price_store.py <prices.csv or folder of SYMBOL.csv files>")
+        sys.exit(1)
+    table = load_price_table(sys.argv[1])
+    print(f"{len(table):,} prices for {len(table.symbols):,} symbol(s) in '{_cache_path(sys.argv[1])}'"
+          f" ({table.header['skipped_rows']:,} unreadable row(s) skipped).")
@@ -0,0 +1,91 @@
+"""Background jobs (analysis_jobs.JobQueue): deduplication, backpressure, attachments and what finished jobs keep."""
+import threading
+import time
+
+import pytest
+
+from analysis_jobs import JobQueue, QueueFullError, DONE, FAILED
+
+
+def finished(queue, job, timeout=5):
+    assert job.wait(timeout)
+    return queue.get(job.id)
+
+
+def test_same_key_returns_the_same_job():
+    queue = JobQueue(workers=1)
+    release = threading.Event()
+    calls = []
+
+    def work(value):
+        calls.append(value)
+        release.wait(5)
+        return value
+
+    job = queue.submit('analyze', 'key', work, b'one')
+    assert queue.submit('analyze', 'key', work, b'two') is job
+    release.set()
+    assert finished(queue, job).body == b'one'
+    assert queue.submit('analyze', 'key', work, b'three') is job
+    assert calls == [b'one']
+
+
+def test_failed_job_is_submitted_again():
+    queue = JobQueue(workers=1, classify_error=lambda e: 400)
+
+    def fail():
+        raise ValueError("bad upload")
+
+    job = finished(queue, queue.submit('analyze', 'key', fail))
+    assert (job.status, job.error, job.error_status) == (FAILED, "bad upload", 400)
+    again = queue.submit('analyze', 'key', lambda: b'ok')
+    assert again is not job
+    assert finished(queue, again).status == DONE
+
+
+def test_full_queue_is_refused():
+    queue = JobQueue(workers=1, max_pending=2)
+    release = threading.Event()
+
+    def work():
+        release.wait(5)
+        return b''
+
+    jobs = [queue.submit('analyze', key, work) for key in ('a', 'b')]
+    with pytest.raises(QueueFullError):
+        queue.submit('analyze', 'c', work)
+    release.set()
+    for job in jobs:
+        finished(queue, job)
+    queue.submit('analyze', 'c', lambda: b'')
+
+
+def test_attachment_goes_to_the_first_taker_only():
+    queue = JobQueue(workers=1)
+    job = finished(queue, queue.submit('analyze', 'key', lambda: (b'body', 'attachment')))
+    assert job.body == b'body'
+    assert queue.take_attachment(job) == 'attachment'
+    assert queue.take_attachment(job) is None
+
+
+def test_unclaimed_attachment_expires_before_the_result():
+    queue = JobQueue(workers=1, attachment_ttl=0.05)
+    job = finished(queue, queue.submit('analyze', 'key', lambda: (b'body', 'attachment')))
+    time.sleep(0.1)
+    assert queue.get(job.id) is job
+    assert queue.take_attachment(job) is None
+
+
+def test_finished_jobs_are_bounded_by_count_and_bytes():
+    queue = JobQueue(workers=1, max_finished=3)
+    jobs = [finished(queue, queue.submit('analyze', key, lambda: b'x')) for key in range(5)]
+    assert [queue.get(job.id) is not None for job in jobs] == [False, False, True, True, True]
+
+    queue = JobQueue(workers=1, max_finished_bytes=250, attachment_size=len)
+    jobs = [finished(queue, queue.submit('analyze', key, lambda: (b'x' * 50, b'y' * 50))) for key in range(3)]
+    assert [queue.get(job.id) is not None for job in jobs] == [False, True, True]
+    # Taking an attachment frees its bytes
+    queue.take_attachment(jobs[2])
+    job = finished(queue, queue.submit('analyze', 'last', lambda: (b'x' * 50, b'y' * 50)))
+    assert [queue.get(job.id) is not None for job in jobs[1:] + [job]] == [True, True, True]
+    assert queue.stats()["finished_bytes"] == 250
@@ -0,0 +1,67 @@
+"""A job that runs past the timeout retires its worker process (portfolio_batch.AnalysisPool)."""
+import os
+import threading
+import time
+
+import pytest
+
+from portfolio_batch import AnalysisPool, AnalysisTimeoutError
+
+
+@pytest.fixture
+def pool():
+    pool = AnalysisPool(workers=1, job_timeout=0.5)
+    yield pool
+    pool.shutdown()
+
+
+def is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_timed_out_worker_is_replaced(pool):
+    worker = pool.run(os.getpid)
+    started = time.monotonic()
+    with pytest.raises(AnalysisTimeoutError):
+        pool.run(time.sleep, 30)
+    assert time.monotonic() - started < 10
+
+    assert pool.run(os.getpid) != worker
+    deadline = time.monotonic() + 10
+    while is_running(worker) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not is_running(worker)
+
+
+def test_jobs_queued_behind_a_stuck_job_still_run(pool):
+    worker = pool.run(os.getpid)
+    results = {}
+
+    def run(name, fn, *args):
+        try:
+            results[name] = pool.run(fn, *args)
+        except Exception as e:
+            results[name] = e
+
+    threads = [threading.Thread(target=run, args=('stuck', time.sleep, 30))]
+    threads[0].start()
+    time.sleep(0.2)
+    for name in ('a', 'b', 'c'):
+        threads.append(threading.Thread(target=run, args=(name, os.getpid)))
+        threads[-1].start()
+    for thread in threads:
+        thread.join(30)
+
+    assert isinstance(results.pop('stuck'), AnalysisTimeoutError)
+    # They were resubmitted to a new worker when the stuck one's pool was retired
+    assert len(set(results.values())) == 1 and worker not in results.values()
+
+    # Once the old pool is reaped nothing is left behind for the jobs
+    deadline = time.monotonic() + 10
+    while pool._timed_out and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert (pool._jobs, pool._started, pool._requeue, pool._timed_out) == ({}, {}, set(), {})
@@ -0,0 +1,81 @@
+"""Analysis sessions of the web app: opt-in, analyzed on first use and bounded by memory (webapp.AnalysisSessions)."""
+import io
+import json
+
+import pytest
+
+import webapp
+from portfolio_rollups import RollupAnalyzer
+
+PORTFOLIO = [
+    {"symbol": "A", "date": "2020-01-01", "type": "BUY", "volume": 100, "price_per_unit": 10.0, "commission": 0.0,
+     "mylotnumber": "L1"},
+    {"symbol": "B", "date": "2020-02-01", "type": "BUY", "volume": 50, "price_per_unit": 20.0, "commission": 0.0,
+     "mylotnumber": "L2"},
+]
+SELL = {"symbol": "A", "date": "2020-03-01", "type": "SELL", "volume": 40, "price_per_unit": 12.0, "commission": 0.0,
+        "closes_lot_number": "L1"}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(webapp, 'analysis_sessions', webapp.AnalysisSessions(1024 * 1024))
+    monkeypatch.setattr(webapp, 'response_cache', webapp.ResponseCache(1024 * 1024))
+    return webapp.app.test_client()
+
+
+def upload(client, **fields):
+    body = json.dumps(PORTFOLIO).encode('utf-8')
+    return client.post('/analyze', data={'portfolio_file': (io.BytesIO(body), 'portfolio.json'), **fields})
+
+
+def test_session_only_when_asked(client):
+    response = upload(client)
+    assert response.status_code == 200
+    assert 'X-Analysis-Session' not in response.headers
+    assert webapp.analysis_sessions.stats()["sessions"] == 0
+
+    response = upload(client, session='1')
+    assert response.get_json()["total_investment"] == 2000.0
+    assert webapp.analysis_sessions.stats()["sessions"] == 1
+    # A cached answer starts a session too
+    response = upload(client, session='1')
+    assert response.headers['X-Analysis-Session']
+    assert webapp.analysis_sessions.stats()["sessions"] == 2
+
+
+def test_session_is_analyzed_on_first_delta(client):
+    session_id = upload(client, session='1').headers['X-Analysis-Session']
+    before = webapp.analysis_sessions.stats()["size_bytes"]
+
+    response = client.post('/analyze/delta', json={"session_id": session_id, "changes": [{"op": "insert", "transaction": SELL}]})
+    assert response.status_code == 200
+    assert response.get_json()["total_realized_pl"] == 80.0
+    assert webapp.analysis_sessions.stats()["size_bytes"] == before * webapp.ANALYZER_BYTES_PER_UPLOAD_BYTE
+
+    response = client.get(f'/reports?session_id={session_id}&group_by=symbol')
+    assert [row["symbol"] for row in response.get_json()["rows"]] == ['A', 'B']
+
+
+def test_invalid_change_ends_the_session(client):
+    session_id = upload(client, session='1').headers['X-Analysis-Session']
+    response = client.post('/analyze/delta', json={"session_id": session_id, "changes": [{"op": "delete", "index": 9}]})
+    assert response.status_code == 400
+    response = client.post('/analyze/delta', json={"session_id": session_id, "changes": []})
+    assert response.status_code == 404
+
+
+def test_sessions_are_bounded_by_size():
+    sessions = webapp.AnalysisSessions(max_bytes=10 * webapp.ANALYZER_BYTES_PER_UPLOAD_BYTE)
+    data = json.dumps(PORTFOLIO).encode('utf-8')
+    assert sessions.open(data, 'specific') is None  # Its analysis could never fit
+
+    sessions = webapp.AnalysisSessions(max_bytes=len(data) * webapp.ANALYZER_BYTES_PER_UPLOAD_BYTE)
+    first = sessions.open(data, 'specific')
+    second = sessions.open(data, 'specific')
+    with sessions.use(first) as analyzer:
+        assert isinstance(analyzer, RollupAnalyzer) and len(analyzer) == 2
+    # Analyzing the first session pushed the total over the limit, so the older second one went
+    with sessions.use(second) as analyzer:
+        assert analyzer is None
+    assert sessions.stats()["size_bytes"] <= sessions.max_bytes
@@ -0,0 +1,76 @@
+"""Batch import of broker CSV exports (converter.import_csv_files)."""
+import json
+
+import pytest
+
+from converter import import_csv_files
+from portfolio_store import SqlitePortfolioStore
+
+HEADER = "Date,Symbol,Type,Volume,Price per Share,Commission,Lot Number,Tax Rate (%),Remark\n"
+EXISTING = [
+    {"symbol": "A", "date": "2020-01-01", "type": "BUY", "volume": 100, "price_per_unit": 10.0, "commission": 0.0,
+     "mylotnumber": "L1"},
+]
+
+
+@pytest.fixture
+def csv_dir(tmp_path):
+    directory = tmp_path / 'exports'
+    directory.mkdir()
+    (directory / 'a.csv').write_text(HEADER +
+                                     "21/01/2021,b,buy,200,5.5,10,L2,,\n"
+                                     "2021-02-01,A,BUY,100,11,0,L1,,already in the portfolio\n"
+                                     "2021-13-01,A,SELL,50,12,0,L1,,\n")
+    (directory / 'b.csv').write_text(HEADER +
+                                     "2021-03-01,B,SELL,100,6,5,L2,,\n"
+                                     "2021-04-01,C,BUY,10,1,0,L2,,same lot as a.csv\n"
+                                     "2021-05-01,B,DIVIDEND,100,0.5,,L2,10,\n")
+    return directory
+
+
+def reasons(report):
+    return sorted((row["file"].rsplit('/', 1)[-1], row["row"], row["reason"].split(':')[0]) for row in report["rejected"])
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_directory_is_imported_in_one_append(tmp_path, csv_dir, workers):
+    portfolio_path = tmp_path / 'portfolio.json'
+    portfolio_path.write_text(json.dumps(EXISTING, indent=2))
+    report_path = tmp_path / 'rejections.json'
+
+    report = import_csv_files([str(csv_dir)], str(portfolio_path), str(report_path), workers=workers)
+
+    assert report["accepted"] == 3
+    assert reasons(report) == [
+        ('a.csv', 3, 'Lot number already exists in the portfolio'),
+        ('a.csv', 4, 'Invalid data format'),
+        ('b.csv', 3, 'Lot number already exists in the portfolio'),
+    ]
+    assert json.loads(report_path.read_text()) == report
+    portfolio = json.loads(portfolio_path.read_text())
+    # Appended in place, byte for byte what dumping the whole list gives
+    assert portfolio_path.read_text() == json.dumps(portfolio, indent=2, ensure_ascii=False)
+    assert [(tx["symbol"], tx["date"], tx["type"]) for tx in portfolio[1:]] == [
+        ('B', '2021-01-21', 'BUY'), ('B', '2021-03-01', 'SELL'), ('B', '2021-05-01', 'DIVIDEND')]
+    assert portfolio[3]["total_amount"] == 45.0
+
+
+def test_lot_index_notices_outside_changes(tmp_path, csv_dir):
+    portfolio_path = tmp_path / 'portfolio.json'
+    portfolio_path.write_text(json.dumps(EXISTING, indent=2))
+    import_csv_files([str(csv_dir / 'b.csv')], str(portfolio_path), None)
+    assert json.loads((tmp_path / 'portfolio.json.lots.json').read_text())["lot_numbers"] == ['L1', 'L2']
+
+    # Edited by hand: L2 removed, so the saved index is stale and must not be trusted
+    portfolio_path.write_text(json.dumps(EXISTING, indent=2))
+    report = import_csv_files([str(csv_dir / 'a.csv')], str(portfolio_path), None)
+    assert report["accepted"] == 1
+
+
+def test_sqlite_portfolio(tmp_path, csv_dir):
+    db_path = str(tmp_path / 'portfolio.db')
+    report = import_csv_files([str(csv_dir)], db_path, None, workers=2)
+    assert report["accepted"] == 4
+    with SqlitePortfolioStore(db_path) as store:
+        assert store.lot_numbers() == {'L1', 'L2'}
+        assert len(store) == 4
@@ -0,0 +1,97 @@
+"""IncrementalPortfolioAnalyzer must give the same result as a full analyze_portfolio_by_lot after any edits."""
+import random
+
+import pytest
+
+from portfolio_lib import StockTransaction, IncrementalPortfolioAnalyzer, analyze_portfolio_by_lot, LOT_POLICIES
+
+
+def buy(symbol, date, lot, volume=100, price=10.0):
+    return StockTransaction(symbol=symbol, date=date, type='BUY', volume=volume, price_per_unit=price,
+                            commission=0.0, mylotnumber=lot)
+
+
+def sell(symbol, date, volume, lot=None, price=12.0):
+    return StockTransaction(symbol=symbol, date=date, type='SELL', volume=volume, price_per_unit=price,
+                            commission=0.0, closes_lot_number=lot)
+
+
+def assert_same_as_full(analyzer, lot_policy):
+    assert analyzer.analyze() == analyze_portfolio_by_lot(analyzer.transactions, backend='python', lot_policy=lot_policy)
+
+
+@pytest.mark.parametrize('lot_policy', [policy for policy in LOT_POLICIES if policy != 'specific'])
+def test_sell_naming_an_emptied_lot_of_another_symbol(lot_policy):
+    # Lot L3 is bought under B and then C (C's BUY supplies the lot), emptied,
+    # then named by a SELL of A, which falls back to automatic matching.
+    portfolio = [
+        buy('A', '2020-01-01', 'L1'),
+        buy('B', '2020-01-02', 'L2'),
+        buy('B', '2020-01-03', 'L3'),
+        buy('C', '2020-01-04', 'L3', volume=50),
+        buy('C', '2020-01-05', 'L4'),
+        sell('C', '2020-02-01', 50, 'L3'),
+    ]
+    analyzer = IncrementalPortfolioAnalyzer(portfolio, lot_policy)
+    assert_same_as_full(analyzer, lot_policy)
+
+    analyzer.insert(sell('A', '2020-03-01', 30, 'L3'))
+    assert_same_as_full(analyzer, lot_policy)
+    analyzer.insert(sell('A', '2020-03-02', 30))
+    assert_same_as_full(analyzer, lot_policy)
+    # Moving the lot to another symbol moves the SELLs that name it
+    analyzer.update(3, buy('B', '2020-01-04', 'L3', volume=50))
+    assert_same_as_full(analyzer, lot_policy)
+    analyzer.delete(3)
+    assert_same_as_full(analyzer, lot_policy)
+
+
+@pytest.mark.parametrize('lot_policy', LOT_POLICIES)
+def test_random_edits_with_shared_lot_numbers(lot_policy):
+    rng = random.Random(lot_policy)
+    symbols, lots = ['A', 'B', 'C'], ['L1', 'L2', 'L3', 'L4']
+
+    def random_transaction():
+        date = f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        if rng.random() < 0.5:
+            return buy(rng.choice(symbols), date, rng.choice(lots), volume=rng.randint(10, 100), price=rng.uniform(5, 15))
+        return sell(rng.choice(symbols), date, rng.randint(1, 60), rng.choice(lots + [None]))
+
+    analyzer = IncrementalPortfolioAnalyzer([random_transaction() for _ in range(20)], lot_policy)
+    for _ in range(60):
+        choice = rng.random()
+        if choice < 0.5 or len(analyzer) < 5:
+            analyzer.insert(random_transaction(), rng.randint(0, len(analyzer)))
+        elif choice < 0.75:
+            analyzer.update(rng.randrange(len(analyzer)), random_transaction())
+        else:
+            analyzer.delete(rng.randrange(len(analyzer)))
+        try:
+            expected = analyze_portfolio_by_lot(analyzer.transactions, backend='python', lot_policy=lot_policy)
+        except ZeroDivisionError:
+            # A lot-specific SELL of an emptied lot under the 'specific' policy; not what this test is about
+            continue
+        assert analyzer.analyze() == expected
+
+
+def test_merged_analysis_kept_between_reports_and_edits():
+    # Reports replay changed symbols before analyze() merges them; edits hit old and recent history alike
+    from portfolio_rollups import RollupAnalyzer
+
+    portfolio = [buy(symbol, f"2020-{month:02d}-01", f"{symbol}{month}") for month in range(1, 13) for symbol in 'ABC']
+    analyzer = RollupAnalyzer(portfolio, 'fifo')
+    assert_same_as_full(analyzer, 'fifo')
+    edits = [
+        lambda: analyzer.insert(sell('B', '2021-01-01', 150)),
+        lambda: analyzer.insert(sell('A', '2020-01-15', 50, 'A1'), 0),
+        lambda: analyzer.update(5, buy('C', '2019-06-01', 'C0', volume=30)),
+        lambda: analyzer.delete(len(analyzer) - 1),
+        lambda: analyzer.insert(buy('D', '2020-06-15', 'D1')),
+    ]
+    for edit in edits:
+        edit()
+        analyzer.report('symbol')
+        assert_same_as_full(analyzer, 'fifo')
+    # The returned lists are the caller's own
+    analyzer.analyze()[0].clear()
+    assert_same_as_full(analyzer, 'fifo')
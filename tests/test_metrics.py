@@ -0,0 +1,65 @@
+"""Metrics of workers that have exited must stay in the /metrics totals (metrics.py)."""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture
+def metrics_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, 'registry', metrics.MetricsRegistry())
+    return tmp_path
+
+
+def exited_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_worker_file(directory, pid, requests, cache_entries):
+    snapshot = {
+        "counters": [["portfolio_requests_total", [["endpoint", "/analyze"], ["status", "200"]], requests]],
+        "histograms": [["portfolio_request_duration_seconds", [["endpoint", "/analyze"]], [0.1, 1], [requests, 0, 0],
+                        0.05 * requests, requests]],
+        "collected": [
+            ["portfolio_response_cache_hits_total", "counter", "Response cache hits.", [], requests],
+            ["portfolio_response_cache_entries", "gauge", "Responses in the cache.", [], cache_entries],
+        ],
+    }
+    (directory / f"metrics-{pid}.json").write_text(json.dumps(snapshot))
+
+
+def sample(text, line_start):
+    return [float(line.rsplit(' ', 1)[1]) for line in text.splitlines() if line.startswith(line_start)]
+
+
+def test_counters_of_exited_workers_are_kept(metrics_dir):
+    write_worker_file(metrics_dir, exited_pid(), requests=5, cache_entries=7)
+    text = metrics.render_prometheus()
+    assert sample(text, 'portfolio_requests_total{endpoint="/analyze",status="200"}') == [5]
+    assert sample(text, 'portfolio_request_duration_seconds_count') == [5]
+    assert sample(text, 'portfolio_response_cache_hits_total') == [5]
+    # The gauge of an exited worker is not carried over
+    assert sample(text, 'portfolio_response_cache_entries') == []
+    # Only this (running) process still has a file of its own
+    assert [path.name for path in metrics_dir.glob('metrics-[0-9]*.json')] == [f"metrics-{os.getpid()}.json"]
+
+    # Scraped again, and after another worker has exited, nothing goes down
+    assert sample(metrics.render_prometheus(), 'portfolio_requests_total{') == [5]
+    write_worker_file(metrics_dir, exited_pid(), requests=3, cache_entries=1)
+    text = metrics.render_prometheus()
+    assert sample(text, 'portfolio_requests_total{') == [8]
+    assert sample(text, 'portfolio_request_duration_seconds_bucket{endpoint="/analyze",le="0.1"}') == [8]
+    assert sample(text, 'portfolio_response_cache_hits_total') == [8]
+
+
+def test_running_worker_is_added_to_the_retired_totals(metrics_dir):
+    write_worker_file(metrics_dir, exited_pid(), requests=5, cache_entries=7)
+    metrics.registry.inc('portfolio_requests_total', (('endpoint', '/analyze'), ('status', '200')), 2)
+    assert sample(metrics.render_prometheus(), 'portfolio_requests_total{') == [7]
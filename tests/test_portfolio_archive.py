@@ -0,0 +1,108 @@
+"""Compacted history must report what the full history does (portfolio_archive.py and /history_report)."""
+import io
+import json
+import math
+import os
+import random
+from dataclasses import asdict
+
+import pytest
+
+from portfolio_lib import StockTransaction, analyze_portfolio_by_lot
+from portfolio_archive import ArchiveStore, ArchiveError, compact, history_report, archive_lot_policy
+
+
+def buy(symbol, date, lot, volume=100, price=10.0, commission=0.0, total_amount=None):
+    return StockTransaction(symbol=symbol, date=date, type='BUY', volume=volume, price_per_unit=price,
+                            commission=commission, mylotnumber=lot, total_amount=total_amount)
+
+
+def sell(symbol, date, volume, lot=None, price=12.0, commission=0.0):
+    return StockTransaction(symbol=symbol, date=date, type='SELL', volume=volume, price_per_unit=price,
+                            commission=commission, closes_lot_number=lot)
+
+
+def realized_pl(portfolio, lot_policy='specific'):
+    return [trade.realized_pl for trade in analyze_portfolio_by_lot(portfolio, lot_policy=lot_policy)[1]]
+
+
+def test_lot_sold_in_parts_after_the_cut_off(tmp_path):
+    portfolio = [
+        buy('A', '2020-01-01', 'L1', volume=200, price=10.0),
+        sell('A', '2021-03-01', 100, 'L1', price=10.0),
+        sell('A', '2021-06-01', 100, 'L1', price=10.0),
+    ]
+    _, _, live = compact(portfolio, '2020-12-31', ArchiveStore(str(tmp_path)))
+    assert live[0].total_amount is None
+    assert realized_pl(live) == realized_pl(portfolio) == [0.0, 0.0]
+
+
+def test_carried_lot_keeps_its_total_amount_per_share(tmp_path):
+    portfolio = [
+        buy('A', '2020-01-01', 'L1', volume=200, price=10.0, commission=20.0, total_amount=2020.0),
+        sell('A', '2021-03-01', 50, 'L1'),
+        sell('A', '2021-06-01', 150, 'L1'),
+    ]
+    _, _, live = compact(portfolio, '2020-12-31', ArchiveStore(str(tmp_path)))
+    assert realized_pl(live) == pytest.approx(realized_pl(portfolio))
+
+
+@pytest.mark.parametrize('lot_policy', ['specific', 'fifo', 'lifo', 'hifo'])
+def test_history_report_matches_full_history(tmp_path, lot_policy):
+    # Every lot is either sold off in one sale or only sold from after the cut-off,
+    # so the compacted history must give the full history's totals
+    rng = random.Random(lot_policy)
+    portfolio = []
+    for number in range(200):
+        symbol = rng.choice('ABC')
+        year = rng.randint(2019, 2022)
+        volume = rng.randint(1, 10) * 100
+        lot = f"L{number}"
+        portfolio.append(buy(symbol, f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}", lot, volume,
+                             rng.uniform(5, 50), commission=rng.choice([0.0, 15.0]),
+                             total_amount=rng.choice([None, volume * 20.0])))
+        if year <= 2020 and rng.random() < 0.5:
+            portfolio.append(sell(symbol, f"{year}-12-30", volume, lot, rng.uniform(5, 50), commission=10.0))
+        elif rng.random() < 0.7:
+            for part in range(rng.randint(1, 3)):
+                portfolio.append(sell(symbol, f"2023-{part + 1:02d}-15", volume // 4, lot, rng.uniform(5, 50)))
+    store = ArchiveStore(str(tmp_path))
+    full = analyze_portfolio_by_lot(portfolio, lot_policy=lot_policy)
+
+    archive_id, index, live = compact(portfolio, '2020-12-31', store, lot_policy=lot_policy)
+    report = history_report(index, live, analyze_portfolio_by_lot(live, lot_policy=archive_lot_policy(index)))
+    assert math.isclose(report["totals"]["realized_pl"], full[3], rel_tol=1e-9)
+    assert math.isclose(report["totals"]["investment"], full[2], rel_tol=1e-9)
+    assert report["totals"]["transaction_count"] == len(portfolio)
+    assert report["totals"]["open_lot_count"] == len(full[0])
+    assert math.isclose(report["totals"]["open_cost"], sum(lot.total_cost for lot in full[0]), rel_tol=1e-9)
+
+
+def test_average_cost_is_refused(tmp_path):
+    with pytest.raises(ArchiveError):
+        compact([buy('A', '2020-01-01', 'L1')], '2020-12-31', ArchiveStore(str(tmp_path)), lot_policy='average')
+
+
+def test_history_report_view_reports_a_missing_archive(tmp_path, monkeypatch):
+    import webapp
+
+    store = ArchiveStore(str(tmp_path))
+    monkeypatch.setattr(webapp, 'archive_store', store)
+    monkeypatch.setattr(webapp, 'response_cache', webapp.ResponseCache(0))
+    portfolio = [buy('A', '2020-01-01', 'L1'), buy('A', '2020-02-01', 'L2'), sell('A', '2020-03-01', 100, 'L2')]
+    archive_id, index, live = compact(portfolio, '2020-12-31', store)
+    body = json.dumps([asdict(tx) for tx in live]).encode('utf-8')
+    client = webapp.app.test_client()
+
+    def post():
+        return client.post('/history_report', data={'portfolio_file': (io.BytesIO(body), 'live.json')})
+
+    response = post()
+    assert response.status_code == 200
+    assert response.get_json()["archive_id"] == archive_id
+
+    os.chmod(tmp_path / 'segments', 0o755)
+    os.remove(tmp_path / 'segments' / f"{index['segments'][0]['segment_id']}.json")
+    response = post()
+    assert response.status_code == 404
+    assert 'incomplete' in response.get_json()["error"]
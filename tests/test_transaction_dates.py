@@ -0,0 +1,56 @@
+"""Transactions with a date in none of the known formats are refused wherever a portfolio comes in."""
+import io
+import json
+
+import pytest
+
+import main
+import webapp
+from portfolio_batch import analyze_account
+from portfolio_lib import IncrementalPortfolioAnalyzer, PortfolioFormatError, StockTransaction, iter_portfolio_json
+from portfolio_store import SqlitePortfolioStore
+
+PORTFOLIO = [
+    {"symbol": "A", "date": "21/11/2018", "type": "BUY", "volume": 100, "price_per_unit": 10.0, "commission": 0.0,
+     "mylotnumber": "L1"},
+    {"symbol": "A", "date": "2018-13-45", "type": "SELL", "volume": 100, "price_per_unit": 12.0, "commission": 0.0,
+     "closes_lot_number": "L1"},
+]
+MESSAGE = "Transaction 2 has an unrecognized date: '2018-13-45'"
+
+
+def test_upload_names_the_transaction():
+    body = json.dumps(PORTFOLIO).encode('utf-8')
+    with pytest.raises(PortfolioFormatError, match=MESSAGE):
+        list(iter_portfolio_json(io.BytesIO(body)))
+    with pytest.raises(PortfolioFormatError, match=MESSAGE):
+        analyze_account(PORTFOLIO)
+
+    response = webapp.app.test_client().post('/analyze', data={'portfolio_file': (io.BytesIO(body), 'portfolio.json')})
+    assert response.status_code == 400
+    assert MESSAGE in response.get_json()["error"]
+
+
+def test_load_names_the_file_and_the_transaction(tmp_path):
+    path = tmp_path / 'portfolio.json'
+    path.write_text(json.dumps(PORTFOLIO))
+    with pytest.raises(PortfolioFormatError, match=f"{path}: {MESSAGE}"):
+        main.load_portfolio(str(path))
+
+    db_path = str(tmp_path / 'portfolio.db')
+    with SqlitePortfolioStore(db_path) as store:
+        with pytest.raises(PortfolioFormatError, match=MESSAGE):
+            store.import_json(str(path))
+        assert len(store) == 0  # Nothing is imported
+        store.append_many(StockTransaction(**item) for item in PORTFOLIO)
+    with pytest.raises(PortfolioFormatError, match=MESSAGE):
+        main.load_portfolio(db_path)
+
+    path.write_text(json.dumps(PORTFOLIO[:1]))
+    assert [tx.date for tx in main.load_portfolio(str(path))] == ['2018-11-21']
+
+
+def test_delta_with_an_unrecognized_date_is_refused():
+    analyzer = IncrementalPortfolioAnalyzer([StockTransaction(**PORTFOLIO[0])])
+    with pytest.raises(PortfolioFormatError, match="Transaction 1 has an unrecognized date"):
+        analyzer.apply_changes([{"op": "insert", "transaction": PORTFOLIO[1]}])
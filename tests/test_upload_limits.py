@@ -0,0 +1,56 @@
+"""Uploads over the size limits are refused from their Content-Length, before any of the body is read (webapp.py)."""
+import io
+import json
+
+import pytest
+
+import webapp
+
+PORTFOLIO = [
+    {"symbol": "A", "date": "2020-01-01", "type": "BUY", "volume": 100, "price_per_unit": 10.0, "commission": 0.0,
+     "mylotnumber": "L1"},
+]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(webapp, 'MAX_UPLOAD_BYTES', 1000)
+    monkeypatch.setattr(webapp, 'MAX_BATCH_UPLOAD_BYTES', 100_000)
+    monkeypatch.setattr(webapp, 'response_cache', webapp.ResponseCache(0))
+
+    def unread(stream, chunk_size=64 * 1024):
+        raise AssertionError("an oversized upload was read")
+
+    monkeypatch.setattr(webapp, 'stream_digest', unread)
+    return webapp.app.test_client()
+
+
+def upload(size: int) -> dict:
+    return {'portfolio_file': (io.BytesIO(b' ' * size), 'portfolio.json')}
+
+
+@pytest.mark.parametrize('path', ['/analyze', '/analyze?async=1', '/history_report', '/holdings_as_of', '/valuation'])
+def test_oversized_upload_is_refused_unread(client, path):
+    response = client.post(path, data=upload(1000 + webapp.UPLOAD_OVERHEAD_BYTES + 1))
+    assert response.status_code == 413
+    assert "larger than the maximum of 1,000 bytes" in response.get_json()["error"]
+
+
+def test_oversized_close_year_body_is_refused(client):
+    response = client.post('/close_year', data=b' ' * (1000 + webapp.UPLOAD_OVERHEAD_BYTES + 1),
+                           content_type='application/json')
+    assert response.status_code == 413
+
+
+def test_batch_has_its_own_limit(client):
+    response = client.post('/analyze_batch', data={'a': (io.BytesIO(json.dumps(PORTFOLIO).encode('utf-8')), 'a.json'),
+                                                   'b': (io.BytesIO(b' ' * 100_000), 'b.json')})
+    assert response.status_code == 413
+    assert "Batch is larger" in response.get_json()["error"]
+
+
+def test_upload_within_the_limit_is_analyzed(monkeypatch):
+    monkeypatch.setattr(webapp, 'response_cache', webapp.ResponseCache(0))
+    body = json.dumps(PORTFOLIO).encode('utf-8')
+    response = webapp.app.test_client().post('/analyze', data={'portfolio_file': (io.BytesIO(body), 'portfolio.json')})
+    assert response.status_code == 200
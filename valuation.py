@@ -0,0 +1,191 @@
+"""
+Mark-to-market valuation of analysis results against a PriceTable.
+
+value_open_lots() prices every open lot and every symbol in one call, with the
+same formulas as the single-stock analyzer on the web page:
+
+    market value         = remaining volume x price
+    unrealized P/L       = market value - total cost
+    net unrealized P/L   = unrealized P/L + dividends received
+
+equity_curve() builds a daily series of market value, cost basis, realized P/L
+and dividends over a date range. Holdings per day come from per-symbol volume
+and cost columns (one +/- entry per purchase and sale, then a running sum), so
+the work is proportional to symbols x days, not to lots x days.
+"""
+from datetime import date
+from itertools import accumulate
+from typing import Dict, List, Optional
+
+from portfolio_lib import StockTransaction, OpenLot, ClosedTrade, TransactionType, date_normalizer
+from price_store import PriceTable
+
+# Longest equity curve that will be computed in one call
+MAX_EQUITY_CURVE_DAYS = 50 * 366
+
+
+def _ordinal(value: str) -> int:
+    parsed = date_normalizer.parse(value)
+    return parsed[1] if parsed is not None else 0
+
+
+def _valuation_row(volume: int, total_cost: float, dividends: float, price: Optional[float]) -> dict:
+    if price is None:
+        return {"price": None, "market_value": None, "unrealized_pl": None, "net_unrealized_pl": None}
+    market_value = volume * price
+    unrealized_pl = market_value - total_cost
+    return {
+        "price": price,
+        "market_value": market_value,
+        "unrealized_pl": unrealized_pl,
+        "net_unrealized_pl": unrealized_pl + dividends,
+    }
+
+
+def value_open_lots(open_lots: List[OpenLot], prices: PriceTable, as_of: Optional[int] = None) -> dict:
+    """
+    Values every open lot at the last close on or before the `as_of` date
+    ordinal (the latest close when it is None). The price is looked up once per
+    symbol. Lots of symbols without a price are listed in `missing_prices` and
+    left out of the market value totals.
+    """
+    by_symbol: Dict[str, List[OpenLot]] = {}
+    for lot in open_lots:
+        by_symbol.setdefault(lot.symbol, []).append(lot)
+
+    lot_rows, symbol_rows, missing = [], [], []
+    totals = {"total_cost": 0, "market_value": 0, "unrealized_pl": 0, "net_unrealized_pl": 0, "dividends_received": 0}
+    for symbol in sorted(by_symbol):
+        lots = by_symbol[symbol]
+        quote = prices.price_on(symbol, as_of)
+        price = quote[1] if quote is not None else None
+        price_date = date.fromordinal(quote[0]).isoformat() if quote is not None else None
+        if quote is None:
+            missing.append(symbol)
+
+        volume = total_cost = dividends = 0
+        for lot in lots:
+            volume += lot.remaining_volume
+            total_cost += lot.total_cost
+            dividends += lot.dividends_received
+            lot_rows.append({
+                "symbol": symbol,
+                "lot_number": lot.lot_number,
+                "buy_date": lot.buy_date,
+                "remaining_volume": lot.remaining_volume,
+                "total_cost": lot.total_cost,
+                "dividends_received": lot.dividends_received,
+                "price_date": price_date,
+                **_valuation_row(lot.remaining_volume, lot.total_cost, lot.dividends_received, price),
+            })
+        row = _valuation_row(volume, total_cost, dividends, price)
+        symbol_rows.append({
+            "symbol": symbol,
+            "remaining_volume": volume,
+            "total_cost": total_cost,
+            "dividends_received": dividends,
+            "price_date": price_date,
+            **row,
+        })
+        if price is not None:
+            totals["total_cost"] += total_cost
+            totals["dividends_received"] += dividends
+            for key in ("market_value", "unrealized_pl", "net_unrealized_pl"):
+                totals[key] += row[key]
+
+    return {"lots": lot_rows, "symbols": symbol_rows, "totals": totals, "missing_prices": missing}
+
+
+def equity_curve(portfolio: List[StockTransaction], open_lots: List[OpenLot], closed_trades: List[ClosedTrade],
+                 prices: PriceTable, start: int, end: int) -> dict:
+    """
+    Daily portfolio values from the `start` to the `end` date ordinal
+    (inclusive). `open_lots` and `closed_trades` are the analysis of the
+    portfolio as of `end`. Every sale is a slice of its lot held from the buy
+    date until the sell date, and every open lot is held until `end`; a day's
+    market value is the volume held at the end of that day times the last
+    close. Symbols without a price that day are left out of the market value
+    and cost basis and are listed in `missing_prices`.
+    """
+    days = end - start + 1
+    if days <= 0:
+        raise ValueError("The end date is before the start date")
+    if days > MAX_EQUITY_CURVE_DAYS:
+        raise ValueError(f"The date range is longer than {MAX_EQUITY_CURVE_DAYS} days")
+
+    # --- Holdings: (buy day, sell day or None, volume, cost) per symbol ---
+    holdings: Dict[str, list] = {}
+    for trade in closed_trades:
+        holdings.setdefault(trade.symbol, []).append(
+            (_ordinal(trade.buy_date), _ordinal(trade.sell_date), trade.volume_sold, trade.money_in))
+    for lot in open_lots:
+        holdings.setdefault(lot.symbol, []).append((_ordinal(lot.buy_date), None, lot.remaining_volume, lot.total_cost))
+
+    market_value = [0.0] * days
+    cost_basis = [0.0] * days
+    missing = []
+    for symbol in sorted(holdings):
+        volume_delta = [0] * (days + 1)
+        cost_delta = [0.0] * (days + 1)
+        held = False
+        for bought, sold, volume, cost in holdings[symbol]:
+            first = max(bought - start, 0)
+            last = days if sold is None else min(sold - start, days)
+            if first < last:
+                volume_delta[first] += volume
+                volume_delta[last] -= volume
+                cost_delta[first] += cost
+                cost_delta[last] -= cost
+                held = True
+        if not held:
+            continue
+
+        closes = prices.daily_closes(symbol, start, days)
+        symbol_missing = False
+        for i, (volume, cost, close) in enumerate(zip(accumulate(volume_delta), accumulate(cost_delta), closes)):
+            if not volume:
+                continue
+            if close is None:
+                symbol_missing = True
+                continue
+            market_value[i] += volume * close
+            cost_basis[i] += cost
+        if symbol_missing:
+            missing.append(symbol)
+
+    # --- Realized P/L and dividends, accumulated by date ---
+    realized_delta = [0.0] * days
+    dividend_delta = [0.0] * days
+    realized_before = dividends_before = 0.0
+    for trade in closed_trades:
+        i = _ordinal(trade.sell_date) - start
+        if i < 0:
+            realized_before += trade.realized_pl
+        elif i < days:
+            realized_delta[i] += trade.realized_pl
+    for tx in portfolio:
+        if tx.type in (TransactionType.DIVIDEND, TransactionType.CASH_RETURN) and tx.closes_lot_number:
+            amount = tx.get_total_amount()
+            i = tx.date_ordinal - start
+            if amount is None or i >= days:
+                continue
+            if i < 0:
+                dividends_before += amount
+            else:
+                dividend_delta[i] += amount
+    realized_delta[0] += realized_before
+    dividend_delta[0] += dividends_before
+
+    points = [
+        {
+            "date": date.fromordinal(start + i).isoformat(),
+            "market_value": value,
+            "cost_basis": cost,
+            "unrealized_pl": value - cost,
+            "realized_pl": realized,
+            "dividends": dividends,
+        }
+        for i, (value, cost, realized, dividends) in enumerate(
+            zip(market_value, cost_basis, accumulate(realized_delta), accumulate(dividend_delta)))
+    ]
+    return {"points": points, "missing_prices": missing}
@@ -1,18 +1,472 @@
-import json
-from flask import Flask, render_template, request, jsonify
-from dataclasses import asdict
+import hashlib
+import io
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from time import perf_counter
+from collections import OrderedDict
+from typing import Optional
+from flask import Flask, Response, render_template, request, jsonify, url_for
 from datetime import date
+from dataclasses import asdict
 
 # --- นำเข้าฟังก์ชันและคลาสจากไลบรารีกลางของเรา ---
-from portfolio_lib import StockTransaction, analyze_portfolio_by_lot
+from portfolio_lib import (
+    analyze_portfolio_by_lot, HoldingsTimeline,
+    iter_portfolio_json, normalize_date, PortfolioFormatError, PortfolioTooLargeError,
+    LOT_POLICIES, DEFAULT_LOT_POLICY,
+)
+from portfolio_batch import (
+    analysis_pool, consolidate, build_analysis_response, analyze_account, close_year_account,
+    year_end_portfolio, AnalysisTimeoutError,
+)
+from analysis_jobs import JobQueue, QueueFullError, DONE, FAILED
+from price_store import PriceStore, PRICE_FILE
+import metrics
+from analysis_output import RowQuery, NDJSON_MIMETYPE, build_rows_response, iter_ndjson
+from valuation import value_open_lots, equity_curve
+from portfolio_rollups import RollupAnalyzer, ROLLUP_MEASURES
+from portfolio_archive import (
+    ArchiveStore, ArchiveError, ARCHIVE_DIR, compact, find_archive_id, history_report, archive_lot_policy,
+)
 
 
 app = Flask(__name__)
 
+# Largest portfolio JSON accepted by /analyze and /close_year (and per account by /analyze_batch)
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 32 * 1024 * 1024))
+# Largest request body accepted by /analyze_batch
+MAX_BATCH_UPLOAD_BYTES = int(os.environ.get('MAX_BATCH_UPLOAD_BYTES', 256 * 1024 * 1024))
+# Room for the multipart boundaries and form fields sent along with a portfolio file
+UPLOAD_OVERHEAD_BYTES = 64 * 1024
+# Flask refuses (413) to read any request body past this, including bodies sent without a length
+app.config['MAX_CONTENT_LENGTH'] = max(MAX_BATCH_UPLOAD_BYTES, MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES)
+
+# Backend of analyze_portfolio_by_lot for /analyze ('auto', 'python', 'numpy' or 'parallel')
+ANALYSIS_BACKEND = os.environ.get('ANALYSIS_BACKEND', 'auto')
+
+# --- Analysis sessions for /analyze/delta and /reports ---
+# Each worker process keeps its own sessions; a client whose session is unknown
+# (expired, or served by another worker) simply falls back to a full /analyze.
+MAX_ANALYSIS_SESSION_BYTES = int(os.environ.get('MAX_ANALYSIS_SESSION_BYTES', 256 * 1024 * 1024))
+# A RollupAnalyzer holds about this many bytes per byte of its portfolio's JSON
+ANALYZER_BYTES_PER_UPLOAD_BYTE = 6
+
+
+class _AnalysisSession:
+    __slots__ = ('data', 'lot_policy', 'analyzer', 'upload_bytes', 'size', 'lock')
+
+    def __init__(self, data: Optional[bytes], lot_policy: str, analyzer: Optional[RollupAnalyzer], upload_bytes: int):
+        self.data = data
+        self.lot_policy = lot_policy
+        self.analyzer = analyzer
+        self.upload_bytes = upload_bytes
+        self.size = upload_bytes * ANALYZER_BYTES_PER_UPLOAD_BYTE if analyzer is not None else upload_bytes
+        self.lock = threading.Lock()  # Held while a request uses the session
+
+
+class AnalysisSessions:
+    """
+    Portfolios kept for /analyze/delta and /reports, least recently used
+    first out once their estimated memory passes `max_bytes`. A session
+    opened on an upload holds just its bytes and is analyzed into a
+    RollupAnalyzer on first use, so a client that never edits costs little.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._sessions: "OrderedDict[str, _AnalysisSession]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def open(self, data: bytes, lot_policy: str) -> Optional[str]:
+        """Starts a session on an already validated upload; None if its analysis could never fit."""
+        return self._store(_AnalysisSession(data, lot_policy, None, len(data)))
+
+    def add(self, analyzer: RollupAnalyzer, upload_bytes: int) -> Optional[str]:
+        """Starts a session on an analyzer built from an upload of `upload_bytes`."""
+        return self._store(_AnalysisSession(None, analyzer.lot_policy, analyzer, upload_bytes))
+
+    def _store(self, session: _AnalysisSession) -> Optional[str]:
+        if session.upload_bytes * ANALYZER_BYTES_PER_UPLOAD_BYTE > self.max_bytes:
+            return None
+        session_id = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[session_id] = session
+            self._size += session.size
+            self._evict()
+        return session_id
+
+    def _evict(self):
+        """Drops the least recently used sessions until the rest fit. Call with the lock held."""
+        while self._size > self.max_bytes and len(self._sessions) > 1:
+            _, evicted = self._sessions.popitem(last=False)
+            self._size -= evicted.size
+
+    @contextmanager
+    def use(self, session_id: Optional[str]):
+        """
+        The session's analyzer (analyzed now if this is its first use), or
+        None if the session is unknown. Requests of one session take turns:
+        the session stays locked until the block ends.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if session is None:
+            yield None
+            return
+        with session.lock:
+            if session.analyzer is None:
+                portfolio = list(iter_portfolio_json(io.BytesIO(session.data), max_bytes=MAX_UPLOAD_BYTES))
+                session.analyzer = RollupAnalyzer(portfolio, session.lot_policy)
+                session.data = None
+                with self._lock:
+                    size = session.upload_bytes * ANALYZER_BYTES_PER_UPLOAD_BYTE
+                    if self._sessions.get(session_id) is session:
+                        self._size += size - session.size
+                        self._sessions.move_to_end(session_id)
+                    session.size = size
+                    self._evict()
+            yield session.analyzer
+
+    def discard(self, session_id: str):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self._size -= session.size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"sessions": len(self._sessions), "size_bytes": self._size, "max_bytes": self.max_bytes}
+
+
+analysis_sessions = AnalysisSessions(MAX_ANALYSIS_SESSION_BYTES)
+
+
+# --- As-of timelines for /holdings_as_of, keyed by the hash of the uploaded file ---
+MAX_HOLDINGS_TIMELINES = 8
+holdings_timelines: "OrderedDict[str, HoldingsTimeline]" = OrderedDict()
+holdings_lock = threading.Lock()  # A timeline replays lazily, so queries on it must not overlap
+
+
+def get_holdings_timeline(digest: str, stream) -> HoldingsTimeline:
+    """The timeline for an uploaded file, built on first use. Call with holdings_lock held."""
+    timeline = holdings_timelines.get(digest)
+    if timeline is None:
+        timeline = HoldingsTimeline(iter_portfolio_json(stream, max_bytes=MAX_UPLOAD_BYTES))
+        holdings_timelines[digest] = timeline
+        while len(holdings_timelines) > MAX_HOLDINGS_TIMELINES:
+            holdings_timelines.popitem(last=False)
+    else:
+        holdings_timelines.move_to_end(digest)
+    return timeline
+
+# --- Local price history for /valuation (see price_store.py) ---
+price_store = PriceStore(PRICE_FILE)
+
+# --- Archived history for /close_year?archive=1 and /history_report (see portfolio_archive.py) ---
+archive_store = ArchiveStore(ARCHIVE_DIR)
+
+
+# --- Response cache for /analyze and /close_year ---
+class ResponseCache:
+    """
+    LRU cache of serialized JSON responses, keyed by a hash of the uploaded
+    bytes and bounded by the total size of the cached bodies.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: tuple, body: bytes):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+response_cache = ResponseCache(int(os.environ.get('ANALYSIS_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
+
+
+# --- Background jobs for large /analyze and /close_year uploads (see analysis_jobs.py) ---
+# The web page sends portfolios of at least this many bytes as jobs
+ASYNC_ANALYSIS_MIN_BYTES = int(os.environ.get('ASYNC_ANALYSIS_MIN_BYTES', 2 * 1024 * 1024))
+# Longest a status request with ?wait= is held open
+MAX_JOB_WAIT_SECONDS = 30
+# Seconds a client is asked to wait before retrying when the job queue is full
+JOB_RETRY_AFTER_SECONDS = 5
+
+
+def job_error_status(e: Exception) -> int:
+    """HTTP status reported for a job that raised `e`."""
+    if isinstance(e, PortfolioTooLargeError):
+        return 413
+    if isinstance(e, PortfolioFormatError):
+        return 400
+    if isinstance(e, AnalysisTimeoutError):
+        return 504
+    import traceback
+    traceback.print_exc()
+    return 500
+
+
+# An /analyze job's attachment is the (upload, lot policy) its session is started from
+analysis_jobs = JobQueue(classify_error=job_error_status, attachment_size=lambda attachment: len(attachment[0]))
+
+
+def response_cache_samples() -> list:
+    """Response cache counters for /metrics, as (name, type, help, labels, value)."""
+    stats = response_cache.stats()
+    return [
+        ('portfolio_response_cache_hits_total', 'counter', "Response cache hits.", (), stats['hits']),
+        ('portfolio_response_cache_misses_total', 'counter', "Response cache misses.", (), stats['misses']),
+        ('portfolio_response_cache_evictions_total', 'counter', "Response cache evictions.", (), stats['evictions']),
+        ('portfolio_response_cache_entries', 'gauge', "Responses in the cache, over all workers.", (), stats['entries']),
+        ('portfolio_response_cache_bytes', 'gauge', "Size of the cached responses, over all workers.", (), stats['size_bytes']),
+    ]
+
+
+def analysis_job_samples() -> list:
+    """Background job counts for /metrics."""
+    stats = analysis_jobs.stats()
+    return [('portfolio_analysis_jobs', 'gauge', "Background analysis jobs kept, by status, over all workers.",
+             (('status', status),), stats[status]) for status in ('queued', 'running', 'done', 'failed')]
+
+
+metrics.install(app, [response_cache_samples, analysis_job_samples])
+
+
+@app.before_request
+def refuse_oversized_request():
+    """
+    Refuses a request whose Content-Length is over its route's limit before any
+    of the body is spooled, hashed or parsed. (Registered after the metrics
+    hooks, so refused requests are still counted.)
+    """
+    if not request.content_length:
+        return None
+    if request.endpoint == 'analyze_batch':
+        if request.content_length > MAX_BATCH_UPLOAD_BYTES:
+            return jsonify({"error": f"Batch is larger than the maximum of {MAX_BATCH_UPLOAD_BYTES:,} bytes"}), 413
+    elif request.content_length > MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES:
+        return jsonify({"error": f"Portfolio is larger than the maximum of {MAX_UPLOAD_BYTES:,} bytes"}), 413
+    return None
+
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": f"Request is larger than the maximum of {app.config['MAX_CONTENT_LENGTH']:,} bytes"}), 413
+
+
+class HashingReader:
+    """Wraps a binary stream and hashes everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.stream.read(size)
+        self.sha256.update(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def stream_digest(stream, chunk_size: int = 64 * 1024) -> str:
+    """Hashes a seekable stream without loading it, then rewinds it."""
+    sha256 = hashlib.sha256()
+    with metrics.timed('upload.read'):
+        for chunk in iter(lambda: stream.read(chunk_size), b''):
+            sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()
+
+
+def upload_error_response(e: PortfolioFormatError):
+    status = 413 if isinstance(e, PortfolioTooLargeError) else 400
+    return jsonify({"error": str(e)}), status
+
+
+def cached_json_response(body: bytes, etag: str, mimetype: str = 'application/json') -> Response:
+    """Returns a cached JSON body, or 304 Not Modified if the client already has it."""
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+
+def wants_ndjson() -> bool:
+    """True when the client asked for NDJSON (`?format=ndjson` or an Accept header)."""
+    if request.values.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+def response_variant(query: RowQuery, ndjson: bool) -> str:
+    """Suffix that keeps filtered, paginated and NDJSON responses apart in the cache and ETags."""
+    variant = query.cache_suffix() + ('ndjson' if ndjson else '')
+    return '-' + hashlib.sha256(variant.encode('utf-8')).hexdigest()[:16] if variant else ''
+
+
+def analysis_result_response(analysis, transaction_count: int, query: RowQuery, ndjson: bool,
+                             cache_key: Optional[tuple] = None) -> Response:
+    """
+    The analysis as JSON (the whole result, or a filtered page), or as a
+    streamed NDJSON response. A streamed body is added to the response cache
+    once it has been sent completely.
+    """
+    metrics.note_transactions(transaction_count)
+    if not ndjson:
+        with metrics.timed('response.serialize'):
+            if query.is_filtered:
+                data = build_rows_response(analysis, transaction_count, query)
+            else:
+                data = build_analysis_response(analysis, transaction_count)
+            body = app.json.dumps(data).encode('utf-8')
+        if cache_key is not None:
+            response_cache.put(cache_key, body)
+        return Response(body, mimetype='application/json')
+
+    def generate():
+        parts = []
+        chunks = iter_ndjson(analysis, transaction_count, query)
+        serialize_seconds = 0.0
+        while True:
+            started = perf_counter()
+            chunk = next(chunks, None)
+            serialize_seconds += perf_counter() - started
+            if chunk is None:
+                break
+            parts.append(chunk)
+            yield chunk
+        metrics.add_phase_time('response.serialize', serialize_seconds)
+        if cache_key is not None:
+            response_cache.put(cache_key, b''.join(parts))
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+
+def wants_session() -> bool:
+    """True when the client will send edits to /analyze/delta and asked for a session (`session=1`)."""
+    return request.values.get('session', '').lower() in ('1', 'true', 'yes')
+
+
+def set_session_header(response: Response, session_id: Optional[str]):
+    """Tells the client its analysis session, if one could be kept."""
+    if session_id is not None:
+        response.headers['X-Analysis-Session'] = session_id
+
+
+def requested_lot_policy() -> str:
+    """The `lot_policy` form field or query arg (see analyze_portfolio_by_lot). Raises ValueError."""
+    lot_policy = request.values.get('lot_policy') or DEFAULT_LOT_POLICY
+    if lot_policy not in LOT_POLICIES:
+        raise ValueError(f"Unknown lot_policy {lot_policy!r} (expected one of {', '.join(LOT_POLICIES)})")
+    return lot_policy
+
+
+def lot_policy_suffix(lot_policy: str) -> str:
+    """Keeps results of a non-default lot policy apart in the cache and ETags."""
+    return '' if lot_policy == DEFAULT_LOT_POLICY else f"-{lot_policy}"
+
+
+def wants_async() -> bool:
+    """True when the client asked for a background job (`?async=1`)."""
+    return request.values.get('async', '').lower() in ('1', 'true', 'yes')
+
+
+def job_status_data(job) -> dict:
+    status = job.describe()
+    status["status_url"] = url_for('job_status', job_id=job.id)
+    status["result_url"] = url_for('job_result', job_id=job.id)
+    return status
+
+
+def job_accepted_response(job) -> Response:
+    """202 Accepted with the job's status and where to poll it."""
+    status = job_status_data(job)
+    response = jsonify(status)
+    response.status_code = 202
+    response.headers['Location'] = status["status_url"]
+    return response
+
+
+def submit_job(kind: str, etag: str, fn, *args) -> Response:
+    """
+    Starts a background job whose result is cached like the synchronous
+    response for the same upload. A cached result becomes a finished job at once.
+    """
+    cache_key = (kind, etag)
+    body = response_cache.get(cache_key)
+    if body is not None:
+        return job_accepted_response(analysis_jobs.completed(kind, cache_key, body, etag))
+    try:
+        job = analysis_jobs.submit(kind, cache_key, fn, *args, etag=etag,
+                                   on_done=lambda result: response_cache.put(cache_key, result))
+    except QueueFullError as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(JOB_RETRY_AFTER_SECONDS)
+        return response
+    return job_accepted_response(job)
+
+
+def run_analyze_job(data: bytes, lot_policy: str, keep_session: bool):
+    """
+    The /analyze response body for an uploaded file, computed on the analysis
+    pool. With `keep_session` the upload is attached too: /jobs/<id>/result
+    starts a session on it, which is only analyzed by its first
+    /analyze/delta, so the job does not analyze the portfolio twice.
+    """
+    body = analysis_pool.run(analyze_account, data, MAX_UPLOAD_BYTES, lot_policy)[1]
+    return (body, (data, lot_policy)) if keep_session else body
+
+
 @app.route('/')
 def index():
     """แสดงหน้าเว็บหลัก (index.html)"""
-    return render_template('index.html')
+    return render_template('index.html', async_analysis_min_bytes=ASYNC_ANALYSIS_MIN_BYTES)
 
 @app.route('/analyze', methods=['POST'])
 def analyze_portfolio():
@@ -24,77 +478,483 @@ def analyze_portfolio():
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
 
+    try:
+        query = RowQuery.from_args(request.values)
+        lot_policy = requested_lot_policy()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    ndjson = wants_ndjson()
+    run_async = wants_async()
+    if run_async and (ndjson or query.is_filtered):
+        return jsonify({"error": "async mode returns the whole analysis as JSON; filters and format=ndjson are not supported"}), 400
+
     if file and file.filename.endswith('.json'):
         try:
-            # อ่านข้อมูลจากไฟล์ที่อัปโหลดมาเป็น string แล้วแปลงเป็น JSON
-            content = file.read().decode('utf-8')
-            portfolio_data = json.loads(content)
-            
-            # แปลง list of dicts ที่ได้จาก JSON ให้เป็น list of StockTransaction objects
-            portfolio_objects = [StockTransaction(**item) for item in portfolio_data]
+            if run_async:
+                # Read one byte past the limit so an oversized file fails the job with 413
+                etag = stream_digest(file.stream) + lot_policy_suffix(lot_policy)
+                return submit_job('analyze', etag, run_analyze_job, file.stream.read(MAX_UPLOAD_BYTES + 1), lot_policy,
+                                  wants_session())
+
+            # The uploaded file is spooled by Werkzeug; hash it first so identical
+            # uploads are answered from the cache without parsing.
+            etag = stream_digest(file.stream) + lot_policy_suffix(lot_policy) + response_variant(query, ndjson)
+            cache_key = ('analyze', etag)
+            body = response_cache.get(cache_key)
+            if body is not None:
+                response = cached_json_response(body, etag, NDJSON_MIMETYPE if ndjson else 'application/json')
+                if wants_session():
+                    # The cached answer is for these very bytes, so they need no parsing to start a session
+                    set_session_header(response, analysis_sessions.open(file.stream.read(), lot_policy))
+                return response
+
+            # อ่านไฟล์ JSON ทีละส่วนและสร้าง StockTransaction ทีละรายการ
+            data = file.stream.read(MAX_UPLOAD_BYTES + 1) if wants_session() else None
+            portfolio_objects = list(iter_portfolio_json(io.BytesIO(data) if data is not None else file.stream,
+                                                         max_bytes=MAX_UPLOAD_BYTES))
 
             # --- เรียกใช้ฟังก์ชันวิเคราะห์ตัวใหม่ ---
-            open_lots, closed_trades, total_investment, total_realized_pl, total_dividends = analyze_portfolio_by_lot(portfolio_objects)
-            
-            # --- รวบรวมรายชื่อหุ้นที่ยังคงมีอยู่ในพอร์ตเท่านั้น ---
-            symbols_in_open_lots = sorted(list(set(lot.symbol for lot in open_lots)))
-            
-            return jsonify({
-                "total_investment": total_investment, 
-                "total_realized_pl": total_realized_pl,
-                "total_dividends": total_dividends,
-                "transaction_count": len(portfolio_objects),
-                # แปลงผลลัพธ์ให้อยู่ในรูปแบบที่ส่งผ่าน JSON ได้
-                "open_lots": [asdict(lot) for lot in open_lots],
-                "closed_trades": [asdict(trade) for trade in closed_trades],
-                "all_symbols": symbols_in_open_lots
-            })
+            analysis = analyze_portfolio_by_lot(portfolio_objects, backend=ANALYSIS_BACKEND, lot_policy=lot_policy)
+            response = analysis_result_response(analysis, len(portfolio_objects), query, ndjson, cache_key)
+            response.set_etag(etag)
+            if data is not None:
+                # Kept so later edits can be sent to /analyze/delta and totals read from /reports
+                set_session_header(response, analysis_sessions.open(data, lot_policy))
+            return response
+        except PortfolioFormatError as e:
+            return upload_error_response(e)
         except Exception as e:
             # เพิ่มการแสดง error ใน terminal เพื่อให้ดีบักง่ายขึ้น
+            metrics.note_error(e)
             import traceback
             traceback.print_exc()
             return jsonify({"error": f"An internal error occurred: {e}"}), 500
 
+@app.route('/analyze/delta', methods=['POST'])
+def analyze_delta():
+    """
+    Applies insert/update/delete changes to a portfolio uploaded earlier through
+    /analyze and returns the updated analysis, replaying only the affected symbols.
+    Expects JSON: {"session_id": "...", "changes": [{"op": "update", "index": 3, "transaction": {...}}, ...]}
+    """
+    payload = request.get_json(silent=True) or {}
+    session_id = payload.get('session_id')
+    try:
+        query = RowQuery.from_args(request.values)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        with analysis_sessions.use(session_id) as analyzer:
+            if analyzer is None:
+                return jsonify({"error": "Unknown or expired session, please re-upload the portfolio"}), 404
+            try:
+                analyzer.apply_changes(payload.get('changes', []))
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                # A half-applied change list leaves the session out of sync with the client.
+                analysis_sessions.discard(session_id)
+                return jsonify({"error": f"Invalid change: {e}"}), 400
+            # analyze() returns new lists of rows that later edits do not touch, so they can be streamed after the lock
+            response = analysis_result_response(analyzer.analyze(), len(analyzer), query, wants_ndjson())
+        response.headers['X-Analysis-Session'] = session_id
+        return response
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
+@app.route('/reports', methods=['GET', 'POST'])
+def reports():
+    """
+    Totals by symbol, year and/or month (see portfolio_rollups.py) of the
+    portfolio of an analysis session (`session_id`), or of an uploaded
+    `portfolio_file`, which then becomes a session. `group_by` picks the
+    grouping (default: year); `symbol`, `year` and `month` filter its rows.
+    The tables are kept up to date by /analyze/delta, so a session answers
+    without replaying the portfolio.
+    """
+    try:
+        group_by = request.values.get('group_by') or 'year'
+        symbol = request.values.get('symbol') or None
+        year = int(request.values['year']) if request.values.get('year') else None
+        month = int(request.values['month']) if request.values.get('month') else None
+        lot_policy = requested_lot_policy()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def report_rows(analyzer: RollupAnalyzer):
+        try:
+            return analyzer.report(group_by, symbol, year, month), None
+        except ValueError as e:
+            return None, (jsonify({"error": str(e)}), 400)
+
+    try:
+        if 'portfolio_file' in request.files:
+            stream = request.files['portfolio_file'].stream
+            portfolio_objects = list(iter_portfolio_json(stream, max_bytes=MAX_UPLOAD_BYTES))
+            metrics.note_transactions(len(portfolio_objects))
+            analyzer = RollupAnalyzer(portfolio_objects, lot_policy)
+            rows, error = report_rows(analyzer)
+            if error:
+                return error
+            session_id = analysis_sessions.add(analyzer, stream.tell())
+        else:
+            session_id = request.values.get('session_id')
+            with analysis_sessions.use(session_id) as analyzer:
+                if analyzer is None:
+                    return jsonify({"error": "Unknown or expired session, please upload the portfolio"}), 404
+                rows, error = report_rows(analyzer)
+                if error:
+                    return error
+        response = jsonify({
+            "group_by": group_by,
+            "lot_policy": analyzer.lot_policy,
+            "measures": list(ROLLUP_MEASURES),
+            "rows": rows,
+        })
+        set_session_header(response, session_id)
+        return response
+    except PortfolioFormatError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
+@app.route('/analyze_batch', methods=['POST'])
+def analyze_batch():
+    """
+    Analyzes many portfolios (accounts) in one request on the worker process pool.
+    Accepts either multipart uploads, one .json file per account (named after the
+    file), or a JSON object mapping account names to transaction lists.
+    Returns the /analyze result of every account plus a cross-account summary.
+    """
+    accounts = {}
+    if request.files:
+        for file in request.files.values():
+            name = os.path.splitext(file.filename or '')[0]
+            if not name:
+                return jsonify({"error": "Every uploaded file needs a file name"}), 400
+            if name in accounts:
+                return jsonify({"error": f"Duplicate account: {name}"}), 400
+            # Read one byte past the limit so oversized files are reported by the worker as 413
+            accounts[name] = file.stream.read(MAX_UPLOAD_BYTES + 1)
+    else:
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify({"error": "Expected portfolio files or a JSON object of account -> transactions"}), 400
+        accounts = payload
+    if not accounts:
+        return jsonify({"error": "No portfolios provided"}), 400
+
+    try:
+        results = analysis_pool.analyze_accounts(accounts, max_bytes=MAX_UPLOAD_BYTES)
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
+    # Worker results are already serialized, so the response is assembled from the JSON bodies
+    account_bodies = []
+    totals = []
+    for name, result in results.items():
+        if isinstance(result, PortfolioTooLargeError):
+            body = app.json.dumps({"error": str(result), "status": 413}).encode('utf-8')
+        elif isinstance(result, PortfolioFormatError):
+            body = app.json.dumps({"error": str(result), "status": 400}).encode('utf-8')
+        elif isinstance(result, AnalysisTimeoutError):
+            body = app.json.dumps({"error": str(result), "status": 504}).encode('utf-8')
+        elif isinstance(result, Exception):
+            body = app.json.dumps({"error": f"An internal error occurred: {result}", "status": 500}).encode('utf-8')
+        else:
+            account_totals, body = result
+            totals.append(account_totals)
+        account_bodies.append(app.json.dumps(name).encode('utf-8') + b':' + body)
+
+    summary = consolidate(totals)
+    summary["failed_accounts"] = len(results) - len(totals)
+    metrics.note_transactions(summary["transaction_count"])
+    body = b'{"accounts":{' + b','.join(account_bodies) + b'},"summary":' + app.json.dumps(summary).encode('utf-8') + b'}'
+    return Response(body, mimetype='application/json')
+
+@app.route('/holdings_as_of', methods=['POST'])
+def holdings_as_of():
+    """
+    Holdings and realized P/L as of a date: the /analyze result for only the
+    transactions dated on or before the `date` form field. The timeline built
+    for an uploaded file is kept, so asking about other dates for the same file
+    only replays from the nearest checkpoint.
+    """
+    if 'portfolio_file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+    as_of_date = request.form.get('date') or request.args.get('date')
+    if not as_of_date:
+        return jsonify({"error": "No date provided"}), 400
+    try:
+        as_of_date = normalize_date(as_of_date)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    file = request.files['portfolio_file']
+    try:
+        digest = stream_digest(file.stream)
+        etag = f"{digest}-{as_of_date}"
+        cache_key = ('holdings_as_of', etag)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return cached_json_response(body, etag)
+
+        with holdings_lock:
+            timeline = get_holdings_timeline(digest, file.stream)
+            analysis = timeline.as_of(as_of_date)
+            transaction_count = timeline.count_as_of(as_of_date)
+
+        metrics.note_transactions(transaction_count)
+        with metrics.timed('response.serialize'):
+            response_data = build_analysis_response(analysis, transaction_count)
+            response_data["as_of"] = as_of_date
+            body = app.json.dumps(response_data).encode('utf-8')
+        response_cache.put(cache_key, body)
+        return cached_json_response(body, etag)
+    except PortfolioFormatError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
+@app.route('/valuation', methods=['POST'])
+def valuation():
+    """
+    Marks the uploaded portfolio to market with the server's price file.
+    Optional form fields (or query args): `date` values the holdings as of that
+    date at the closes on or before it (default: current holdings at the latest
+    closes); `start` and `end` add a daily equity curve for that range.
+    """
+    if 'portfolio_file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+    prices = price_store.get()
+    if prices is None:
+        return jsonify({"error": f"No price file found at '{price_store.source}' (set PRICE_FILE)"}), 404
+    try:
+        fields = {name: request.form.get(name) or request.args.get(name) for name in ('date', 'start', 'end')}
+        dates = {name: normalize_date(value) for name, value in fields.items() if value}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if ('start' in dates) != ('end' in dates):
+        return jsonify({"error": "Both start and end are needed for an equity curve"}), 400
+
+    file = request.files['portfolio_file']
+    try:
+        digest = stream_digest(file.stream)
+        etag = '-'.join([digest, prices.version] + [dates.get(name, '') for name in ('date', 'start', 'end')])
+        cache_key = ('valuation', etag)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return cached_json_response(body, etag)
+
+        with holdings_lock:
+            timeline = get_holdings_timeline(digest, file.stream)
+            if 'date' in dates:
+                open_lots = timeline.as_of(dates['date'])[0]
+                as_of = date.fromisoformat(dates['date']).toordinal()
+            else:
+                open_lots = analyze_portfolio_by_lot(timeline.transactions)[0]
+                as_of = None
+            curve_analysis = timeline.as_of(dates['end']) if 'end' in dates else None
+
+        metrics.note_transactions(len(timeline))
+        response_data = value_open_lots(open_lots, prices, as_of)
+        response_data["as_of"] = dates.get('date')
+        if curve_analysis is not None:
+            try:
+                response_data["equity_curve"] = equity_curve(
+                    timeline.transactions, curve_analysis[0], curve_analysis[1], prices,
+                    date.fromisoformat(dates['start']).toordinal(), date.fromisoformat(dates['end']).toordinal())
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
+        with metrics.timed('response.serialize'):
+            body = app.json.dumps(response_data).encode('utf-8')
+        response_cache.put(cache_key, body)
+        return cached_json_response(body, etag)
+    except PortfolioFormatError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
 @app.route('/close_year', methods=['POST'])
 def close_year_end():
     """
     Receives the current portfolio, calculates the open lots, and returns a new
     set of 'BUY' transactions representing the starting balance for a new period.
     This effectively clears all history (sells, dividends) and resets P/L.
+
+    With `?archive=1` the history is archived instead of dropped: the response
+    is the live portfolio from portfolio_archive.compact, and its archive id is
+    sent in the X-Archive-Id header (and written into the carried-forward BUYs).
     """
     try:
-        portfolio_data = request.get_json()
-        if not portfolio_data:
+        closing_date = date.today().strftime('%Y-%m-%d')
+        try:
+            lot_policy = requested_lot_policy()
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        if request.args.get('archive', '').lower() in ('1', 'true', 'yes'):
+            if wants_async():
+                return jsonify({"error": "archive=1 cannot be combined with async=1"}), 400
+            return close_year_archived(closing_date, lot_policy)
+        if wants_async():
+            data = request.stream.read(MAX_UPLOAD_BYTES + 1)
+            if not data.strip():
+                return jsonify({"error": "No portfolio data provided"}), 400
+            etag = f"{hashlib.sha256(data).hexdigest()}-{closing_date}{lot_policy_suffix(lot_policy)}"
+            return submit_job('close_year', etag, analysis_pool.run, close_year_account, data, closing_date,
+                              MAX_UPLOAD_BYTES, lot_policy)
+
+        # The request body is parsed as it streams in; the hash is only known at
+        # the end, so a cache hit here saves the analysis but not the parsing.
+        reader = HashingReader(request.stream)
+        portfolio_objects = list(iter_portfolio_json(reader, max_bytes=MAX_UPLOAD_BYTES))
+        if not portfolio_objects:
             return jsonify({"error": "No portfolio data provided"}), 400
+        metrics.note_transactions(len(portfolio_objects))
 
-        portfolio_objects = [StockTransaction(**item) for item in portfolio_data]
-        open_lots, _, _, _, _ = analyze_portfolio_by_lot(portfolio_objects)
+        # The closing date is part of the response, so it is part of the cache key too.
+        etag = f"{reader.hexdigest()}-{closing_date}{lot_policy_suffix(lot_policy)}"
+        cache_key = ('close_year', etag)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return cached_json_response(body, etag)
 
-        closing_date = date.today().strftime('%Y-%m-%d')
-        new_portfolio_as_dicts = []
-
-        for lot in open_lots:
-            if lot.remaining_volume <= 0:
-                continue
-
-            avg_cost_per_share = lot.total_cost / lot.remaining_volume if lot.remaining_volume > 0 else 0
-            
-            new_tx = StockTransaction(
-                symbol=lot.symbol, date=closing_date, type='BUY',
-                volume=lot.remaining_volume,
-                price_per_unit=round(avg_cost_per_share, 4),
-                commission=0, mylotnumber=lot.lot_number,
-                total_amount=round(lot.total_cost, 2),
-                remark=f"Year-end closing balance from lot bought on {lot.buy_date}",
-            )
-            new_portfolio_as_dicts.append(asdict(new_tx))
-        
-        return jsonify(new_portfolio_as_dicts)
+        open_lots, _, _, _, _ = analyze_portfolio_by_lot(portfolio_objects, lot_policy=lot_policy)
+        new_portfolio_as_dicts = year_end_portfolio(open_lots, closing_date)
 
+        with metrics.timed('response.serialize'):
+            body = app.json.dumps(new_portfolio_as_dicts).encode('utf-8')
+        response_cache.put(cache_key, body)
+        return cached_json_response(body, etag)
+
+    except PortfolioFormatError as e:
+        return upload_error_response(e)
+    except Exception as e:
+        metrics.note_error(e)
+        import traceback
+        traceback.print_exc()
+        return jsonify({"error": f"An internal error occurred: {e}"}), 500
+
+def close_year_archived(closing_date: str, lot_policy: str) -> Response:
+    """Year-end closing that keeps the closed history in the archive store (not cached: it writes files)."""
+    portfolio_objects = list(iter_portfolio_json(request.stream, max_bytes=MAX_UPLOAD_BYTES))
+    if not portfolio_objects:
+        return jsonify({"error": "No portfolio data provided"}), 400
+    metrics.note_transactions(len(portfolio_objects))
+    base_archive_id = request.args.get('archive_id') or find_archive_id(portfolio_objects)
+    try:
+        archive_id, _, live = compact(portfolio_objects, closing_date, archive_store, base_archive_id, lot_policy)
+    except ArchiveError as e:
+        return jsonify({"error": str(e)}), 400
+    with metrics.timed('response.serialize'):
+        response = Response(app.json.dumps([asdict(tx) for tx in live]), mimetype='application/json')
+    response.headers['X-Archive-Id'] = archive_id
+    return response
+
+@app.route('/history_report', methods=['POST'])
+def history_report_view():
+    """
+    Totals by year over the whole history of an uploaded live portfolio: the
+    archived summaries plus the analysis of the file. The archive is found
+    from the carried-forward BUYs, or given in the `archive_id` form field.
+    """
+    if 'portfolio_file' not in request.files:
+        return jsonify({"error": "No file part"}), 400
+
+    file = request.files['portfolio_file']
+    try:
+        digest = stream_digest(file.stream)
+        requested_id = request.form.get('archive_id') or request.args.get('archive_id') or ''
+        etag = f"{digest}-{requested_id}"
+        cache_key = ('history_report', etag)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return cached_json_response(body, etag)
+
+        portfolio_objects = list(iter_portfolio_json(file.stream, max_bytes=MAX_UPLOAD_BYTES))
+        archive_id = requested_id or find_archive_id(portfolio_objects)
+        if archive_id is None:
+            return jsonify({"error": "This portfolio has no archived history (pass archive_id)"}), 404
+        try:
+            index = archive_store.load_index(archive_id)
+        except ArchiveError as e:
+            return jsonify({"error": str(e)}), 404
+        metrics.note_transactions(len(portfolio_objects))
+        live_analysis = analyze_portfolio_by_lot(portfolio_objects, lot_policy=archive_lot_policy(index))
+        report = history_report(index, portfolio_objects, live_analysis)
+        report["archive_id"] = archive_id
+        with metrics.timed('response.serialize'):
+            body = app.json.dumps(report).encode('utf-8')
+        response_cache.put(cache_key, body)
+        return cached_json_response(body, etag)
+    except PortfolioFormatError as e:
+        return upload_error_response(e)
     except Exception as e:
+        metrics.note_error(e)
         import traceback
         traceback.print_exc()
         return jsonify({"error": f"An internal error occurred: {e}"}), 500
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """
+    Status of a background job. With `?wait=N` the request is held for up to N
+    seconds (at most MAX_JOB_WAIT_SECONDS) until the job has ended.
+    """
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    try:
+        wait = min(float(request.args.get('wait') or 0), MAX_JOB_WAIT_SECONDS)
+    except ValueError:
+        return jsonify({"error": "'wait' must be a number of seconds"}), 400
+    if wait > 0 and not job.ended:
+        job.wait(wait)
+    return jsonify(job_status_data(job))
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """The result of a finished job: the same response the synchronous request would have returned."""
+    job = analysis_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if job.status == DONE:
+        response = cached_json_response(job.body, job.etag)
+        # As with /analyze?session=1, the first fetch gets an analysis session; a shared or cached result comes without one
+        attachment = analysis_jobs.take_attachment(job)
+        if attachment is not None:
+            set_session_header(response, analysis_sessions.open(*attachment))
+        return response
+    if job.status == FAILED:
+        error = job.error if job.error_status != 500 else f"An internal error occurred: {job.error}"
+        return jsonify({"error": error}), job.error_status
+    return job_accepted_response(job)
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit/miss/eviction counters of the response cache (per worker process)."""
+    return jsonify(response_cache.stats())
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Request, phase and cache metrics of all worker processes in the Prometheus text format."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled (set METRICS_ENABLED=1)"}), 404
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file